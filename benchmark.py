@@ -0,0 +1,340 @@
+import glob
+import os
+import sys
+import time
+import tracemalloc
+from random import Random
+
+from panda3d.core import *
+
+loadPrcFileData("", "window-type none")
+loadPrcFileData("", "audio-library-name null")
+
+from direct.distributed.PyDatagram import PyDatagram
+from direct.distributed.PyDatagramIterator import PyDatagramIterator
+from direct.showbase.ShowBase import ShowBase
+
+import src.ai as ai
+import src.collision as collision
+import src.constants as constants
+import src.engine as engine
+import src.net as net
+import src.net2 as net2
+
+base = ShowBase()
+engine.log = engine.Logger()
+
+
+def showHelpInfo():
+    print("Usage: benchmark.py test [nav files]")
+    print("Tests:")
+    print("build\t\t\tNavmesh construction time for each nav file")
+    print("memory\t\t\tPython heap used by each navmesh, and by its arrays")
+    print("paths\t\t\tA* paths per second on each navmesh")
+    print("hpa\t\t\tFlat A* against hierarchical (HPA*) search on each navmesh")
+    print("chase\t\t\tSearches needed by a pack of bots chasing one target through the path scheduler")
+    print("bvh [maps]\t\tStatic geometry BVH build time and rays/sec against Panda's collision traverser")
+    print("packets\t\t\tController update encode/decode throughput, NetObjects against compiled Schemas")
+    sys.exit()
+
+
+def getNavFiles(args):
+    "Returns the nav mesh filenames (without extension) to benchmark. Defaults to every shipped *-nav.egg."
+    if len(args) > 0:
+        return args
+    return sorted(os.path.basename(x)[:-4]
+                  for x in glob.glob("maps/*-nav.egg"))
+
+
+def loadNavMesh(filename):
+    ai.navMeshCache.clear()
+    return ai.NavMesh("maps", filename)
+
+
+def benchmarkBuild(navFiles):
+    print("%-24s %6s %6s %10s" % ("navmesh", "nodes", "edges", "seconds"))
+    total = 0
+    for filename in navFiles:
+        navMesh = loadNavMesh(filename)
+        total += navMesh.buildTime
+        print("%-24s %6d %6d %10.3f" %
+              (filename, len(navMesh.nodes), len(navMesh.edges), navMesh.buildTime))
+    print("%-24s %6s %6s %10.3f" % ("total", "", "", total))
+
+
+def benchmarkMemory(navFiles):
+    "Panda3D allocates Vec3 data outside the Python heap, so that isn't counted."
+    print("%-24s %6s %6s %10s %10s" %
+          ("navmesh", "nodes", "edges", "heap KB", "arrays KB"))
+    for filename in navFiles:
+        ai.navMeshCache.clear()
+        tracemalloc.start()
+        navMesh = ai.NavMesh("maps", filename)
+        heap = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print("%-24s %6d %6d %10d %10d" %
+              (filename, len(navMesh.nodes), len(navMesh.edges), heap // 1024,
+               navMesh.getArrays().getSize() // 1024))
+
+
+def benchmarkPaths(navFiles, numPaths=500):
+    print("%-24s %6s %6s %6s %10s %10s" %
+          ("navmesh", "nodes", "edges", "mode", "found", "paths/sec"))
+    for filename in navFiles:
+        navMesh = loadNavMesh(filename)
+        random = Random(1337)
+        pairs = [(random.choice(navMesh.nodes), random.choice(navMesh.nodes))
+                 for _ in range(numPaths)]
+        found = 0
+        start = time.time()
+        for startNode, endNode in pairs:
+            path = navMesh.findPathFromNodes(
+                startNode, endNode, startNode.center, endNode.center, 1.5)
+            if path is not None:
+                found += 1
+        elapsed = time.time() - start
+        print("%-24s %6d %6d %6s %10d %10.1f" %
+              (filename, len(navMesh.nodes), len(navMesh.edges),
+               "routes" if navMesh.hasRoutes() else "A*", found,
+               numPaths / elapsed))
+
+
+def getPathLength(path):
+    points = [path.start] + path.waypoints + [path.end]
+    return sum((points[i + 1] - points[i]).length()
+               for i in range(len(points) - 1))
+
+
+def benchmarkHierarchy(navFiles, numPaths=500):
+    print("%-24s %6s %8s %8s %10s %10s %8s %8s" %
+          ("navmesh", "nodes", "clusters", "portals", "flat/sec", "hpa/sec", "speedup", "length"))
+    for filename in navFiles:
+        navMesh = loadNavMesh(filename)
+        hierarchy = ai.NavMeshHierarchy(navMesh)
+        random = Random(1337)
+        pairs = [(random.choice(navMesh.nodes), random.choice(navMesh.nodes))
+                 for _ in range(numPaths)]
+        results = []
+        for search in (navMesh._searchEdges, hierarchy.findEdges):
+            found = []
+            start = time.time()
+            for startNode, endNode in pairs:
+                found.append(search(startNode, endNode,
+                                    startNode.center, endNode.center))
+            elapsed = time.time() - start
+            # Path lengths are measured after string pulling, outside the timing.
+            lengths = []
+            for i in range(len(pairs)):
+                startNode, endNode = pairs[i]
+                if found[i] is None:
+                    lengths.append(None)
+                else:
+                    lengths.append(getPathLength(navMesh.makePath(
+                        found[i], startNode, endNode, startNode.center, endNode.center, 1.5)))
+            results.append((numPaths / elapsed, lengths))
+        (flatRate, flatLengths), (hpaRate, hpaLengths) = results
+        ratios = [hpaLengths[i] / flatLengths[i] for i in range(numPaths)
+                  if flatLengths[i] and hpaLengths[i] is not None]
+        print("%-24s %6d %8d %8d %10.1f %10.1f %7.2fx %7.2fx" %
+              (filename, len(navMesh.nodes), len(hierarchy.clusters),
+               len(hierarchy.links), flatRate, hpaRate, hpaRate / flatRate,
+               sum(ratios) / max(len(ratios), 1)))
+
+
+def benchmarkChase(navFiles, numBots=24, numRounds=30):
+    """Every round, each bot moves to a random neighbouring node and asks for a path to the target,
+    like AIControllers in a survival round. The target moves every few rounds."""
+    print("%-24s %8s %8s %10s %10s" %
+          ("navmesh", "requests", "searches", "hit rate", "seconds"))
+    for filename in navFiles:
+        navMesh = loadNavMesh(filename)
+        scheduler = ai.PathScheduler()
+        random = Random(1337)
+        target = random.choice(navMesh.nodes)
+        bots = [random.choice(navMesh.nodes) for _ in range(numBots)]
+        start = time.time()
+        for round in range(numRounds):
+            if round % 5 == 0:
+                target = random.choice(navMesh.nodes)
+            for i in range(numBots):
+                neighbors = [n for e in bots[i].edges for n in e.nodes]
+                bots[i] = random.choice(neighbors)
+
+                def callback(path):
+                    pass
+                scheduler.add(callback, bots[i], target,
+                              bots[i].center, target.center, 1.5)
+            while len(scheduler.requests) > 0:
+                scheduler.update(navMesh)
+        elapsed = time.time() - start
+        cache = navMesh.pathCache
+        print("%-24s %8d %8d %9.1f%% %10.3f" %
+              (filename, numBots * numRounds, scheduler.searches,
+               100.0 * cache.hits / max(cache.hits + cache.misses, 1), elapsed))
+
+
+def getGeometryMaps(args):
+    "Returns the map names to benchmark. Defaults to every map with static geometry."
+    if len(args) > 0:
+        return args
+    names = []
+    for filename in sorted(glob.glob("maps/*.txt")):
+        lines = open(filename).read().split("\n")
+        if any(line.startswith("world") for line in lines) and any(
+                line.startswith("geometry") for line in lines):
+            names.append(os.path.basename(filename)[:-4])
+    return names
+
+
+def benchmarkBVH(mapNames, numRays=2000):
+    if not collision.isAvailable():
+        print("NumPy isn't installed.")
+        return
+    print("%-24s %8s %8s %10s %10s %10s %10s" %
+          ("map", "tris", "nodes", "build sec", "panda/sec", "bvh/sec", "batch/sec"))
+    for name in mapNames:
+        root = render.attachNewNode(name)
+        for line in open("maps/" + name + ".txt").read().split("\n"):
+            tokens = line.split()
+            if len(tokens) >= 5 and tokens[0] in ("geometry", "geometry-scenery"):
+                node = loader.loadModel("maps/" + tokens[1])
+                node.reparentTo(root)
+                node.setPos(float(tokens[2]), float(tokens[3]), float(tokens[4]))
+        root.setCollideMask(BitMask32(1))
+        bvh = collision.StaticBVH()
+        bvh.build(collision.getTriangles(root, render))
+        bounds = root.getTightBounds()
+        random = Random(1337)
+        rays = []
+        for _ in range(numRays):
+            origin = Point3(*[random.uniform(bounds[0][i], bounds[1][i]) for i in range(3)])
+            direction = Vec3(random.uniform(-1, 1), random.uniform(-1, 1), random.uniform(-1, 1))
+            rays.append((origin, direction))
+
+        traverser = CollisionTraverser()
+        cNode = CollisionNode("ray")
+        cNode.setIntoCollideMask(BitMask32(0))
+        cNode.setFromCollideMask(BitMask32(1))
+        ray = CollisionRay()
+        cNode.addSolid(ray)
+        rayNP = render.attachNewNode(cNode)
+        queue = CollisionHandlerQueue()
+        traverser.addCollider(rayNP, queue)
+        start = time.time()
+        for origin, direction in rays:
+            ray.setOrigin(origin)
+            ray.setDirection(direction)
+            traverser.traverse(root)
+            queue.sortEntries()
+        pandaRate = numRays / (time.time() - start)
+        rayNP.removeNode()
+
+        start = time.time()
+        for origin, direction in rays:
+            bvh.getFirstHit(origin, direction)
+        bvhRate = numRays / (time.time() - start)
+        start = time.time()
+        bvh.castRays([tuple(origin) for origin, _ in rays],
+                     [tuple(direction) for _, direction in rays])
+        batchRate = numRays / (time.time() - start)
+        print("%-24s %8d %8d %10.3f %10.1f %10.1f %10.1f" %
+              (name, bvh.numTriangles, bvh.getNumNodes(), bvh.buildTime, pandaRate, bvhRate, batchRate))
+        root.removeNode()
+
+
+def benchmarkPackets(numMessages=20000):
+    """Each message is the fixed part of a droid's controller update: header, full snapshot, status and target position.
+    The NetObject codec allocates an object per float, the way net2's vector types used to.
+    Messages go 100 to a datagram, like a busy server tick."""
+    schema = net.Schema(net.Uint8, net.Uint8, net.Uint8, net2.HighResVec3, net2.StandardQuat,
+                        net.Boolean, net.Int16, net2.LowResVec3)
+    random = Random(1337)
+    messages = []
+    for _ in range(numMessages):
+        messages.append((random.randint(0, 255),
+                         Vec3(random.uniform(-200, 200), random.uniform(-200, 200), random.uniform(0, 50)),
+                         Quat(random.uniform(-1, 1), random.uniform(-1, 1), random.uniform(-1, 1), random.uniform(-1, 1)),
+                         random.random() < 0.1, random.randint(0, 100),
+                         Vec3(random.uniform(-200, 200), random.uniform(-200, 200), random.uniform(0, 50))))
+
+    def encodeObjects(batch):
+        p = net.Packet()
+        for id, pos, quat, onFire, health, target in batch:
+            p.add(net.Uint8(constants.PACKET_CONTROLLER))
+            p.add(net.Uint8(id))
+            p.add(net.Uint8(net2.SNAPSHOT_FULL))
+            for x in (pos.getX(), pos.getY(), pos.getZ()):
+                p.add(net.HighResFloat(x))
+            for x in (quat.getX(), quat.getY(), quat.getZ(), quat.getW()):
+                p.add(net.StandardFloat(x))
+            p.add(net.Boolean(onFire))
+            p.add(net.Int16(health))
+            for x in (target.getX(), target.getY(), target.getZ()):
+                p.add(net.LowResFloat(x))
+        datagram = PyDatagram()
+        p.addTo(datagram)
+        return datagram
+
+    def encodeSchema(batch):
+        p = net.Packet()
+        for id, pos, quat, onFire, health, target in batch:
+            p.write(schema, constants.PACKET_CONTROLLER, id, net2.SNAPSHOT_FULL,
+                    pos, quat, onFire, health, target)
+        datagram = PyDatagram()
+        p.addTo(datagram)
+        return datagram
+
+    def decodeObjects(iterator):
+        return (net.Uint8.getFrom(iterator), net.Uint8.getFrom(iterator), net.Uint8.getFrom(iterator),
+                Vec3(net.HighResFloat.getFrom(iterator), net.HighResFloat.getFrom(iterator),
+                     net.HighResFloat.getFrom(iterator)),
+                Quat(net.StandardFloat.getFrom(iterator), net.StandardFloat.getFrom(iterator),
+                     net.StandardFloat.getFrom(iterator), net.StandardFloat.getFrom(iterator)),
+                net.Boolean.getFrom(iterator), net.Int16.getFrom(iterator),
+                Vec3(net.LowResFloat.getFrom(iterator), net.LowResFloat.getFrom(iterator),
+                     net.LowResFloat.getFrom(iterator)))
+
+    batches = [messages[i:i + 100] for i in range(0, numMessages, 100)]
+    print("%-10s %12s %12s %10s" % ("codec", "encode/sec", "decode/sec", "bytes"))
+    results = []
+    for name, encode, decode in (("NetObject", encodeObjects, decodeObjects),
+                                 ("Schema", encodeSchema, schema.getFrom)):
+        start = time.time()
+        datagrams = [encode(batch) for batch in batches]
+        encodeRate = numMessages / (time.time() - start)
+        start = time.time()
+        for datagram in datagrams:
+            iterator = PyDatagramIterator(datagram)
+            for _ in range(100):
+                decode(iterator)
+        decodeRate = numMessages / (time.time() - start)
+        results.append((encodeRate, decodeRate, [x.getMessage() for x in datagrams]))
+        print("%-10s %12.1f %12.1f %10d" % (name, encodeRate, decodeRate,
+                                            sum(x.getLength() for x in datagrams)))
+    (oldEncode, oldDecode, oldData), (newEncode, newDecode, newData) = results
+    print("%-10s %11.2fx %11.2fx %10s" % ("speedup", newEncode / oldEncode, newDecode / oldDecode,
+                                          "same" if oldData == newData else "different"))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        showHelpInfo()
+
+    test = sys.argv[1]
+    navFiles = getNavFiles(sys.argv[2:])
+    if test == "bvh":
+        benchmarkBVH(getGeometryMaps(sys.argv[2:]))
+    elif test == "packets":
+        benchmarkPackets()
+    elif test == "build":
+        benchmarkBuild(navFiles)
+    elif test == "memory":
+        benchmarkMemory(navFiles)
+    elif test == "paths":
+        benchmarkPaths(navFiles)
+    elif test == "hpa":
+        benchmarkHierarchy(navFiles)
+    elif test == "chase":
+        benchmarkChase(navFiles)
+    else:
+        showHelpInfo()
@@ -0,0 +1,79 @@
+import glob
+import os
+import sys
+import time
+
+from panda3d.core import *
+
+loadPrcFileData("", "window-type none")
+loadPrcFileData("", "audio-library-name null")
+
+from direct.showbase.ShowBase import ShowBase
+
+import src.collision as collision
+
+base = ShowBase()
+
+
+def showHelpInfo():
+    print("Usage: buildproxies.py [-c cell size] [maps]")
+    print("Writes a simplified collision proxy next to every geometry and geometry-scenery model of each map (all maps by default).")
+    print("Physics and ray queries use the proxy instead of the visible mesh. Delete a proxy to go back to the full mesh.")
+    print("-c cell size\t\tVertices closer than this are merged (default %.2f)" %
+          collision.proxyCellSize)
+    sys.exit()
+
+
+def getMapModels(name):
+    "Returns the model filenames of the static geometry in a map file. Physics entity files in maps/ have none."
+    lines = open("maps/" + name + ".txt").read().split("\n")
+    if not any(line.startswith("world") for line in lines):
+        return []
+    models = []
+    for line in lines:
+        tokens = line.split()
+        if len(tokens) >= 2 and tokens[0] in ("geometry", "geometry-scenery") and tokens[1] not in models:
+            models.append(tokens[1])
+    return models
+
+
+if __name__ == '__main__':
+    if "-h" in sys.argv or "--help" in sys.argv:
+        showHelpInfo()
+    if not collision.isAvailable():
+        print("Building collision proxies needs NumPy.")
+        sys.exit(1)
+
+    args = sys.argv[1:]
+    cellSize = collision.proxyCellSize
+    if "-c" in args:
+        i = args.index("-c")
+        cellSize = float(args[i + 1])
+        del args[i:i + 2]
+    maps = args
+    if len(maps) == 0:
+        maps = sorted(os.path.basename(x)[:-4] for x in glob.glob("maps/*.txt"))
+    print("%-28s %10s %10s %8s %8s" %
+          ("model", "triangles", "proxy", "ratio", "seconds"))
+    totalBefore = 0
+    totalAfter = 0
+    done = set()
+    for name in maps:
+        for model in getMapModels(name):
+            if model in done:
+                continue
+            done.add(model)
+            start = time.time()
+            node = loader.loadModel("maps/" + model)
+            triangles = collision.getTriangles(node, node)
+            proxy = collision.decimateTriangles(triangles, cellSize)
+            collision.writeEgg(proxy, "maps/" +
+                               collision.getProxyFilename(model) + ".egg")
+            node.removeNode()
+            totalBefore += len(triangles)
+            totalAfter += len(proxy)
+            print("%-28s %10d %10d %7.1f%% %8.2f" %
+                  (model, len(triangles), len(proxy), 100.0 * len(proxy) / max(len(triangles), 1),
+                   time.time() - start))
+    print("%-28s %10d %10d %7.1f%%" %
+          ("total", totalBefore, totalAfter, 100.0 * totalAfter / max(totalBefore, 1)))
@@ -0,0 +1,44 @@
+import glob
+import os
+import sys
+import time
+
+from panda3d.core import *
+
+loadPrcFileData("", "window-type none")
+loadPrcFileData("", "audio-library-name null")
+
+from direct.showbase.ShowBase import ShowBase
+
+import src.ai as ai
+import src.engine as engine
+
+base = ShowBase()
+engine.log = engine.Logger()
+
+
+def showHelpInfo():
+    print("Usage: buildroutes.py [nav files]")
+    print("Writes all-pairs routing tables next to each nav mesh (maps/*-nav.egg by default).")
+    print("Rebuild them whenever a nav mesh changes. Out of date tables are ignored.")
+    sys.exit()
+
+
+if __name__ == '__main__':
+    if "-h" in sys.argv or "--help" in sys.argv:
+        showHelpInfo()
+
+    navFiles = sys.argv[1:]
+    if len(navFiles) == 0:
+        navFiles = sorted(os.path.basename(x)[:-4]
+                          for x in glob.glob("maps/*-nav.egg"))
+    for filename in navFiles:
+        ai.navMeshCache.clear()
+        navMesh = ai.NavMesh("maps", filename)
+        start = time.time()
+        navMesh.buildRoutes()
+        routesFilename = navMesh.getRoutesFilename("maps")
+        navMesh.saveRoutes(routesFilename)
+        print("%-24s %6d nodes %8.2f seconds %8d KB" %
+              (filename, len(navMesh.nodes), time.time() - start,
+               os.path.getsize(routesFilename) // 1024))
@@ -1,5 +1,6 @@
 import sys
 
+import src.ai as ai
 import src.audio as audio
 import src.core as core
 import src.engine as engine
@@ -31,6 +32,7 @@ def showHelpInfo():
     print("-p portnumber\t\tUse the specified port (for both client and server)")
     print("-d map\t\t\tRun in dedicated server mode on the specified map")
     print("-v\t\t\t(Daemon only) Run the game in survival mode")
+    print("-j workers\t\tFind AI paths on the specified number of worker processes")
     print("-h\t\t\tShow help information")
     print("-m\t\t\tDeveloper mode")
     engine.exit()
@@ -114,6 +116,12 @@ while i < len(sys.argv):
             i += 1
         except BaseException:
             showHelpInfo()
+    elif sys.argv[i] == "-j":
+        try:
+            ai.pathWorkers = int(sys.argv[i + 1])
+            i += 1
+        except BaseException:
+            showHelpInfo()
     elif sys.argv[i] == "-m":
         skipIntro = True
         engine.enablePause = True
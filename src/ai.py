@@ -1,8 +1,17 @@
 import math
+import multiprocessing
+import os
+import struct
 import sys
 import time
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from heapq import heappop, heappush
 from random import choice, randint, random
 
+from . import collision
 from . import engine
 from . import entities
 
@@ -12,10 +21,19 @@ from panda3d.ode import *
 from direct.showbase.DirectObject import DirectObject
 
 
+pathBudget = 0.004  # Seconds of path finding allowed per frame
+maxPathWait = 3.0  # Requests waiting longer than this are dropped. The AI will ask again.
+pathWorkers = 0  # Number of worker processes to find paths on. 0 finds them on the main thread.
+physicsSpace = "hash"  # ODE broadphase: "hash", "quadtree" or "simple". Maps can choose their own with a "physics" line.
+hashSpaceLevels = (-3, 10)  # Smallest and largest cell sizes of a hash space, as powers of two
+quadTreeDepth = 6  # Levels in a quadtree space
+quickStepIterations = 20  # Solver iterations per physics step
+
+
 def init():
-    global pathRequests, currentWorld, pathFindTask
+    global pathScheduler, currentWorld, pathFindTask
     currentWorld = None
-    pathRequests = []
+    pathScheduler = PathScheduler(workers=pathWorkers)
     pathFindTask = taskMgr.add(pathWorker, 'ai-path-worker')
 
 
@@ -28,29 +46,249 @@ class PathRequest:
             position,
             targetPosition,
             radius):
-        self.callback = callback
+        self.callbacks = [callback]
+        self.endpoints = {callback: (position, targetPosition)}  # Each requester's own start and goal, for fitting its path
         self.aiNode = aiNode
         self.targetAiNode = targetAiNode
         self.position = position
         self.targetPosition = targetPosition
         self.radius = radius
+        self.time = time.time()
+
+    def getPriority(self, now):
+        "Lower values are serviced first. Nearby targets are the most urgent, and each second of waiting counts as 10 units closer."
+        return (self.targetPosition - self.position).length() - \
+            (now - self.time) * 10
+
+
+class PathScheduler:
+    """Services path requests within a per-frame time budget, most urgent first.
+    Requests for the same nodes share one search, and a new request from a callback replaces its pending one.
+    If workers is above zero, searches run on a pool of worker processes instead, and only the results are handled on the main thread."""
+
+    def __init__(self, budget=pathBudget, workers=0):
+        self.budget = budget
+        self.workers = workers
+        self.requests = dict()  # (aiNode, targetAiNode, radius) -> PathRequest
+        self.requestKeys = dict()  # Callback -> key of its pending request
+        self.pool = None
+        self.poolArrays = None  # The NavMeshArrays the pool was started with
+        self.running = []  # (future, request) pairs for searches on the pool
+        self.resetStats()
+
+    def resetStats(self):
+        self.searches = 0
+        self.served = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.totalWait = 0
+        self.maxWait = 0
+        self.maxQueueDepth = 0
+
+    def getQueueDepth(self):
+        return len(self.requestKeys)
+
+    def add(
+            self,
+            callback,
+            aiNode,
+            targetAiNode,
+            position,
+            targetPosition,
+            radius):
+        key = (aiNode, targetAiNode, radius)
+        oldKey = self.requestKeys.get(callback)
+        if oldKey is not None and oldKey != key:
+            # The requester has moved on, so its old request is stale.
+            self._removeCallback(oldKey, callback)
+            self.dropped += 1
+        request = self.requests.get(key)
+        if request is None:
+            self.requests[key] = PathRequest(
+                callback, aiNode, targetAiNode, position, targetPosition, radius)
+        else:
+            if callback not in request.callbacks:
+                request.callbacks.append(callback)
+            request.endpoints[callback] = (position, targetPosition)
+            request.position = position
+            request.targetPosition = targetPosition
+            self.coalesced += 1
+        self.requestKeys[callback] = key
+        self.maxQueueDepth = max(self.maxQueueDepth, self.getQueueDepth())
+
+    def _removeCallback(self, key, callback):
+        request = self.requests[key]
+        request.callbacks.remove(callback)
+        del request.endpoints[callback]
+        if len(request.callbacks) == 0:
+            del self.requests[key]
+
+    def _removeRequest(self, key):
+        request = self.requests.pop(key)
+        for callback in request.callbacks:
+            del self.requestKeys[callback]
+        return request
+
+    def _popMostUrgent(self, now):
+        key = min(self.requests,
+                  key=lambda x: self.requests[x].getPriority(now))
+        return self._removeRequest(key)
+
+    def _deliver(self, navMesh, request, edges):
+        "Only the edge search is shared. Each requester gets a path fitted to its own start and goal positions."
+        wait = time.time() - request.time
+        for callback in request.callbacks:
+            if edges is None:
+                path = None
+            else:
+                position, targetPosition = request.endpoints[callback]
+                path = navMesh.makePath(
+                    edges,
+                    request.aiNode,
+                    request.targetAiNode,
+                    position,
+                    targetPosition,
+                    request.radius)
+            callback(path)
+            self.served += 1
+            self.totalWait += wait
+            self.maxWait = max(self.maxWait, wait)
+
+    def _deliverCached(self, navMesh, request):
+        "Delivers the request from the path cache if possible. Returns True if it was delivered."
+        found, edges = navMesh.pathCache.get(
+            request.aiNode, request.targetAiNode, request.radius)
+        if found:
+            self._deliver(navMesh, request, edges)
+        return found
+
+    def _search(self, navMesh, request):
+        if self._deliverCached(navMesh, request):
+            return
+        self.searches += 1
+        edges = navMesh.findEdgesFromNodes(
+            request.aiNode,
+            request.targetAiNode,
+            request.position,
+            request.targetPosition)
+        navMesh.pathCache.add(
+            request.aiNode, request.targetAiNode, request.radius, edges)
+        self._deliver(navMesh, request, edges)
+
+    def update(self, navMesh):
+        now = time.time()
+        for key in [k for k, v in self.requests.items()
+                    if now - v.time > maxPathWait]:
+            self.dropped += len(self._removeRequest(key).callbacks)
+        if self.workers > 0 and not navMesh.hasRoutes():
+            # Table walks are cheap enough to run here.
+            self._updatePool(navMesh, now)
+            return
+        deadline = now + self.budget
+        # At least one search runs every frame, however long it takes.
+        while len(self.requests) > 0:
+            self._search(navMesh, self._popMostUrgent(now))
+            if time.time() >= deadline:
+                break
+
+    def _updatePool(self, navMesh, now):
+        if self.pool is None or self.poolArrays is not navMesh.getArrays():
+            self._startPool(navMesh)
+            if self.pool is None:
+                return
+        running = []
+        for future, request in self.running:
+            if not future.done():
+                running.append((future, request))
+                continue
+            try:
+                edges = future.result()
+            except Exception as e:
+                engine.log.warning("Path worker failed: " + str(e))
+                self.dropped += len(request.callbacks)
+                continue
+            if edges is not None:
+                edges = [navMesh.edges[i] for i in edges]
+            navMesh.pathCache.add(
+                request.aiNode, request.targetAiNode, request.radius, edges)
+            self._deliver(navMesh, request, edges)
+        self.running = running
+        # Keep each worker busy, with one more search queued behind it.
+        while len(self.requests) > 0 and len(
+                self.running) < self.workers * 2:
+            request = self._popMostUrgent(now)
+            if self._deliverCached(navMesh, request):
+                continue
+            self.searches += 1
+            try:
+                future = self.pool.submit(
+                    findPathInWorker,
+                    request.aiNode.index,
+                    request.targetAiNode.index,
+                    (request.position.getX(), request.position.getY(), request.position.getZ()),
+                    (request.targetPosition.getX(), request.targetPosition.getY(), request.targetPosition.getZ()))
+            except BrokenProcessPool:
+                engine.log.warning(
+                    "Path workers stopped. Finding paths on the main thread.")
+                self._stopPool()
+                self.workers = 0
+                self.searches -= 1
+                self._search(navMesh, request)
+                return
+            self.running.append((future, request))
+
+    def _startPool(self, navMesh):
+        self._stopPool()
+        # Spawned workers would re-run main.py, which starts the game, so only fork is supported.
+        if "fork" not in multiprocessing.get_all_start_methods():
+            engine.log.warning(
+                "Path workers require fork. Finding paths on the main thread.")
+            self.workers = 0
+            return
+        self.poolArrays = navMesh.getArrays()
+        self.pool = ProcessPoolExecutor(
+            self.workers,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=initPathWorker,
+            initargs=(self.poolArrays,))
+
+    def _stopPool(self):
+        for future, request in self.running:
+            future.cancel()
+            self.dropped += len(request.callbacks)
+        self.running = []
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+        self.pool = None
+        self.poolArrays = None
 
-def pathWorker(task):
-    if len(pathRequests) > 0:
-        req = pathRequests.pop(0)
-        req.callback(
-            currentWorld.navMesh.findPathFromNodes(
-                req.aiNode,
-                req.targetAiNode,
-                req.position,
-                req.targetPosition,
-                req.radius))
+    def clear(self):
+        self.dropped += self.getQueueDepth()
+        self.requests.clear()
+        self.requestKeys.clear()
+        self._stopPool()
 
-        del req
+    def getStats(self):
+        averageWait = self.totalWait / self.served if self.served > 0 else 0
+        return "%d paths served from %d searches, %d coalesced, %d dropped. Queue depth %d (peak %d), wait %.1f ms average, %.1f ms max" % (
+            self.served, self.searches, self.coalesced, self.dropped, self.getQueueDepth(), self.maxQueueDepth, averageWait * 1000, self.maxWait * 1000)
 
-    if len(pathRequests) > 5:
-        del pathRequests[:]
 
+workerArrays = None  # The NavMeshArrays in a path worker process
+
+
+def initPathWorker(arrays):
+    global workerArrays
+    workerArrays = arrays
+
+
+def findPathInWorker(startNode, endNode, startPos, endPos):
+    return workerArrays.findPath(startNode, endNode, startPos, endPos)
+
+
+def pathWorker(task):
+    if currentWorld is not None and currentWorld.navMesh is not None:
+        pathScheduler.update(currentWorld.navMesh)
     return task.cont
 
 
@@ -61,9 +299,109 @@ def requestPath(
         position,
         targetPosition,
         radius):
-    request = PathRequest(callback, aiNode, targetAiNode,
-                          position, targetPosition, radius)
-    pathRequests.append(request)
+    pathScheduler.add(callback, aiNode, targetAiNode,
+                      position, targetPosition, radius)
+
+
+class HitscanService:
+    """Casts rays through the collision scene graph with a persistent pool of ray colliders.
+    Rays can be cast in batches, so several rays share one traversal of the scene graph.
+    Only the nearest hit of each ray is returned."""
+
+    def __init__(self, traverser):
+        self.traverser = traverser
+        self.root = render.attachNewNode("hitscan")
+        self.colliders = []
+        self.rays = 0
+        self.batches = 0
+        self.castTime = 0.0
+        self.startTime = time.time()
+
+    def _getCollider(self, index):
+        "Returns the (nodePath, ray, queue) at the given index of the pool, adding one if needed."
+        while len(self.colliders) <= index:
+            cNode = CollisionNode("hitscan-ray")
+            cNode.setIntoCollideMask(BitMask32(0))
+            cNode.setFromCollideMask(BitMask32(1))
+            ray = CollisionRay()
+            cNode.addSolid(ray)
+            self.colliders.append(
+                (self.root.attachNewNode(cNode), ray, CollisionHandlerQueue()))
+        return self.colliders[index]
+
+    def castRays(self, rays, node=None):
+        """Rays is a list of (position, direction, ignore) tuples, where ignore is a NodePath whose collisions are skipped, or None.
+        Returns a list with the first CollisionEntry along each ray, or None where a ray hits nothing.
+        Only checks for collisions with the specified NodePath, if one is given."""
+        if len(rays) == 0:
+            return []
+        start = time.time()
+        for i in range(len(rays)):
+            (position, direction, ignore) = rays[i]
+            (nodePath, ray, queue) = self._getCollider(i)
+            ray.setOrigin(position)
+            ray.setDirection(direction)
+            queue.clearEntries()
+            self.traverser.addCollider(nodePath, queue)
+        if node is None:
+            self.traverser.traverse(engine.renderLit)
+        else:
+            self.traverser.traverse(node)
+        self.traverser.clearColliders()
+        results = []
+        for i in range(len(rays)):
+            ignore = rays[i][2]
+            queue = self.colliders[i][2]
+            queue.sortEntries()
+            result = None
+            for j in range(queue.getNumEntries()):
+                entry = queue.getEntry(j)
+                if ignore is None or not ignore.isAncestorOf(entry.getIntoNodePath()):
+                    result = entry
+                    break
+            results.append(result)
+            queue.clearEntries()
+        self.rays += len(rays)
+        self.batches += 1
+        self.castTime += time.time() - start
+        return results
+
+    def castRay(self, position, direction, ignore=None, node=None):
+        "Returns the first CollisionEntry along the ray that isn't under the ignored NodePath, or None."
+        return self.castRays([(position, direction, ignore)], node)[0]
+
+    def getQueue(self, position, direction, node=None):
+        """Gets a CollisionHandlerQueue containing all collisions along the specified ray, using the first pooled collider.
+        Only checks for collisions with the specified NodePath, if one is given."""
+        (nodePath, ray, _) = self._getCollider(0)
+        ray.setOrigin(position)
+        ray.setDirection(direction)
+        queue = CollisionHandlerQueue()
+        self.traverser.addCollider(nodePath, queue)
+        if node is None:
+            self.traverser.traverse(engine.renderLit)
+        else:
+            self.traverser.traverse(node)
+        self.traverser.clearColliders()
+        queue.sortEntries()
+        return queue
+
+    def resetStats(self):
+        self.rays = 0
+        self.batches = 0
+        self.castTime = 0.0
+        self.startTime = time.time()
+
+    def getStats(self):
+        elapsed = max(time.time() - self.startTime, 0.001)
+        raysPerSecond = self.rays / self.castTime if self.castTime > 0 else 0
+        return "%d rays in %d batches (%.1f rays/sec of play, %.0f rays/sec while casting), %d pooled colliders" % (
+            self.rays, self.batches, self.rays / elapsed, raysPerSecond, len(self.colliders))
+
+    def delete(self):
+        self.traverser.clearColliders()
+        self.root.removeNode()
+        del self.colliders[:]
 
 
 class World:
@@ -75,6 +413,8 @@ class World:
         currentWorld = self
         self.grids = dict()
         self.navMesh = None
+        self.staticBVH = None  # A collision.StaticBVH of the level geometry, if NumPy is installed
+        self.sweeps = collision.SweepService()
         self.spawnPoints = []
         self.docks = []
         if base.cTrav == 0:
@@ -83,6 +423,7 @@ class World:
         else:
             self.traverser = base.cTrav
             self.traverser.clearColliders()
+        self.hitscan = HitscanService(self.traverser)
 
         # Setup the physics world
         self.world = OdeWorld()
@@ -95,27 +436,169 @@ class World:
         self.world.setSurfaceEntry(2, 2, 0.2, 0.3, 7, 0.9, 0.00001, 0.0, 0.01)
         self.world.setSurfaceEntry(0, 0, 1.0, 0.3, 7, 0.9, 0.00001, 0.0, 0.01)
 
-        self.space = OdeHashSpace()
-        self.space.setAutoCollideWorld(self.world)
+        self.world.setQuickStepNumIterations(quickStepIterations)
+
         self.contactGroup = OdeJointGroup()
+        self.contactSubscriptions = []  # (callback, categoryA, categoryB)
+        self.contactCategories = 0  # Every subscription's categoryA
+        self.contactReports = dict()  # Subscription index -> {(entityA, entityB): (entityA, entityB, position)}
+        self.space = None
+        self.setBroadphase(physicsSpace)
+        self.resetPhysicsStats()
+
+    def setBroadphase(self, kind, worldSize=100.0, levels=None, depth=None):
+        """Chooses the ODE space used to find colliding geometry. Hash spaces suit most maps, quadtree spaces suit large flat ones.
+        The space can only be changed before anything has been added to it, which is when the map file is read."""
+        if self.space is not None and self.space.getNumGeoms() > 0:
+            engine.log.warning(
+                "Can't change the physics broadphase once the space has geometry.")
+            return
+        if kind == "quadtree":
+            if depth is None:
+                depth = quadTreeDepth
+            space = OdeQuadTreeSpace(Point3(0, 0, 0), Vec3(
+                worldSize * 2, worldSize * 2, worldSize * 2), depth)
+        elif kind == "simple":
+            space = OdeSimpleSpace()
+        else:
+            if levels is None:
+                levels = hashSpaceLevels
+            space = OdeHashSpace()
+            space.setLevels(levels[0], levels[1])
+        if self.space is not None:
+            self.space.destroy()
+        self.space = space
+        self.broadphase = kind
+        self.space.setAutoCollideWorld(self.world)
         self.space.setAutoCollideJointGroup(self.contactGroup)
-        self.space.setCollisionEvent("physicsCollision")
 
-    def update(self):
+    def setQuickStepIterations(self, iterations):
+        self.world.setQuickStepNumIterations(iterations)
+
+    def subscribeContacts(self, callback, categoryA, categoryB=None):
+        """Calls callback(contacts) once per physics step when geometry in categoryA touched geometry in categoryB (see constants.CATEGORY_*).
+        contacts is a list of (entityA, entityB, position) with one entry per pair of entities. Entities are None for static geometry."""
+        if categoryB is None:
+            categoryB = categoryA
+        self.contactSubscriptions.append((callback, categoryA, categoryB))
+        self.contactCategories |= categoryA
+
+    def unsubscribeContacts(self, callback):
+        self.contactSubscriptions = [
+            x for x in self.contactSubscriptions if x[0] != callback]
+        self.contactCategories = 0
+        for subscription in self.contactSubscriptions:
+            self.contactCategories |= subscription[1]
+        self.contactReports.clear()
+
+    def _collectContacts(self):
+        """Tests each subscribed geom against the space, with its own category bits cleared and its collide bits set to the subscription's categoryB.
+        ODE's category test then drops every other pair in C++, so only the pairs a subscription wants reach Python."""
+        for i in range(self.space.getNumGeoms()):
+            geom = self.space.getGeom(i)
+            categoryBits = geom.getCategoryBits()
+            if categoryBits.getWord() & self.contactCategories == 0:
+                continue
+            collideBits = geom.getCollideBits()
+            geom.setCategoryBits(BitMask32.allOff())
+            for index in range(len(self.contactSubscriptions)):
+                callback, categoryA, categoryB = self.contactSubscriptions[index]
+                if categoryBits.getWord() & categoryA:
+                    geom.setCollideBits(BitMask32(categoryB))
+                    OdeUtil.collide2(geom, self.space, index, self._contactCallback)
+            geom.setCategoryBits(categoryBits)
+            geom.setCollideBits(collideBits)
+
+    def _contactCallback(self, index, geom1, geom2):
+        "Adds a pair of touching geoms to the subscription's report for this step."
+        self.contactsTested += 1
+        if geom2.getCategoryBits().getWord() == 0:
+            geom1, geom2 = geom2, geom1  # The subscribed geom is the one with its category bits cleared
+        entry = OdeUtil.collide(geom1, geom2, 1)
+        if entry.getNumContacts() == 0:
+            return
+        pair = (self._getGeomEntity(geom1), self._getGeomEntity(geom2))
+        report = self.contactReports.setdefault(index, dict())
+        if pair not in report and (pair[1], pair[0]) not in report:
+            report[pair] = pair + (entry.getContactPoint(0),)
+
+    def _getGeomEntity(self, geom):
+        if geom.hasBody():
+            return geom.getBody().getData()
+        return None
+
+    def _sendContactReports(self):
+        reports = self.contactReports
+        self.contactReports = dict()
+        subscriptions = self.contactSubscriptions  # A callback may unsubscribe
+        for index, report in reports.items():
+            contacts = [x for x in report.values() if (x[0] is None or x[0].active) and (
+                x[1] is None or x[1].active)]
+            if len(contacts) > 0:
+                self.contactsDispatched += len(contacts)
+                subscriptions[index][0](contacts)
+
+    def countContactJoints(self, entityGroup):
+        """Counts the contact joints autoCollide made this step. Neither autoCollide nor the joint group report it, so the joints are found through their bodies.
+        A joint between two bodies shows up on both of them, so it counts half on each."""
+        contacts = 0.0
+        for entity in entityGroup.getEntitiesOfType(entities.ObjectEntity):
+            body = entity.body
+            for i in range(body.getNumJoints()):
+                joint = body.getJoint(i)
+                if joint.getBody(0).isEmpty() or joint.getBody(1).isEmpty():
+                    contacts += 1.0
+                else:
+                    contacts += 0.5
+        return int(contacts + 0.5)
+
+    def update(self, entityGroup):
+        start = time.time()
         self.space.autoCollide()
-        self.world.quickStep(engine.clock.timeStep)
+        collided = time.time()
+        if len(self.contactSubscriptions) > 0:
+            self._collectContacts()  # Against the same positions autoCollide saw
+        filtered = time.time()
+        self.world.quickStep(engine.physicsTimeStep)
+        stepped = time.time()
+        contacts = self.countContactJoints(entityGroup)  # Before the joints are cleared
         self.contactGroup.empty()  # Clear the contact joints
+        self.physicsSteps += 1
+        self.collideTime += collided - start
+        self.maxCollideTime = max(self.maxCollideTime, collided - start)
+        self.filterTime += filtered - collided
+        self.stepTime += stepped - filtered
+        self.maxStepTime = max(self.maxStepTime, stepped - filtered)
+        if contacts > 0:
+            self.contacts += contacts
+            self.maxContacts = max(self.maxContacts, contacts)
+        self.sweeps.update(self)
+        if len(self.contactReports) > 0:
+            self._sendContactReports()
+
+    def resetPhysicsStats(self):
+        self.physicsSteps = 0
+        self.collideTime = 0.0
+        self.maxCollideTime = 0.0
+        self.stepTime = 0.0
+        self.maxStepTime = 0.0
+        self.contacts = 0
+        self.maxContacts = 0
+        self.filterTime = 0.0
+        self.contactsTested = 0
+        self.contactsDispatched = 0
+
+    def getPhysicsStats(self):
+        steps = max(self.physicsSteps, 1)
+        return "%s space, %d iterations. %d steps: autoCollide %.2f ms average, %.2f ms max. quickStep %.2f ms average, %.2f ms max. %d contact joints generated, %.1f per step, %d max. Contact filter %.2f ms average: %d subscribed pairs tested, %d contacts dispatched to %d subscriptions" % (
+            self.broadphase, self.world.getQuickStepNumIterations(), self.physicsSteps,
+            self.collideTime * 1000 / steps, self.maxCollideTime * 1000,
+            self.stepTime * 1000 / steps, self.maxStepTime * 1000,
+            self.contacts, float(self.contacts) / steps, self.maxContacts,
+            self.filterTime * 1000 / steps, self.contactsTested, self.contactsDispatched, len(self.contactSubscriptions))
 
     def getNearestDroid(self, entityGroup, pos):
-        distance = -1
-        droid = None
-        for entity in (x for x in list(entityGroup.entities.values())
-                       if isinstance(x, entities.BasicDroid)):
-            vector = pos - entity.getPosition()
-            if vector.length() < distance or distance == -1:
-                distance = vector.length()
-                droid = entity
-        return droid
+        return entityGroup.getNearestEntity(pos, entities.BasicDroid)
 
     def getNearestEnemy(
             self,
@@ -123,30 +606,14 @@ class World:
             pos,
             team,
             includeCloakedUnits=False):
-        distance = -1
-        enemy = None
-        for entity in (
-            x for x in list(entityGroup.entities.values()) if isinstance(
-                x, entities.BasicDroid) and (
-                (not x.cloaked) or includeCloakedUnits) and (
-                not team.isAlly(
-                    x.getTeam()))):
-            vector = pos - entity.getPosition()
-            if vector.length() < distance or distance == -1:
-                distance = vector.length()
-                enemy = entity
-        return enemy
+        if includeCloakedUnits:
+            return entityGroup.getNearestEntity(
+                pos, entities.BasicDroid, enemiesOf=team)
+        return entityGroup.getNearestEntity(
+            pos, entities.BasicDroid, enemiesOf=team, filter=lambda x: not x.cloaked)
 
     def getNearestDropPod(self, entityGroup, pos):
-        distance = -1
-        pod = None
-        for entity in (x for x in list(entityGroup.entities.values())
-                       if isinstance(x, entities.DropPod)):
-            vector = pos - entity.getPosition()
-            if vector.length() < distance or distance == -1:
-                distance = vector.length()
-                pod = entity
-        return pod
+        return entityGroup.getNearestEntity(pos, entities.DropPod)
 
     def getNearestSpawnPoint(self, pos):
         lowestDistance = -1
@@ -174,19 +641,20 @@ class World:
         dockList = [team.dock] if team.dock is not None else []
         points = sorted(dockList + self.spawnPoints,
                         key=lambda x: (x.getPosition() - pos).length())
-        enemies = [x for x in list(entityGroup.entities.values()) if isinstance(
-            x, entities.Actor) and x.getTeam() != team]
         for point in points:
             p = point.getPosition()
-            open = True
-            for enemy in enemies:
-                if (enemy.getPosition() - p).length() < minRadius:
-                    open = False
-                    break
-            if open:
+            if self._isSpawnPointOpen(team, entityGroup, p, minRadius):
                 return p
         return points[0].getPosition()
 
+    def _isSpawnPointOpen(self, team, entityGroup, pos, minRadius):
+        "Returns True if no Actor from another team is within minRadius of pos."
+        for actor, distance in entityGroup.getEntitiesInRadius(
+                pos, minRadius, entities.Actor):
+            if actor.getTeam() != team:
+                return False
+        return True
+
     def getRandomSpawnPoint(self, zombieSpawnsOnly=False, team=None):
         if zombieSpawnsOnly:
             spawns = self.spawnPoints[1:]
@@ -208,18 +676,8 @@ class World:
             spawns = self.spawnPoints[:]
         if team is not None and team.dock is not None:
             spawns.append(team.dock)
-        goodSpawns = []
-        enemies = [x for x in list(entityGroup.entities.values()) if isinstance(
-            x, entities.Actor) and x.getTeam() != team]
-        for point in spawns:
-            p = point.getPosition()
-            open = True
-            for enemy in enemies:
-                if (enemy.getPosition() - p).length() < minRadius:
-                    open = False
-                    break
-            if open:
-                goodSpawns.append(point)
+        goodSpawns = [x for x in spawns if self._isSpawnPointOpen(
+            team, entityGroup, x.getPosition(), minRadius)]
         if len(goodSpawns) == 0:
             return spawns[0].getPosition()
         else:
@@ -241,23 +699,7 @@ class World:
     def getCollisionQueue(self, position, direction, node=None):
         """Gets a CollisionHandlerQueue containing all collisions along the specified ray.
         Only checks for collisions with the specified NodePath, if one is given."""
-        cNode = CollisionNode("cnode")
-        nodepath = render.attachNewNode(cNode)
-        cNode.setIntoCollideMask(BitMask32(0))
-        cNode.setFromCollideMask(BitMask32(1))
-        ray = CollisionRay(position.getX(), position.getY(), position.getZ(
-        ), direction.getX(), direction.getY(), direction.getZ())
-        cNode.addSolid(ray)
-        queue = CollisionHandlerQueue()
-        self.traverser.addCollider(nodepath, queue)
-        if node is None:
-            self.traverser.traverse(engine.renderLit)
-        else:
-            self.traverser.traverse(node)
-        self.traverser.clearColliders()
-        nodepath.removeNode()
-        queue.sortEntries()
-        return queue
+        return self.hitscan.getQueue(position, direction, node)
 
     def getRayFirstCollision(self, rayNP, node=None):
         """Gets a CollisionEntry for the first collision along the specified ray.
@@ -271,11 +713,31 @@ class World:
     def getFirstCollision(self, position, direction, node=None):
         """Gets a CollisionEntry for the first collision along the specified ray.
         Only checks for collisions with the specified NodePath, if one is given."""
-        queue = self.getCollisionQueue(position, direction, node)
-        if queue.getNumEntries() > 0:
-            return queue.getEntry(0)
-        else:
+        return self.hitscan.castRay(position, direction, node=node)
+
+    def getStaticCollision(self, position, direction, maxDistance=None):
+        """Returns (point, normal) for the first hit along the ray against the static level geometry, or None.
+        Uses the StaticBVH if the map has one, otherwise Panda's collision system."""
+        if self.staticBVH is not None:
+            return self.staticBVH.getFirstHit(position, direction, maxDistance)
+        queue = self.getCollisionQueue(
+            position, direction, engine.renderEnvironment)
+        if queue.getNumEntries() == 0:
+            return None
+        entry = queue.getEntry(0)
+        point = entry.getSurfacePoint(render)
+        if maxDistance is not None and (point - position).length() > maxDistance:
             return None
+        return (point, entry.getSurfaceNormal(render))
+
+    def isOccluded(self, start, end):
+        "Returns True if static level geometry blocks the segment between the two points."
+        if self.staticBVH is not None:
+            return self.staticBVH.isOccluded(start, end)
+        vector = end - start
+        if vector.length() == 0:
+            return False
+        return self.getStaticCollision(start, vector, vector.length()) is not None
 
     def testCollisions(self, node, traversePath=None):
         if traversePath is None:
@@ -297,32 +759,129 @@ class World:
             dock.delete()
         del self.docks[:]
         if self.navMesh is not None:
+            engine.log.info("Path cache: " + self.navMesh.pathCache.getStats())
             self.navMesh.delete()
+        engine.log.info("Path scheduler: " + pathScheduler.getStats())
+        pathScheduler.clear()
+        pathScheduler.resetStats()
+        engine.log.info("Hitscan: " + self.hitscan.getStats())
+        self.hitscan.delete()
+        engine.log.info("Sweeps: " + self.sweeps.getStats())
+        engine.log.info("Physics: " + self.getPhysicsStats())
+        self.sweeps.clear()
+        del self.contactSubscriptions[:]
+        self.contactCategories = 0
+        self.contactReports.clear()
+        self.staticBVH = None
         self.world.destroy()
         self.space.destroy()
 
 
 navMeshCache = dict()
+navMeshCacheSize = 4  # Most nav meshes kept in navMeshCache
+pathCacheSize = 256  # Number of node-to-node searches a PathCache remembers
+noRoute = 0xFFFF  # Next hop for nodes with no route between them
+routesMagic = b"NAVR"
+routesVersion = 1
+routesHeader = struct.Struct("<4sHII")  # Magic, version, node count, edge count
+hierarchicalPaths = True  # Use a NavMeshHierarchy on meshes with at least four clusters
+clusterSize = 32  # Most NavNodes in a NavMeshHierarchy cluster
+
+
+class PathCache:
+    """A least recently used cache of the edges found between two nodes.
+    Agents build their own Path from the cached edges, so the waypoints are still fitted to their own start and end positions."""
+
+    def __init__(self, size=pathCacheSize):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _getKey(self, startNode, endNode, radius):
+        # Radii are bucketed to the nearest half unit.
+        return (startNode, endNode, int(round(radius * 2)))
+
+    def get(self, startNode, endNode, radius):
+        "Returns (found, edges). Edges is None if the cache knows there is no path."
+        key = self._getKey(startNode, endNode, radius)
+        if key not in self.entries:
+            self.misses += 1
+            return (False, None)
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return (True, self.entries[key])
+
+    def add(self, startNode, endNode, radius, edges):
+        key = self._getKey(startNode, endNode, radius)
+        self.entries[key] = edges
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def getStats(self):
+        total = self.hits + self.misses
+        hitRate = 100.0 * self.hits / total if total > 0 else 0
+        return "%d hits, %d misses (%.1f%% hit rate), %d of %d entries used" % (
+            self.hits, self.misses, hitRate, len(self.entries), self.size)
 
 
 class NavMesh:
+    # Vertices closer than this on every axis are welded together.
+    weldEpsilon = 0.1
+
     def __init__(self, directory, filename):
         global navMeshCache
         self.edges = []
         self.nodes = []
         self.filename = filename
+        self.buildTime = 0
+        # 2D grid over node bounds for point location
+        self.grid = dict()
+        self.gridCellSize = 1.0
+        self.arrays = None
+        self.pathCache = PathCache()
+        # All-pairs routing tables, indexed by startNode * len(nodes) + endNode.
+        # Loaded from a .routes file next to the nav mesh, if there is one.
+        self.routeNextHops = None
+        self.routeDistances = None
+        self.hierarchy = None  # NavMeshHierarchy for long paths on large meshes
+        # Spatial hashes used only while building the mesh
+        self._vertexIndex = dict()
+        self._vertices = []
+        self._edgeIndex = dict()
         if directory + "/" + self.filename in navMeshCache:
-            navMesh = navMeshCache[directory + "/" + self.filename]
+            # Move it to the back of the line for eviction
+            navMesh = navMeshCache.pop(directory + "/" + self.filename)
+            navMeshCache[directory + "/" + self.filename] = navMesh
             self.edges = navMesh.edges
             self.nodes = navMesh.nodes
+            self.grid = navMesh.grid
+            self.gridCellSize = navMesh.gridCellSize
+            self.arrays = navMesh.arrays
+            self.routeNextHops = navMesh.routeNextHops
+            self.routeDistances = navMesh.routeDistances
+            self.hierarchy = navMesh.hierarchy
+            self.buildTime = navMesh.buildTime
         else:
+            startTime = time.time()
             node = engine.loadModel(directory + "/" + self.filename)
             self._processNode(node)
             node.removeNode()
+            self.buildTime = time.time() - startTime
+            self.loadRoutes(self.getRoutesFilename(directory))
+            if hierarchicalPaths and len(self.nodes) >= clusterSize * 4:
+                self.hierarchy = NavMeshHierarchy(self)
+            while len(navMeshCache) >= navMeshCacheSize:
+                # Forget the least recently loaded map
+                del navMeshCache[next(iter(navMeshCache))]
             navMeshCache[directory + "/" + self.filename] = self
 
     def delete(self):
-        pass
+        self.pathCache.clear()
 
     def _processNode(self, node):
         geomNodeCollection = node.findAllMatches('**/+GeomNode')
@@ -335,6 +894,56 @@ class NavMesh:
                 # But we still need it for determining which node an agent is
                 # in.
                 edge.navigable = False
+        self._markWalls()
+        self._buildIndices()
+        self.arrays = NavMeshArrays(self)
+        self._vertexIndex.clear()
+        del self._vertices[:]
+        self._edgeIndex.clear()
+        self._buildGrid()
+
+    def _markWalls(self):
+        "Flags the edge ends that touch a wall, which are the only corners agents need to keep their distance from."
+        wallVertices = set()
+        for edge in self.edges:
+            if not edge.navigable:
+                wallVertices.add(self._weldVertex(edge.a))
+                wallVertices.add(self._weldVertex(edge.b))
+        for edge in self.edges:
+            edge.aOnWall = self._weldVertex(edge.a) in wallVertices
+            edge.bOnWall = self._weldVertex(edge.b) in wallVertices
+
+    def _buildIndices(self):
+        "Numbers the edges and nodes, so they can be referred to by index outside this process."
+        for i in range(len(self.edges)):
+            self.edges[i].index = i
+        for i in range(len(self.nodes)):
+            self.nodes[i].index = i
+
+    def _buildGrid(self):
+        """Buckets every node into the cells its XY bounds overlap.
+        Cells are sized to the average node, so a lookup only has a handful of nodes to test."""
+        self.grid = dict()
+        if len(self.nodes) == 0:
+            return
+        totalSize = 0
+        for node in self.nodes:
+            totalSize += max(node.maxX - node.minX, node.maxY - node.minY)
+        self.gridCellSize = max(totalSize / len(self.nodes), 1.0)
+        for node in self.nodes:
+            minX, minY = self._gridCell(node.minX, node.minY)
+            maxX, maxY = self._gridCell(node.maxX, node.maxY)
+            for x in range(minX, maxX + 1):
+                for y in range(minY, maxY + 1):
+                    self.grid.setdefault((x, y), []).append(node)
+
+    def _gridCell(self, x, y):
+        return (int(math.floor(x / self.gridCellSize)),
+                int(math.floor(y / self.gridCellSize)))
+
+    def _getContainingNodes(self, pos, radius):
+        cell = self._gridCell(pos.getX(), pos.getY())
+        return [x for x in self.grid.get(cell, ()) if x.containerTest(pos, radius)]
 
     def _processGeomNode(self, geomNode):
         for i in range(geomNode.getNumGeoms()):
@@ -373,19 +982,37 @@ class NavMesh:
                 self.nodes.append(NavNode(edge1, edge2, edge3))
 
     def addEdge(self, v1, v2):
-        edge = self._checkForEdge(v1, v2)
+        key = self._edgeKey(v1, v2)
+        edge = self._edgeIndex.get(key)
         if edge is None:
             edge = Edge(Vec3(v1), Vec3(v2))
             self.edges.append(edge)
+            self._edgeIndex[key] = edge
         return edge
 
-    def _checkForEdge(self, v1, v2):
-        epsilon = 0.1
-        for edge in self.edges:
-            if (edge.a.almostEqual(v1, epsilon) and edge.b.almostEqual(v2, epsilon)) or (
-                    edge.a.almostEqual(v2, epsilon) and edge.b.almostEqual(v1, epsilon)):
-                return edge
-        return None
+    def _edgeKey(self, v1, v2):
+        "Edges are keyed on their welded vertex indices, regardless of direction."
+        i1 = self._weldVertex(v1)
+        i2 = self._weldVertex(v2)
+        return (i1, i2) if i1 < i2 else (i2, i1)
+
+    def _weldVertex(self, v):
+        """Returns the index of the vertex within weldEpsilon of v, adding v if there isn't one.
+        Vertices are hashed into cells of weldEpsilon, so only the surrounding cells need checking."""
+        epsilon = self.weldEpsilon
+        cx = int(math.floor(v[0] / epsilon))
+        cy = int(math.floor(v[1] / epsilon))
+        cz = int(math.floor(v[2] / epsilon))
+        for x in range(cx - 1, cx + 2):
+            for y in range(cy - 1, cy + 2):
+                for z in range(cz - 1, cz + 2):
+                    for index in self._vertexIndex.get((x, y, z), ()):
+                        if self._vertices[index].almostEqual(v, epsilon):
+                            return index
+        index = len(self._vertices)
+        self._vertices.append(Vec3(v))
+        self._vertexIndex.setdefault((cx, cy, cz), []).append(index)
+        return index
 
     def getNode(self, pos, radius=1, lastKnownNode=None):
         if lastKnownNode is not None:
@@ -396,9 +1023,9 @@ class NavMesh:
                 nodes += [x for x in edge.getNodes() if x !=
                           lastKnownNode and x.containerTest(pos, radius)]
             if len(nodes) == 0:
-                nodes = [x for x in self.nodes if x.containerTest(pos, radius)]
+                nodes = self._getContainingNodes(pos, radius)
         else:
-            nodes = [x for x in self.nodes if x.containerTest(pos, radius)]
+            nodes = self._getContainingNodes(pos, radius)
         size = len(nodes)
         if size == 0:
             return None
@@ -425,68 +1052,484 @@ class NavMesh:
             startPos,
             endPos,
             radius=1):
-        # Clear pathfinding data
-        for edge in self.edges:
-            edge.closed = False
-            edge.cameFrom = None
-            edge.gScore = 0
-            edge.hScore = 0
-            edge.fScore = 0
-            edge.open = False
+        edges = self.findEdgesFromNodes(startNode, endNode, startPos, endPos)
+        if edges is None:
+            return None
+        return self.makePath(edges, startNode, endNode, startPos, endPos, radius)
+
+    def findEdgesFromNodes(self, startNode, endNode, startPos, endPos):
+        """Returns the edges from the goal back to the start, or None if there is no path.
+        Walks the routing tables if they're loaded, otherwise runs a hierarchical or flat A* search."""
+        if self.hasRoutes():
+            return self._walkRoute(startNode, endNode, startPos, endPos)
+        if self.hierarchy is not None:
+            return self.hierarchy.findEdges(startNode, endNode, startPos, endPos)
+        return self._searchEdges(startNode, endNode, startPos, endPos)
+
+    def _searchEdges(self, startNode, endNode, startPos, endPos):
+        "Flat A* search, run on the array-backed copy of the mesh."
+        edges = self.arrays.findPath(
+            startNode.index,
+            endNode.index,
+            (startPos.getX(), startPos.getY(), startPos.getZ()),
+            (endPos.getX(), endPos.getY(), endPos.getZ()))
+        if edges is None:
+            return None
+        return [self.edges[x] for x in edges]
+
+    def _walkRoute(self, startNode, endNode, startPos, endPos):
+        count = len(self.nodes)
+        if startNode is endNode:
+            # Same as A*: the cheapest edge from the start position to the end position.
+            return [min(startNode.edges, key=lambda x: x.cost(startPos) + x.cost(endPos))]
+        edges = []
+        node = startNode
+        while node is not endNode:
+            nextHop = self.routeNextHops[node.index * count + endNode.index]
+            if nextHop == noRoute:
+                return None
+            nextNode = self.nodes[nextHop]
+            edges.append(self._getSharedEdge(node, nextNode))
+            node = nextNode
+        edges.reverse()
+        return edges
+
+    def _getSharedEdge(self, node1, node2):
+        for edge in node1.edges:
+            if edge.navigable and node2 in edge.nodes:
+                return edge
+        return None
+
+    def hasRoutes(self):
+        return self.routeNextHops is not None
+
+    def getRouteDistance(self, startNode, endNode):
+        "Returns the length of the route between two nodes, or None if there are no tables or no route."
+        if not self.hasRoutes():
+            return None
+        distance = self.routeDistances[startNode.index *
+                                       len(self.nodes) + endNode.index]
+        return distance if distance >= 0 else None
+
+    def getRoutesFilename(self, directory):
+        return directory + "/" + self.filename + ".routes"
+
+    def buildRoutes(self):
+        """Runs a Dijkstra search from every node to fill in the routing tables.
+        Nodes are linked through their shared edges, at the cost of going from center to edge center to center."""
+        count = len(self.nodes)
+        if count >= noRoute:
+            raise ValueError("Too many nodes for routing tables: %d" % count)
+        links = []
+        for node in self.nodes:
+            nodeLinks = []
+            for edge in node.edges:
+                if not edge.navigable:
+                    continue
+                for neighbor in edge.nodes:
+                    if neighbor is not node:
+                        nodeLinks.append((neighbor.index, (node.center - edge.center).length() + (
+                            edge.center - neighbor.center).length()))
+            links.append(nodeLinks)
+        self.routeNextHops = array("H", [noRoute]) * (count * count)
+        self.routeDistances = array("f", [-1.0]) * (count * count)
+        for source in range(count):
+            row = source * count
+            distances = dict()
+            distances[source] = 0
+            firstHops = dict()
+            firstHops[source] = source
+            openNodes = [(0, source)]
+            done = set()
+            while len(openNodes) > 0:
+                distance, current = heappop(openNodes)
+                if current in done:
+                    continue
+                done.add(current)
+                self.routeNextHops[row + current] = firstHops[current]
+                self.routeDistances[row + current] = distance
+                for neighbor, cost in links[current]:
+                    if neighbor in done:
+                        continue
+                    if distance + cost < distances.get(neighbor, float("inf")):
+                        distances[neighbor] = distance + cost
+                        firstHops[neighbor] = neighbor if current == source else firstHops[current]
+                        heappush(openNodes, (distance + cost, neighbor))
+
+    def saveRoutes(self, filename):
+        routesFile = open(filename, "wb")
+        routesFile.write(routesHeader.pack(routesMagic, routesVersion, len(self.nodes), len(self.edges)))
+        nextHops = array("H", self.routeNextHops)
+        distances = array("f", self.routeDistances)
+        if sys.byteorder != "little":
+            nextHops.byteswap()
+            distances.byteswap()
+        nextHops.tofile(routesFile)
+        distances.tofile(routesFile)
+        routesFile.close()
+
+    def loadRoutes(self, filename):
+        """Loads the routing tables written by saveRoutes, if the file exists and matches this mesh.
+        Returns True if they were loaded."""
+        if not os.path.exists(filename):
+            return False
+        routesFile = open(filename, "rb")
+        header = routesFile.read(routesHeader.size)
+        if len(header) < routesHeader.size or routesHeader.unpack(header) != (
+                routesMagic, routesVersion, len(self.nodes), len(self.edges)):
+            routesFile.close()
+            engine.log.warning("Ignoring out of date routing tables: " + filename)
+            return False
+        count = len(self.nodes) * len(self.nodes)
+        nextHops = array("H")
+        distances = array("f")
+        try:
+            nextHops.fromfile(routesFile, count)
+            distances.fromfile(routesFile, count)
+        except EOFError:
+            engine.log.warning("Ignoring truncated routing tables: " + filename)
+            return False
+        finally:
+            routesFile.close()
+        if sys.byteorder != "little":
+            nextHops.byteswap()
+            distances.byteswap()
+        self.routeNextHops = nextHops
+        self.routeDistances = distances
+        return True
+
+    def makePath(self, edges, startNode, endNode, startPos, endPos, radius=1):
+        "Builds a Path from a list of edges, ordered from the goal back to the start."
         path = Path(startPos, endPos, startNode, endNode, radius)
-        openEdges = startNode.edges[:]
-        for edge in startNode.edges:
-            edge.gScore = 0
-            edge.hScore = edge.cost(endNode.center)
-            edge.fScore = edge.hScore
-            edge.open = True
-
-        def compare(x, y):
-            return (x.fScore > y.fScore) - (x.fScore < y.fScore)
-        iterations = 0
+        for edge in edges:
+            path.add(edge)
+        path.clean()
+        return path
+
+    def getArrays(self):
+        "Returns the NavMeshArrays copy of this mesh, which can be sent to path worker processes."
+        return self.arrays
+
+
+class NavMeshArrays:
+    """A compact, immutable struct-of-arrays copy of a NavMesh, referring to vertices, edges and nodes by index.
+    Flat searches run on it, and it holds no Panda3D objects, so it can also be sent to path worker processes."""
+
+    def __init__(self, navMesh):
+        self.vertices = array("f")  # x, y, z for each welded vertex
+        self.edgeVertices = array("i")  # Vertex indices a, b for each edge
+        self.edgeCenters = array("d")  # x, y, z for each edge
+        # Navigable neighbors of edge i are neighbors[neighborStart[i]:neighborStart[i + 1]],
+        # and neighborCosts holds the cost of each step. nodeEdges is laid out the same way.
+        self.neighborStart = array("i", [0])
+        self.neighbors = array("i")
+        self.neighborCosts = array("d")
+        self.nodeEdgeStart = array("i", [0])
+        self.nodeEdges = array("i")
+        vertexIndices = dict()  # Welded vertex index -> index in self.vertices
+        for edge in navMesh.edges:
+            for v in (edge.a, edge.b):
+                welded = navMesh._weldVertex(v)
+                if welded not in vertexIndices:
+                    vertexIndices[welded] = len(self.vertices) // 3
+                    self.vertices.extend((v.getX(), v.getY(), v.getZ()))
+                self.edgeVertices.append(vertexIndices[welded])
+            self.edgeCenters.extend(
+                (edge.center.getX(), edge.center.getY(), edge.center.getZ()))
+            for neighbor in edge.neighbors:
+                if neighbor.navigable:
+                    self.neighbors.append(neighbor.index)
+                    self.neighborCosts.append(edge.costToEdge(neighbor))
+            self.neighborStart.append(len(self.neighbors))
+        for node in navMesh.nodes:
+            self.nodeEdges.extend(x.index for x in node.edges)
+            self.nodeEdgeStart.append(len(self.nodeEdges))
+
+    def getSize(self):
+        "Returns the number of bytes held by the arrays."
+        return sum(len(x) * x.itemsize for x in (
+            self.vertices, self.edgeVertices, self.edgeCenters, self.neighborStart,
+            self.neighbors, self.neighborCosts, self.nodeEdgeStart, self.nodeEdges))
+
+    def _distance(self, edge, pos):
+        i = edge * 3
+        x = self.edgeCenters[i] - pos[0]
+        y = self.edgeCenters[i + 1] - pos[1]
+        z = self.edgeCenters[i + 2] - pos[2]
+        return math.sqrt(x * x + y * y + z * z)
+
+    def findPath(self, startNode, endNode, startPos, endPos):
+        """A* search over the edges, using a binary heap for the open set. Positions are (x, y, z) tuples.
+        Returns a list of edge indices from the goal back to the start, or None if there is no path."""
+        edgeCount = len(self.neighborStart) - 1
+        gScores = [float("inf")] * edgeCount
+        cameFrom = [-1] * edgeCount
+        closed = bytearray(edgeCount)
+        goalEdges = set(
+            self.nodeEdges[self.nodeEdgeStart[endNode]:self.nodeEdgeStart[endNode + 1]])
+        neighborStart = self.neighborStart
+        neighbors = self.neighbors
+        neighborCosts = self.neighborCosts
+        distance = self._distance
+        openEdges = []
+        # The counter breaks ties in the heap, the same as NavMesh used to.
+        counter = 0
+        goalEdge = -1
+        goalScore = float("inf")
+        for edge in self.nodeEdges[self.nodeEdgeStart[startNode]:self.nodeEdgeStart[startNode + 1]]:
+            gScores[edge] = distance(edge, startPos)
+            heappush(openEdges, (gScores[edge] +
+                                 distance(edge, endPos), counter, edge))
+            counter += 1
         while len(openEdges) > 0:
-            # TODO FIXME: this is broken in panda!
-            #openEdges.sort(compare)
-            currentEdge = openEdges.pop(0)
-            if endNode in currentEdge.nodes:
-                c = currentEdge
-                path.add(currentEdge)
-                while c.cameFrom is not None:
-                    c = c.cameFrom
-                    path.add(c)
-                path.clean()
-                return path
-            currentEdge.closed = True
+            fScore, _, currentEdge = heappop(openEdges)
+            if fScore >= goalScore:
+                # Nothing left in the open set can beat the best goal edge.
+                break
+            if closed[currentEdge]:
+                continue  # Stale heap entry
+            closed[currentEdge] = 1
+            gScore = gScores[currentEdge]
+            if currentEdge in goalEdges:
+                # The final leg runs straight from the edge to the end position.
+                score = gScore + distance(currentEdge, endPos)
+                if score < goalScore:
+                    goalScore = score
+                    goalEdge = currentEdge
+                continue
+            for i in range(neighborStart[currentEdge], neighborStart[currentEdge + 1]):
+                neighbor = neighbors[i]
+                if closed[neighbor]:
+                    continue
+                tentativeGScore = gScore + neighborCosts[i]
+                if tentativeGScore < gScores[neighbor]:
+                    cameFrom[neighbor] = currentEdge
+                    gScores[neighbor] = tentativeGScore
+                    heappush(openEdges, (tentativeGScore +
+                                         distance(neighbor, endPos), counter, neighbor))
+                    counter += 1
+        if goalEdge == -1:
+            return None
+        edges = [goalEdge]
+        while cameFrom[edges[-1]] != -1:
+            edges.append(cameFrom[edges[-1]])
+        return edges
+
+
+class NavCluster:
+    def __init__(self, index):
+        self.index = index
+        self.nodes = []
+        self.edges = set()  # Every edge of every node in the cluster
+        self.portals = []  # One navigable edge for each entrance to another cluster
+        self.neighbors = set()  # Clusters this one has an entrance to
+
+
+class NavMeshHierarchy:
+    """A two level graph for HPA* searches. Adjacent NavNodes are grouped into clusters,
+    and the abstract graph links the portal edges of each cluster with the shortest path between them.
+    A search runs over the portals, then stitches together the paths stored in each cluster it crosses."""
+
+    def __init__(self, navMesh):
+        self.navMesh = navMesh
+        self.clusters = []
+        self.nodeClusters = dict()  # NavNode -> NavCluster
+        # Portal edge -> list of (portal, cost, edges from the first portal to the second, excluding the first)
+        self.links = dict()
+        self._buildClusters()
+        self._buildLinks()
+
+    def _buildClusters(self):
+        "Grows each cluster breadth first from the first unclustered node, until it's full."
+        for seed in self.navMesh.nodes:
+            if seed in self.nodeClusters:
+                continue
+            cluster = NavCluster(len(self.clusters))
+            self.clusters.append(cluster)
+            queue = [seed]
+            self.nodeClusters[seed] = cluster
+            while len(queue) > 0 and len(cluster.nodes) < clusterSize:
+                node = queue.pop(0)
+                cluster.nodes.append(node)
+                for edge in node.edges:
+                    if not edge.navigable:
+                        continue
+                    for neighbor in edge.nodes:
+                        if neighbor not in self.nodeClusters:
+                            self.nodeClusters[neighbor] = cluster
+                            queue.append(neighbor)
+            for node in queue:
+                # These didn't fit, so they'll seed clusters of their own.
+                del self.nodeClusters[node]
+            for node in cluster.nodes:
+                cluster.edges.update(node.edges)
+        # Boundary edges between the same clusters are grouped into entrances.
+        entrances = dict()  # Sorted tuple of cluster indices -> boundary edges
+        for edge in self.navMesh.edges:
+            if not edge.navigable:
+                continue
+            clusters = set(self.nodeClusters[x] for x in edge.nodes)
+            if len(clusters) > 1:
+                key = tuple(sorted(x.index for x in clusters))
+                entrances.setdefault(key, []).append(edge)
+        for key, edges in entrances.items():
+            for run in self._getConnectedRuns(edges):
+                # Only the edge in the middle of each run becomes a portal,
+                # which keeps the abstract graph small.
+                center = Vec3()
+                for edge in run:
+                    center += edge.center
+                center /= len(run)
+                portal = min(run, key=lambda x: x.cost(center))
+                for index in key:
+                    self.clusters[index].portals.append(portal)
+                    self.clusters[index].neighbors.update(
+                        self.clusters[x] for x in key if x != index)
+
+    def _getConnectedRuns(self, edges):
+        "Splits boundary edges into runs of edges that share a vertex."
+        runs = []
+        remaining = list(edges)
+        while len(remaining) > 0:
+            run = [remaining.pop(0)]
+            i = 0
+            while i < len(run):
+                edge = run[i]
+                for other in remaining[:]:
+                    if any(x.almostEqual(y, NavMesh.weldEpsilon) for x in (edge.a, edge.b) for y in (other.a, other.b)):
+                        run.append(other)
+                        remaining.remove(other)
+                i += 1
+            runs.append(run)
+        return runs
+
+    def _buildLinks(self):
+        for cluster in self.clusters:
+            for portal in cluster.portals:
+                gScores, cameFrom = self._searchCluster(cluster, [(portal, 0)])
+                links = self.links.setdefault(portal, [])
+                for other in cluster.portals:
+                    if other is portal or other not in gScores:
+                        continue
+                    edges = [other]
+                    while cameFrom[edges[-1]] is not portal:
+                        edges.append(cameFrom[edges[-1]])
+                    edges.reverse()
+                    links.append((other, gScores[other], edges))
+
+    def _searchCluster(self, cluster, sources):
+        """Dijkstra search over the edges of a cluster, from a list of (edge, starting cost).
+        Returns the gScore and cameFrom dictionaries, keyed by edge."""
+        gScores = dict()
+        cameFrom = dict()
+        closed = set()
+        openEdges = []
+        counter = 0
+        for edge, cost in sources:
+            if cost < gScores.get(edge, float("inf")):
+                gScores[edge] = cost
+                cameFrom[edge] = None
+                heappush(openEdges, (cost, counter, edge))
+                counter += 1
+        while len(openEdges) > 0:
+            gScore, _, currentEdge = heappop(openEdges)
+            if currentEdge in closed:
+                continue
+            closed.add(currentEdge)
             for neighbor in currentEdge.neighbors:
-                if neighbor.navigable and not neighbor.closed:
-                    tentativeGScore = currentEdge.gScore + \
-                        currentEdge.costToEdge(neighbor)
-                    tentativeIsBetter = False
-                    if not neighbor.open:
-                        neighbor.open = True
-                        openEdges.append(neighbor)
-                        neighbor.hScore = neighbor.cost(endNode.center)
-                        tentativeIsBetter = True
-                    elif tentativeGScore < neighbor.gScore:
-                        tentativeIsBetter = True
-                    if tentativeIsBetter:
-                        neighbor.cameFrom = currentEdge
-                        neighbor.gScore = tentativeGScore
-                        neighbor.fScore = neighbor.gScore + neighbor.hScore
-            iterations += 1
-            if iterations > 9:
-                time.sleep(0.0)
-                iterations = 0
-        return None
+                if not neighbor.navigable or neighbor in closed or neighbor not in cluster.edges:
+                    continue
+                tentativeGScore = gScore + currentEdge.costToEdge(neighbor)
+                if tentativeGScore < gScores.get(neighbor, float("inf")):
+                    gScores[neighbor] = tentativeGScore
+                    cameFrom[neighbor] = currentEdge
+                    heappush(openEdges, (tentativeGScore, counter, neighbor))
+                    counter += 1
+        return gScores, cameFrom
+
+    def findEdges(self, startNode, endNode, startPos, endPos):
+        """Same interface as NavMesh.findEdgesFromNodes.
+        Short searches, within a cluster or into a neighboring one, fall back to a flat search,
+        since a detour through the portals would cost more than it saves."""
+        startCluster = self.nodeClusters[startNode]
+        endCluster = self.nodeClusters[endNode]
+        if startCluster is endCluster or endCluster in startCluster.neighbors:
+            return self.navMesh._searchEdges(startNode, endNode, startPos, endPos)
+        # Costs from the start position to the portals of the start cluster,
+        # and from the portals of the end cluster to the end position.
+        startScores, startCameFrom = self._searchCluster(
+            startCluster, [(x, x.cost(startPos)) for x in startNode.edges])
+        endScores, endCameFrom = self._searchCluster(
+            endCluster, [(x, x.cost(endPos)) for x in endNode.edges])
+        gScores = dict()
+        cameFrom = dict()  # Portal -> (previous portal, link edges)
+        closed = set()
+        openPortals = []
+        counter = 0
+        goalPortal = None
+        goalScore = float("inf")
+        for portal in startCluster.portals:
+            if portal in startScores:
+                gScores[portal] = startScores[portal]
+                cameFrom[portal] = None
+                heappush(openPortals, (gScores[portal] +
+                                       portal.cost(endPos), counter, portal))
+                counter += 1
+        while len(openPortals) > 0:
+            fScore, _, portal = heappop(openPortals)
+            if fScore >= goalScore:
+                break
+            if portal in closed:
+                continue
+            closed.add(portal)
+            if portal in endScores:
+                score = gScores[portal] + endScores[portal]
+                if score < goalScore:
+                    goalScore = score
+                    goalPortal = portal
+            for other, cost, edges in self.links.get(portal, ()):
+                if other in closed:
+                    continue
+                tentativeGScore = gScores[portal] + cost
+                if tentativeGScore < gScores.get(other, float("inf")):
+                    gScores[other] = tentativeGScore
+                    cameFrom[other] = (portal, edges)
+                    heappush(openPortals, (tentativeGScore +
+                                           other.cost(endPos), counter, other))
+                    counter += 1
+        if goalPortal is None:
+            return None
+        # Goal back to start: the end cluster leg, the stored links, then the start cluster leg.
+        edges = []
+        edge = endCameFrom[goalPortal]
+        while edge is not None:
+            edges.append(edge)
+            edge = endCameFrom[edge]
+        edges.reverse()
+        portal = goalPortal
+        while cameFrom[portal] is not None:
+            previous, linkEdges = cameFrom[portal]
+            edges.extend(reversed(linkEdges))
+            portal = previous
+        edge = portal
+        while edge is not None:
+            edges.append(edge)
+            edge = startCameFrom[edge]
+        return edges
 
 
 class NavNode:
+    __slots__ = ("highest", "lowest", "edges", "halfPlanes", "center",
+                 "index", "minX", "maxX", "minY", "maxY")
+
     def __init__(self, edge1, edge2, edge3):
         self.highest = -10000
         self.lowest = 10000
         self.edges = []
-        self.edgeNormals = []  # For containerTest
+        edgeNormals = []
+        self.halfPlanes = []  # (x, y, offset) for each edge. For containerTest
         self.center = Vec3()
+        self.index = 0  # Position in NavMesh.nodes
         for e in [edge1, edge2, edge3]:
             self._addEdge(e)
         for edge in self.edges:
@@ -505,18 +1548,29 @@ class NavNode:
             normal = parallel.cross(up)
             reverseNormal = normal * -1
             if toCenter.dot(normal) < 0:
-                self.edgeNormals.append(normal)
+                edgeNormals.append(normal)
             else:
-                self.edgeNormals.append(reverseNormal)
+                edgeNormals.append(reverseNormal)
+        for i in range(len(self.edges)):
+            normal = edgeNormals[i]
+            center = self.edges[i].center
+            self.halfPlanes.append((normal.getX(), normal.getY(), normal.dot(
+                Vec3(center.getX(), center.getY(), 0))))
+        xs = [v.getX() for e in self.edges for v in (e.a, e.b)]
+        ys = [v.getY() for e in self.edges for v in (e.a, e.b)]
+        self.minX = min(xs)
+        self.maxX = max(xs)
+        self.minY = min(ys)
+        self.maxY = max(ys)
 
     def containerTest(self, p, radius=1):
-        p2 = Vec3(p.getX(), p.getY(), 0)
-        if p.getZ() > self.highest + radius + 1 or p.getZ() < self.lowest - radius - 1:
+        z = p.getZ()
+        if z > self.highest + radius + 1 or z < self.lowest - radius - 1:
             return False
-        for i in range(len(self.edgeNormals)):
-            vector = p2 - self.edges[i].flatCenter
-            vector.normalize()
-            if vector.dot(self.edgeNormals[i]) < 0:
+        x = p.getX()
+        y = p.getY()
+        for nx, ny, offset in self.halfPlanes:
+            if x * nx + y * ny < offset:
                 return False
         # To do: vertical test
         return True
@@ -539,22 +1593,22 @@ class NavNode:
 
 
 class Edge:
+    __slots__ = ("a", "b", "aToBVector", "length", "aOnWall", "bOnWall", "center",
+                 "neighbors", "nodes", "index", "navigable")
+
     def __init__(self, v1, v2):
         self.a = v1
         self.b = v2
         self.aToBVector = self.b - self.a
+        self.length = self.aToBVector.length()
         self.aToBVector.normalize()
+        # Set by NavMesh once all the edges are known
+        self.aOnWall = True
+        self.bOnWall = True
         self.center = (self.a + self.b) / 2
-        self.flatCenter = Vec3(self.center.getX(), self.center.getY(), 0)
         self.neighbors = []
         self.nodes = []
-        # Temporary pathfinding data
-        self.closed = False
-        self.open = False
-        self.cameFrom = None
-        self.gScore = 0
-        self.hScore = 0
-        self.fScore = 0
+        self.index = 0  # Position in NavMesh.edges
         self.navigable = True
 
     def intersects(self, c, d, radius=0):
@@ -570,20 +1624,15 @@ class Edge:
             self.nodes.append(node)
 
     def cost(self, pos):
-        # The cost is the distance from given point to the closer of our two
-        # corners.
-        dist1 = (self.a - pos).length()
-        dist2 = (self.b - pos).length()
-        return min(dist1, dist2)
+        # The cost is the straight-line distance from our center to the given
+        # point. It never overestimates, so it's an admissible A* heuristic.
+        return (self.center - pos).length()
 
     def costToEdge(self, edge):
-        # The cost is the distance between the two closest corners of the two
-        # edges.
-        dist1 = (self.a - edge.a).length()
-        dist2 = (self.b - edge.b).length()
-        dist3 = (self.a - edge.b).length()
-        dist4 = (self.b - edge.a).length()
-        return min(dist1, dist2, dist3, dist4)
+        # The cost is the distance between the centers of the two edges.
+        # Edges of the same triangle always share a corner, so corner
+        # distances would make every step free.
+        return (self.center - edge.center).length()
 
     def getNodes(self):
         return self.nodes
@@ -596,6 +1645,16 @@ class Edge:
         return self.neighbors
 
 
+def _triangleArea(a, b, c):
+    "Twice the signed area of the triangle abc on the XY plane. Positive if c is left of the line from a to b."
+    return (b.getX() - a.getX()) * (c.getY() - a.getY()) - \
+        (b.getY() - a.getY()) * (c.getX() - a.getX())
+
+
+def _samePoint(a, b):
+    return abs(a.getX() - b.getX()) < 0.001 and abs(a.getY() - b.getY()) < 0.001
+
+
 class Path:
     def __init__(
             self,
@@ -618,13 +1677,65 @@ class Path:
             self.end = Vec3(end)
 
     def clean(self):
-        i = len(self.waypoints) - 2
-        while i > 0:
-            if self.edges[i].intersects(
-                    self.waypoints[i - 1], self.waypoints[i + 1], self.radius):
-                del self.waypoints[i]
-                del self.edges[i]
-            i -= 1
+        """Replaces the waypoints with the shortest route through the edges, using the simple stupid funnel algorithm.
+        Corners on walls are pulled in by the radius, so agents don't clip them. The last waypoint is the end position."""
+        if self.start is None or len(self.edges) == 0:
+            return
+        portals = [(self.start, self.start)]
+        previous = self.start
+        for edge in self.edges:
+            a = edge.a
+            b = edge.b
+            if edge.aOnWall:
+                a = a + (edge.aToBVector * min(self.radius, edge.length / 2))
+            if edge.bOnWall:
+                b = b - (edge.aToBVector * min(self.radius, edge.length / 2))
+            if _triangleArea(previous, edge.center, a) > 0:
+                portals.append((a, b))
+            else:
+                portals.append((b, a))
+            previous = edge.center
+        portals.append((self.end, self.end))
+
+        waypoints = []
+        apex = portalLeft = portalRight = self.start
+        apexIndex = leftIndex = rightIndex = 0
+        i = 1
+        while i < len(portals):
+            left, right = portals[i]
+            # Narrow the funnel from the right, unless that crosses the left side.
+            if _triangleArea(apex, portalRight, right) >= 0:
+                if _samePoint(apex, portalRight) or _triangleArea(
+                        apex, portalLeft, right) < 0:
+                    portalRight = right
+                    rightIndex = i
+                else:
+                    # The left side becomes a corner of the path.
+                    waypoints.append(portalLeft)
+                    apex = portalLeft
+                    apexIndex = leftIndex
+                    portalLeft = portalRight = apex
+                    leftIndex = rightIndex = apexIndex
+                    i = apexIndex + 1
+                    continue
+            # Narrow the funnel from the left, unless that crosses the right side.
+            if _triangleArea(apex, portalLeft, left) <= 0:
+                if _samePoint(apex, portalLeft) or _triangleArea(
+                        apex, portalRight, left) > 0:
+                    portalLeft = left
+                    leftIndex = i
+                else:
+                    waypoints.append(portalRight)
+                    apex = portalRight
+                    apexIndex = rightIndex
+                    portalLeft = portalRight = apex
+                    leftIndex = rightIndex = apexIndex
+                    i = apexIndex + 1
+                    continue
+            i += 1
+        if len(waypoints) == 0 or not _samePoint(waypoints[-1], self.end):
+            waypoints.append(self.end)
+        self.waypoints = [Vec3(x) for x in waypoints]
 
     def add(self, edge):
         self.edges.insert(0, edge)
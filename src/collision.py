@@ -0,0 +1,507 @@
+import hashlib
+import os
+import time
+import zipfile
+
+from panda3d.core import *
+from panda3d.egg import *
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+bvhVersion = 1
+bvhLeafSize = 8  # Most triangles in a StaticBVH leaf
+proxyCellSize = 0.5  # Size of the grid cells vertices are merged into when decimating collision proxies
+
+
+def isAvailable():
+    "StaticBVH needs NumPy. Without it, static ray queries go through Panda's collision system."
+    return numpy is not None
+
+
+def getTriangles(nodePath, relativeTo):
+    "Returns an (n, 3, 3) array with the corners of every triangle under the NodePath, in the coordinate space of relativeTo."
+    triangles = []
+    for geomNodePath in nodePath.findAllMatches("**/+GeomNode"):
+        mat = geomNodePath.getMat(relativeTo)
+        transform = numpy.array([[mat.getCell(row, column) for column in range(3)]
+                                 for row in range(4)])
+        geomNode = geomNodePath.node()
+        for i in range(geomNode.getNumGeoms()):
+            geom = geomNode.getGeom(i).decompose()
+            reader = GeomVertexReader(geom.getVertexData(), "vertex")
+            vertices = []
+            while not reader.isAtEnd():
+                v = reader.getData3()
+                vertices.append((v.getX(), v.getY(), v.getZ()))
+            if len(vertices) == 0:
+                continue
+            # Panda uses row vectors, so points are transformed by p * M.
+            vertices = numpy.array(vertices).dot(
+                transform[:3]) + transform[3]
+            indices = []
+            for j in range(geom.getNumPrimitives()):
+                primitive = geom.getPrimitive(j)
+                if not isinstance(primitive, GeomTriangles):
+                    continue
+                for k in range(primitive.getNumVertices()):
+                    indices.append(primitive.getVertex(k))
+            if len(indices) > 0:
+                triangles.append(vertices[numpy.array(indices)].reshape(-1, 3, 3))
+    if len(triangles) == 0:
+        return numpy.zeros((0, 3, 3))
+    return numpy.concatenate(triangles)
+
+
+def getProxyFilename(filename):
+    "Collision proxies are saved next to the model they simplify."
+    return filename + "-proxy"
+
+
+def decimateTriangles(triangles, cellSize=None):
+    """Simplifies a triangle soup by vertex clustering. Vertices in the same grid cell are merged into their average,
+    and triangles that collapse or repeat are dropped. Faces keep their winding, so they still face the same way."""
+    if cellSize is None:
+        cellSize = proxyCellSize
+    triangles = numpy.asarray(triangles, dtype=numpy.float64).reshape(-1, 3, 3)
+    if len(triangles) == 0:
+        return triangles
+    vertices = triangles.reshape(-1, 3)
+    cells = numpy.floor(vertices / cellSize).astype(numpy.int64)
+    (cells, clusters) = numpy.unique(cells, axis=0, return_inverse=True)
+    clusters = clusters.reshape(-1)
+    counts = numpy.bincount(clusters, minlength=len(cells)).astype(numpy.float64)
+    merged = numpy.zeros((len(cells), 3))
+    for axis in range(3):
+        merged[:, axis] = numpy.bincount(
+            clusters, weights=vertices[:, axis], minlength=len(cells)) / counts
+    indices = clusters.reshape(-1, 3)
+    keep = (indices[:, 0] != indices[:, 1]) & (indices[:, 1] != indices[:, 2]) & (
+        indices[:, 0] != indices[:, 2])
+    indices = indices[keep]
+    # Triangles with the same corners in a different order are duplicates. Opposite faces are kept.
+    rolled = numpy.argmin(indices, axis=1)
+    canonical = indices[numpy.arange(len(indices))[:, None],
+                        (rolled[:, None] + numpy.arange(3)) % 3]
+    (canonical, first) = numpy.unique(canonical, axis=0, return_index=True)
+    indices = indices[numpy.sort(first)]
+    return merged[indices]
+
+
+def writeEgg(triangles, filename):
+    "Writes the triangles to an egg file as a single polygon group with shared vertices."
+    data = EggData()
+    data.setCoordinateSystem(CS_zup_right)
+    pool = EggVertexPool("proxy")
+    data.addChild(pool)
+    group = EggGroup("proxy")
+    data.addChild(group)
+    vertices = dict()
+    for triangle in triangles:
+        polygon = EggPolygon()
+        for corner in triangle:
+            key = tuple(corner)
+            if key not in vertices:
+                vertex = EggVertex()
+                vertex.setPos(Point3D(key[0], key[1], key[2]))
+                vertices[key] = pool.addVertex(vertex)
+            polygon.addVertex(vertices[key])
+        group.addChild(polygon)
+    data.writeEgg(Filename.fromOsSpecific(filename))
+
+
+class StaticBVH:
+    """A bounding volume hierarchy over the triangles of the static level geometry.
+    Rays are tested in batches. Each step of the traversal tests every (ray, node) pair at once with NumPy,
+    and leaves are tested with a vectorized Moller-Trumbore intersection.
+    Like Panda's collision polygons, triangles are one-sided: rays only hit them from the front."""
+
+    def __init__(self):
+        self.key = None
+        self.buildTime = 0.0
+        self.numTriangles = 0
+
+    @staticmethod
+    def getKey(triangles):
+        "Identifies a set of triangles, so a cached BVH is rebuilt when the level geometry changes."
+        digest = hashlib.sha1(numpy.ascontiguousarray(
+            triangles, dtype=numpy.float32).tobytes())
+        digest.update(("%d %d" % (bvhVersion, bvhLeafSize)).encode())
+        return digest.hexdigest()
+
+    def build(self, triangles):
+        start = time.time()
+        triangles = numpy.asarray(triangles, dtype=numpy.float64)
+        self.key = StaticBVH.getKey(triangles)
+        self.numTriangles = len(triangles)
+        count = len(triangles)
+        order = numpy.arange(count)
+        centroids = triangles.mean(axis=1)
+        triangleMins = triangles.min(axis=1)
+        triangleMaxs = triangles.max(axis=1)
+        nodeMins = []
+        nodeMaxs = []
+        nodeChildren = []  # Index of the first child. Children are allocated in pairs.
+        nodeStarts = []
+        nodeCounts = []  # Triangles in a leaf, or 0 for inner nodes
+
+        def addNode():
+            nodeMins.append(None)
+            nodeMaxs.append(None)
+            nodeChildren.append(-1)
+            nodeStarts.append(0)
+            nodeCounts.append(0)
+            return len(nodeMins) - 1
+
+        stack = [(addNode(), 0, count)]
+        while len(stack) > 0:
+            (index, first, last) = stack.pop()
+            items = order[first:last]
+            if len(items) > 0:
+                nodeMins[index] = triangleMins[items].min(axis=0)
+                nodeMaxs[index] = triangleMaxs[items].max(axis=0)
+            else:
+                nodeMins[index] = numpy.zeros(3)
+                nodeMaxs[index] = numpy.zeros(3)
+            points = centroids[items]
+            extent = points.max(
+                axis=0) - points.min(axis=0) if len(items) > 0 else numpy.zeros(3)
+            axis = int(extent.argmax())
+            if len(items) <= bvhLeafSize or extent[axis] <= 0:
+                nodeStarts[index] = first
+                nodeCounts[index] = len(items)
+                continue
+            # Median split along the longest axis of the centroid bounds
+            middle = len(items) // 2
+            split = numpy.argpartition(points[:, axis], middle)
+            order[first:last] = items[split]
+            left = addNode()
+            right = addNode()
+            nodeChildren[index] = left
+            stack.append((left, first, first + middle))
+            stack.append((right, first + middle, last))
+
+        triangles = triangles[order]
+        self.vertices = triangles[:, 0]
+        self.edges1 = triangles[:, 1] - triangles[:, 0]
+        self.edges2 = triangles[:, 2] - triangles[:, 0]
+        normals = numpy.cross(self.edges1, self.edges2)
+        lengths = numpy.sqrt((normals * normals).sum(axis=1))
+        lengths[lengths == 0] = 1
+        self.normals = normals / lengths[:, None]
+        self.nodeMins = numpy.array(nodeMins).reshape(-1, 3)
+        self.nodeMaxs = numpy.array(nodeMaxs).reshape(-1, 3)
+        self.nodeChildren = numpy.array(nodeChildren, dtype=numpy.int32)
+        self.nodeStarts = numpy.array(nodeStarts, dtype=numpy.int32)
+        self.nodeCounts = numpy.array(nodeCounts, dtype=numpy.int32)
+        self.buildTime = time.time() - start
+
+    def save(self, filename):
+        "Writes the cache to a temporary file first, so a crash part way through can't leave a broken cache behind."
+        tempFilename = filename + ".tmp"
+        try:
+            with open(tempFilename, "wb") as f:
+                numpy.savez(f, key=numpy.array(self.key), vertices=self.vertices, edges1=self.edges1, edges2=self.edges2,
+                            normals=self.normals, nodeMins=self.nodeMins, nodeMaxs=self.nodeMaxs,
+                            nodeChildren=self.nodeChildren, nodeStarts=self.nodeStarts, nodeCounts=self.nodeCounts)
+            os.replace(tempFilename, filename)
+        finally:
+            if os.path.exists(tempFilename):
+                os.remove(tempFilename)
+
+    def load(self, filename, key):
+        "Loads a cached BVH. Returns False if there isn't one, it's damaged, or it was built from different triangles."
+        if not os.path.exists(filename):
+            return False
+        try:
+            with numpy.load(filename) as data:
+                if str(data["key"]) != key:
+                    return False
+                self.vertices = data["vertices"]
+                self.edges1 = data["edges1"]
+                self.edges2 = data["edges2"]
+                self.normals = data["normals"]
+                self.nodeMins = data["nodeMins"]
+                self.nodeMaxs = data["nodeMaxs"]
+                self.nodeChildren = data["nodeChildren"]
+                self.nodeStarts = data["nodeStarts"]
+                self.nodeCounts = data["nodeCounts"]
+        except (IOError, KeyError, ValueError, EOFError, zipfile.BadZipFile):
+            return False  # Truncated or empty files get here, and are rebuilt
+        self.key = key
+        self.numTriangles = len(self.vertices)
+        return True
+
+    def getNumNodes(self):
+        return len(self.nodeCounts)
+
+    def castRays(self, origins, directions, maxDistances=None, radii=None):
+        """Returns (distances, triangles): the distance along each ray to the first triangle it hits, and the index of that triangle.
+        Rays that hit nothing within their maximum distance get an infinite distance and a triangle index of -1.
+        If radii are given, each ray sweeps a sphere of that radius, and the distance is where the sphere first touches a triangle's face.
+        Sphere hits on edges and corners are only caught once the center of the sphere crosses them."""
+        origins = numpy.asarray(origins, dtype=numpy.float64).reshape(-1, 3)
+        directions = numpy.asarray(
+            directions, dtype=numpy.float64).reshape(-1, 3)
+        lengths = numpy.sqrt((directions * directions).sum(axis=1))
+        lengths[lengths == 0] = 1
+        directions = directions / lengths[:, None]
+        count = len(origins)
+        if maxDistances is None:
+            distances = numpy.full(count, numpy.inf)
+        else:
+            distances = numpy.array(
+                numpy.broadcast_to(maxDistances, (count,)), dtype=numpy.float64)
+        hits = numpy.full(count, -1, dtype=numpy.int64)
+        if radii is not None:
+            radii = numpy.array(numpy.broadcast_to(
+                radii, (count,)), dtype=numpy.float64)
+        if count == 0 or self.getNumNodes() == 0 or self.numTriangles == 0:
+            return (numpy.full(count, numpy.inf), hits)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            inverses = 1.0 / directions
+            rays = numpy.arange(count)
+            nodes = numpy.zeros(count, dtype=numpy.int32)
+            while len(rays) > 0:
+                # Slab test against every (ray, node) pair. fmin and fmax skip the NaNs from axis-parallel rays.
+                rayOrigins = origins[rays]
+                rayInverses = inverses[rays]
+                mins = self.nodeMins[nodes]
+                maxs = self.nodeMaxs[nodes]
+                if radii is not None:
+                    mins = mins - radii[rays][:, None]
+                    maxs = maxs + radii[rays][:, None]
+                t1 = (mins - rayOrigins) * rayInverses
+                t2 = (maxs - rayOrigins) * rayInverses
+                near = numpy.fmax.reduce(numpy.fmin(t1, t2), axis=1)
+                far = numpy.fmin.reduce(numpy.fmax(t1, t2), axis=1)
+                keep = (near <= far) & (far >= 0) & (near <= distances[rays])
+                rays = rays[keep]
+                nodes = nodes[keep]
+                leaves = self.nodeCounts[nodes] > 0
+                if leaves.any():
+                    self._intersectLeaves(
+                        rays[leaves], nodes[leaves], origins, directions, distances, hits)
+                    if radii is not None:
+                        self._intersectLeaves(
+                            rays[leaves], nodes[leaves], origins, directions, distances, hits, radii)
+                inner = ~leaves
+                children = self.nodeChildren[nodes[inner]]
+                rays = numpy.concatenate((rays[inner], rays[inner]))
+                nodes = numpy.concatenate((children, children + 1))
+        distances[hits < 0] = numpy.inf
+        return (distances, hits)
+
+    def _intersectLeaves(self, rays, nodes, origins, directions, distances, hits, radii=None):
+        """Tests every triangle in the given leaves against the paired ray, keeping the nearest hit of each ray.
+        With radii, the triangles are pushed out along their normals by the radius of each ray's sphere."""
+        counts = self.nodeCounts[nodes]
+        offsets = numpy.arange(counts.sum()) - \
+            numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        triangles = numpy.repeat(self.nodeStarts[nodes], counts) + offsets
+        rays = numpy.repeat(rays, counts)
+        d = directions[rays]
+        edges1 = self.edges1[triangles]
+        edges2 = self.edges2[triangles]
+        p = numpy.cross(d, edges2)
+        determinants = (edges1 * p).sum(axis=1)
+        # A positive determinant means the ray faces the front of the triangle.
+        front = determinants > 1e-9
+        rays = rays[front]
+        triangles = triangles[front]
+        d = d[front]
+        edges1 = edges1[front]
+        edges2 = edges2[front]
+        p = p[front]
+        inverses = 1.0 / determinants[front]
+        s = origins[rays] - self.vertices[triangles]
+        if radii is not None:
+            s -= self.normals[triangles] * radii[rays][:, None]
+        u = (s * p).sum(axis=1) * inverses
+        q = numpy.cross(s, edges1)
+        v = (d * q).sum(axis=1) * inverses
+        t = (edges2 * q).sum(axis=1) * inverses
+        valid = (u >= 0) & (v >= 0) & (u + v <= 1) & (
+            t >= 0) & (t <= distances[rays])
+        if not valid.any():
+            return
+        rays = rays[valid]
+        triangles = triangles[valid]
+        t = t[valid]
+        numpy.minimum.at(distances, rays, t)
+        nearest = t == distances[rays]
+        hits[rays[nearest]] = triangles[nearest]
+
+    def getFirstHit(self, origin, direction, maxDistance=None):
+        "Returns (point, normal) for the first triangle along the ray, as Panda vectors, or None if it hits nothing."
+        (distances, hits) = self.castRays(
+            [tuple(origin)], [tuple(direction)], maxDistance)
+        if hits[0] < 0:
+            return None
+        d = Vec3(direction)
+        d.normalize()
+        normal = self.normals[hits[0]]
+        return (Point3(origin + d * float(distances[0])), Vec3(normal[0], normal[1], normal[2]))
+
+    def getOccluded(self, starts, ends):
+        "Returns a boolean array that is True for each segment blocked by static geometry."
+        starts = numpy.asarray(starts, dtype=numpy.float64).reshape(-1, 3)
+        ends = numpy.asarray(ends, dtype=numpy.float64).reshape(-1, 3)
+        vectors = ends - starts
+        lengths = numpy.sqrt((vectors * vectors).sum(axis=1))
+        (distances, hits) = self.castRays(starts, vectors, lengths)
+        return hits >= 0
+
+    def isOccluded(self, start, end):
+        return bool(self.getOccluded([tuple(start)], [tuple(end)])[0])
+
+
+def loadStaticBVH(nodePaths, filename):
+    """Returns a StaticBVH of the triangles under the given NodePaths, loading it from the cache file if it's up to date.
+    Returns None if NumPy isn't installed."""
+    if not isAvailable():
+        return None
+    triangles = [getTriangles(nodePath, render) for nodePath in nodePaths]
+    triangles = numpy.concatenate(
+        triangles) if len(triangles) > 0 else numpy.zeros((0, 3, 3))
+    bvh = StaticBVH()
+    if not bvh.load(filename, StaticBVH.getKey(triangles)):
+        bvh.build(triangles)
+        try:
+            bvh.save(filename)
+        except IOError:
+            pass  # The map directory may be read-only. We'll just rebuild next time.
+    return bvh
+
+
+sweepSkin = 0.05  # Bodies within this distance of a surface at the end of a move report contact
+
+
+class SweptBody:
+    "A fast moving entity registered with a SweepService."
+    __slots__ = ("entity", "lastPosition", "minDistance",
+                 "maxCorrections", "corrections", "contact", "normal")
+
+    def __init__(self, entity, minDistance, maxCorrections):
+        self.entity = entity
+        self.lastPosition = entity.getPosition()
+        self.minDistance = minDistance
+        self.maxCorrections = maxCorrections
+        self.corrections = 0  # Corrections in a row
+        self.contact = False
+        self.normal = None
+
+
+class SweepService:
+    """Continuous collision detection for fast movers like grenades and droids.
+    Once per physics step, the sphere of every registered entity is swept from its last position to its current one against the static level geometry,
+    all in one batch. Entities that went through a wall are moved back to where they first touched it,
+    and any entity that touched something during its move gets a contact flag for this step."""
+
+    def __init__(self):
+        self.bodies = dict()
+        self.sweeps = 0
+        self.corrections = 0
+
+    def add(self, entity, minDistance=0.0, maxCorrections=None):
+        """Registers an entity. Moves shorter than minDistance aren't swept.
+        After maxCorrections corrections in a row, an entity is left where the physics put it until it moves freely again."""
+        if entity not in self.bodies:
+            self.bodies[entity] = SweptBody(
+                entity, minDistance, maxCorrections)
+
+    def remove(self, entity):
+        if entity in self.bodies:
+            del self.bodies[entity]
+
+    def reset(self, entity):
+        "Call after teleporting an entity, so its next move isn't swept from where it was."
+        body = self.bodies.get(entity)
+        if body is not None:
+            body.lastPosition = entity.getPosition()
+
+    def hasContact(self, entity):
+        body = self.bodies.get(entity)
+        return body is not None and body.contact
+
+    def update(self, aiWorld):
+        for entity in [e for e in self.bodies if not e.active]:
+            del self.bodies[entity]
+        moving = []
+        for body in self.bodies.values():
+            body.contact = False
+            body.normal = None
+            vector = body.entity.getPosition() - body.lastPosition
+            distance = vector.length()
+            if distance > 0 and distance > body.minDistance:
+                vector /= distance
+                moving.append((body, vector, distance))
+        if len(moving) > 0:
+            self.sweeps += len(moving)
+            if aiWorld.staticBVH is not None:
+                results = self._sweepBVH(aiWorld.staticBVH, moving)
+            else:
+                results = self._sweepRays(aiWorld, moving)
+            for i in range(len(moving)):
+                (body, vector, distance) = moving[i]
+                (position, normal, tunneled) = results[i]
+                body.contact = position is not None
+                body.normal = normal
+                if tunneled and (body.maxCorrections is None or body.corrections < body.maxCorrections):
+                    body.entity.setPosition(position)
+                    body.entity.commitChanges()
+                    body.corrections += 1
+                    self.corrections += 1
+                else:
+                    body.corrections = 0
+        for body in self.bodies.values():
+            body.lastPosition = body.entity.getPosition()
+
+    def _sweepBVH(self, bvh, moving):
+        "Returns (contact position, normal, tunneled) for each move. The position and normal are None if nothing was touched."
+        origins = numpy.array([tuple(body.lastPosition)
+                               for (body, vector, distance) in moving])
+        directions = numpy.array([tuple(vector)
+                                  for (body, vector, distance) in moving])
+        distances = numpy.array([distance for (body, vector, distance) in moving])
+        radii = numpy.array([body.entity.radius for (body, vector, distance) in moving])
+        # The center ray says whether the entity went through a wall, and the sphere says where it should have stopped.
+        (centerDistances, centerHits) = bvh.castRays(
+            origins, directions, distances)
+        (sphereDistances, sphereHits) = bvh.castRays(
+            origins, directions, distances + sweepSkin, radii)
+        results = []
+        for i in range(len(moving)):
+            if sphereHits[i] < 0:
+                results.append((None, None, False))
+                continue
+            (body, vector, distance) = moving[i]
+            normal = bvh.normals[sphereHits[i]]
+            position = Point3(body.lastPosition + vector *
+                              float(min(sphereDistances[i], distance)))
+            results.append((position, Vec3(normal[0], normal[1], normal[2]), bool(
+                centerHits[i] >= 0 and centerDistances[i] < distance)))
+        return results
+
+    def _sweepRays(self, aiWorld, moving):
+        "Without a BVH, only the center of each sphere is swept, with one Panda ray per entity."
+        results = []
+        for (body, vector, distance) in moving:
+            hit = aiWorld.getStaticCollision(
+                body.lastPosition, vector, distance + body.entity.radius + sweepSkin)
+            if hit is None:
+                results.append((None, None, False))
+                continue
+            (point, normal) = hit
+            results.append((Point3(point - (vector * body.entity.radius)), normal,
+                            (point - body.lastPosition).length() < distance))
+        return results
+
+    def clear(self):
+        self.bodies.clear()
+
+    def getStats(self):
+        return "%d sweeps, %d corrections, %d bodies registered" % (
+            self.sweeps, self.corrections, len(self.bodies))
@@ -207,16 +207,14 @@ class Gun(Weapon):
     def bulletTest(self, aiWorld, entityGroup, origin, direction):
         """Low-level bullet ray test used by most guns.
         Returns the position of the bullet hit, and the ObjectEntity damaged, if any."""
-        queue = aiWorld.getCollisionQueue(origin, direction)
-        for i in range(queue.getNumEntries()):
-            entry = queue.getEntry(i)
-            pos = entry.getSurfacePoint(render)
-            normal = entry.getSurfaceNormal(render)
-            entity = entityGroup.getEntityFromEntry(entry)
-            if entity == self.actor:
-                continue
-            return (entity, pos, normal, queue)
-        return (None, None, None, None)
+        entry = aiWorld.hitscan.castRay(
+            origin, direction, ignore=self.actor.node)
+        if entry is None:
+            return (None, None, None, None)
+        pos = entry.getSurfacePoint(render)
+        normal = entry.getSurfaceNormal(render)
+        entity = entityGroup.getEntityFromEntry(entry)
+        return (entity, pos, normal, entry)
 
     def serverUpdate(self, aiWorld, entityGroup, packetUpdate):
         p = Weapon.serverUpdate(self, aiWorld, entityGroup, packetUpdate)
@@ -334,7 +332,7 @@ class ChainGun(Gun):
             entity = None
             hitPos = None
             if direction.length() > 0:
-                entity, hitPos, normal, queue = self.bulletTest(
+                entity, hitPos, normal, entry = self.bulletTest(
                     aiWorld, entityGroup, origin, direction)
             if hitPos is None:
                 p.add(net.Boolean(False))  # Bullet didn't hit anything
@@ -440,7 +438,7 @@ class Shotgun(Gun):
             entity = None
             hitPos = None
             if direction.length() > 0:
-                entity, hitPos, normal, queue = self.bulletTest(
+                entity, hitPos, normal, entry = self.bulletTest(
                     aiWorld, entityGroup, origin, direction)
             if hitPos is None:
                 p.add(net.Boolean(False))  # Bullet didn't hit anything
@@ -553,7 +551,7 @@ class SniperRifle(Gun):
 
             p.add(net2.StandardVec3(direction))
 
-            entity, hitPos, normal, queue = self.bulletTest(
+            entity, hitPos, normal, entry = self.bulletTest(
                 aiWorld, entityGroup, origin, direction)
             if hitPos is None:
                 p.add(net.Boolean(False))  # Bullet didn't hit anything
@@ -899,7 +897,7 @@ class Pistol(Gun):
             entity = None
             hitPos = None
             if direction.length() > 0:
-                entity, hitPos, normal, queue = self.bulletTest(
+                entity, hitPos, normal, entry = self.bulletTest(
                     aiWorld, entityGroup, origin, direction)
             if hitPos is None:
                 p.add(net.Boolean(False))  # Bullet didn't hit anything
@@ -916,6 +914,8 @@ class Pistol(Gun):
 
                     pinned = False
                     if isinstance(entity, entities.BasicDroid):
+                        # Look for a wall right behind the droid to pin it to.
+                        queue = aiWorld.hitscan.getQueue(hitPos, direction)
                         for i in range(queue.getNumEntries()):
                             entry = queue.getEntry(i)
                             pos = entry.getSurfacePoint(render)
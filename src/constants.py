@@ -22,6 +22,17 @@ SURVIVAL = 1
 # entities
 SPECIAL_DELAY = 18
 
+# ODE category bits. Every geometry is in CATEGORY_ALL, and collides with it, so everything still collides with everything.
+# The other bits say what a geometry belongs to, so contact subscriptions can pick the pairs they care about.
+CATEGORY_ALL = 0x01
+CATEGORY_STATIC = 0x02  # Level geometry and platforms
+CATEGORY_DROPPOD = 0x04
+CATEGORY_FRAGMENT = 0x08
+CATEGORY_GLASS = 0x10
+CATEGORY_PHYSICSENTITY = 0x20
+CATEGORY_ACTOR = 0x40
+CATEGORY_PROJECTILE = 0x80  # Grenades and molotovs
+
 # net
 # In-game packets
 PACKET_SETUP = 0  # Load a new map
@@ -52,6 +63,15 @@ PACKET_NEWCLIENTNOTIFICATION = 18
 PACKET_CLIENTCONNECTNOTIFICATION = 19
 PACKET_CONFIRMREGISTER = 20  # Lobby server confirms host registration
 
+# Delta snapshots
+PACKET_SNAPSHOT = 21  # Server sequence number for the controller updates that follow
+PACKET_SNAPSHOTACK = 22  # Client acknowledges the server sequences it has decoded
+
+# Connection header with the datagram sequence, acknowledgements and reliable messages (net.PythonNetContext)
+PACKET_SEQUENCED = 23
+# Part of a compressed datagram too big to send in one piece. The fragment header isn't compressed.
+PACKET_FRAGMENT = 24
+
 # Spawn types
 SPAWN_PLAYER = 0
 SPAWN_BOT = 1
@@ -18,10 +18,20 @@ from direct.showbase.DirectObject import DirectObject
 
 types = None
 specialTypes = None
+# Fixed parts of controller messages, packed with one struct call each. Built in init(), since net2 imports this module.
+spawnHeaderSchema = None
+deleteSchema = None
+controllerHeaderSchema = None
+snapshotEncodingSchema = None
+objectSpawnSchema = None
+glassSpawnSchema = None
+actorStatusSchema = None
 
 
 def init():
     global types, specialTypes
+    global spawnHeaderSchema, deleteSchema, controllerHeaderSchema, snapshotEncodingSchema
+    global objectSpawnSchema, glassSpawnSchema, actorStatusSchema
     # Important: Shield droid and cloak droid MUST come before chaingun droid, due to inheritance issues.
     # When determining the controller's type, readSpawnPacket stops at the
     # first match.
@@ -42,6 +52,14 @@ def init():
         constants.AWESOME_SPECIAL: AwesomeSpecial,
         constants.ROCKET_SPECIAL: RocketSpecial}
 
+    spawnHeaderSchema = net.Schema(net.Uint8, net.Uint8, net.Uint32)  # PACKET_SPAWN, controller type, entity ID
+    deleteSchema = net.Schema(net.Uint8, net.Uint32, net.Boolean)  # PACKET_DELETE, entity ID, killed
+    controllerHeaderSchema = net.Schema(net.Uint8, net.Uint8)  # PACKET_CONTROLLER, entity ID
+    snapshotEncodingSchema = net.Schema(net.Uint8)
+    objectSpawnSchema = net.Schema(net2.HighResVec3, net2.StandardVec3, net2.StandardVec3)  # Position, velocity, rotation
+    glassSpawnSchema = net.Schema(net2.StandardVec3, net2.StandardVec3, net.StandardFloat, net.StandardFloat)
+    actorStatusSchema = net.Schema(net.Boolean, net.Int16)  # On fire, health
+
 
 class Controller(DirectObject):
 
@@ -56,6 +74,7 @@ class Controller(DirectObject):
         # If we have a critical packet on an update frame, and we add it to the critical packet queue,
         # it will get sent again on the next update frame.
         # So, we don't want that to happen.
+        # Critical updates go on the NetManager's reliable channel, so they arrive even if a datagram is lost.
         if packetUpdate:
             self.criticalUpdate = True
         elif p not in self.criticalPackets:
@@ -64,6 +83,10 @@ class Controller(DirectObject):
     def clearCriticalPackets(self):
         del self.criticalPackets[:]
 
+    def isDormant(self):
+        "Dormant entities have been asleep since their last full update, so the NetManager skips their updates."
+        return False
+
     def setEntity(self, entity):
         """ObjectEntity calls this function on initialization."""
         assert isinstance(entity, entities.Entity)
@@ -72,14 +95,13 @@ class Controller(DirectObject):
     def buildSpawnPacket(self):
         """Builds a packet instructing client(s) to spawn the correct ObjectEntity with the correct ID."""
         p = net.Packet()
-        p.add(net.Uint8(constants.PACKET_SPAWN))
         controllerType = 0
         for type in list(types.items()):
             if isinstance(self, type[1]):
                 controllerType = type[0]
                 break
-        p.add(net.Uint8(controllerType))
-        p.add(net.Uint32(self.entity.getId()))
+        p.write(spawnHeaderSchema, constants.PACKET_SPAWN,
+                controllerType, self.entity.getId())
         return p
 
     @staticmethod
@@ -93,9 +115,8 @@ class Controller(DirectObject):
     def buildDeletePacket(self, killed=False):
         """Builds a packet instructing clients to delete the Entity."""
         p = net.Packet()
-        p.add(net.Uint8(constants.PACKET_DELETE))
-        p.add(net.Uint32(self.entity.getId()))
-        p.add(net.Boolean(killed))
+        p.write(deleteSchema, constants.PACKET_DELETE,
+                self.entity.getId(), killed)
         return p
 
     def serverUpdate(self, aiWorld, entityGroup, packetUpdate):
@@ -109,12 +130,12 @@ class Controller(DirectObject):
             if packetUpdate:
                 self.criticalUpdate = len(self.criticalPackets) > 0
                 for packet in self.criticalPackets:
-                    p.add(packet)
+                    p.add(net2.EventUpdate(packet))
                 del self.criticalPackets[:]
             else:
                 self.criticalUpdate = False
-            p.add(net.Uint8(constants.PACKET_CONTROLLER))
-            p.add(net.Uint8(self.entity.getId()))
+            p.write(controllerHeaderSchema, constants.PACKET_CONTROLLER,
+                    self.entity.getId())
         return p
 
     def needsToSendUpdate(self):
@@ -222,15 +243,19 @@ class TeamEntityController(Controller):
         p.add(net.Int16(self.entity.money))
         if self.entity.username != self.oldUsername:
             self.addCriticalPacket(p, packetUpdate)
-            p.add(net.Boolean(True))
-            p.add(net.String(self.entity.username))
+            rename = net.Packet()
+            rename.add(net.Boolean(True))
+            rename.add(net.String(self.entity.username))
+            p.add(net2.EventUpdate(rename, omitted=net.Boolean(False)))
         else:
             p.add(net.Boolean(False))
         self.oldUsername = self.entity.username
         a = [
             x for x in self.respawns if engine.clock.time -
             x[4] > self.spawnDelay]
-        p.add(net.Uint8(len(a)))
+        purchases = net.Packet()
+        purchases.add(net.Uint8(len(a)))
+        p.add(net2.EventUpdate(purchases, omitted=net.Uint8(0)))
         for purchase in a:
             isLocalPlayer = purchase[0]
             type = purchase[1]
@@ -285,7 +310,7 @@ class TeamEntityController(Controller):
             u.setPosition(pos)
             u.setTeamId(self.entity.getId())
             u.commitChanges()
-            p.add(net2.HighResVec3(Vec3(pos)))
+            purchases.add(net2.HighResVec3(Vec3(pos)))
             self.addCriticalPacket(p, packetUpdate)
             entityGroup.spawnEntity(u)
             self.respawns.remove(purchase)
@@ -353,6 +378,7 @@ class ObjectController(Controller):
         self.lastSnapshot = net2.EntitySnapshot()
         self.upperHeightLimit = 70
         self.lowerHeightLimit = -30
+        self.dormant = False  # Asleep, and the resting state has already been sent
 
     def setEntity(self, entity):
         """ObjectEntity calls this function on initialization."""
@@ -366,9 +392,8 @@ class ObjectController(Controller):
         if isPhysicsEntity:
             p.add(net.String(self.entity.directory))
             p.add(net.String(self.entity.dataFile))
-        p.add(net2.HighResVec3(self.entity.getPosition()))
-        p.add(net2.StandardVec3(self.entity.getLinearVelocity()))
-        p.add(net2.StandardVec3(self.entity.getRotation()))
+        p.write(objectSpawnSchema, self.entity.getPosition(),
+                self.entity.getLinearVelocity(), self.entity.getRotation())
         return p
 
     @staticmethod
@@ -391,9 +416,7 @@ class ObjectController(Controller):
                     dataFile + ".txt"),
                 directory,
                 dataFile)
-        pos = net2.HighResVec3.getFrom(iterator)
-        vel = net2.StandardVec3.getFrom(iterator)
-        rot = net2.StandardVec3.getFrom(iterator)
+        pos, vel, rot = objectSpawnSchema.getFrom(iterator)
         entity.setPosition(pos)
         entity.setRotation(Vec3(rot.getX(), rot.getY(), rot.getZ()))
         entity.setLinearVelocity(vel)
@@ -417,21 +440,38 @@ class ObjectController(Controller):
             self.entity.commitChanges()
             snapshot = net2.EntitySnapshot()
             snapshot.takeSnapshot(self.entity)
-            if not packetUpdate or self.isStatic or (self.lastSentSnapshot.almostEquals(
-                    snapshot) and self.entity.body.getLinearVel().length() < 0.5):
-                p.add(net.Boolean(False))
+            unchanged = self.lastSentSnapshot.almostEquals(
+                snapshot) and self.entity.body.getLinearVel().length() < 0.5
+            if unchanged and packetUpdate and self.entity.isAsleep() and not net2.baselines.isAcknowledged(
+                    self.entity.getId(), snapshot):
+                # The resting state went out unreliably. Keep sending it until every client has it, or they'd be left with the last moving state.
+                unchanged = False
+            if not packetUpdate or self.isStatic or unchanged:
+                p.write(snapshotEncodingSchema, net2.SNAPSHOT_NONE)
                 self.newPositionData = False
             else:
                 self.newPositionData = True
-                p.add(net.Boolean(True))
                 self.lastSnapshot = snapshot
-                p.add(snapshot)
+                p.add(net2.SnapshotUpdate(self.entity.getId(), snapshot))
             z = self.entity.getPosition().getZ()
             if z < self.lowerHeightLimit or z > self.upperHeightLimit:
                 self.entity.killer = None
                 self.entity.kill(aiWorld, entityGroup)
+            if not self.entity.isAsleep():
+                self.dormant = False
+            elif packetUpdate:
+                # Only go dormant once every client has acknowledged the resting state.
+                self.dormant = not self.newPositionData
         return p
 
+    def isDormant(self):
+        return self.dormant and self.entity.isAsleep()
+
+    def addSnapshot(self, snapshot):
+        "Adds a received snapshot to the ones the entity is interpolated between."
+        self.snapshots.insert(0, snapshot)
+        self.snapshots = self.snapshots[:6]
+
     def needsToSendUpdate(self):
         if self.newPositionData or Controller.needsToSendUpdate(self):
             self.lastSentSnapshot = self.lastSnapshot
@@ -449,13 +489,12 @@ class ObjectController(Controller):
                 self.snapshots.append(net2.EntitySnapshot())
                 self.snapshots[0].takeSnapshot(self.entity)
             if iterator is not None:
-                if net.Boolean.getFrom(iterator):
-                    snapshot = net2.EntitySnapshot.getFrom(iterator)
-                else:
+                snapshot = net2.baselines.readSnapshot(
+                    iterator, self.entity.getId())
+                if snapshot is None:
                     snapshot = net2.EntitySnapshot()
                     snapshot.setFrom(self.snapshots[0])
-                self.snapshots.insert(0, snapshot)
-                self.snapshots = self.snapshots[:6]
+                self.addSnapshot(snapshot)
             elif not self.entity.isLocal and len([x for x in self.snapshots if x.time > currentTime]) == 0:
                 snapshot = net2.EntitySnapshot()
                 snapshot.setFrom(self.snapshots[0])
@@ -523,10 +562,8 @@ class GlassController(Controller):
 
     def buildSpawnPacket(self):
         p = Controller.buildSpawnPacket(self)
-        p.add(net2.StandardVec3(self.entity.getPosition()))
-        p.add(net2.StandardVec3(self.entity.getRotation()))
-        p.add(net.StandardFloat(self.entity.glassWidth))
-        p.add(net.StandardFloat(self.entity.glassHeight))
+        p.write(glassSpawnSchema, self.entity.getPosition(), self.entity.getRotation(),
+                self.entity.glassWidth, self.entity.glassHeight)
         return p
 
     @staticmethod
@@ -534,13 +571,8 @@ class GlassController(Controller):
         entity = entities.Glass(aiWorld.world, aiWorld.space)
         entity = Controller.readSpawnPacket(
             aiWorld, entityGroup, iterator, entity)
-        pos = net2.StandardVec3.getFrom(iterator)
-        hpr = net2.StandardVec3.getFrom(iterator)
-        entity.initGlass(
-            aiWorld.world,
-            aiWorld.space,
-            net.StandardFloat.getFrom(iterator),
-            net.StandardFloat.getFrom(iterator))
+        pos, hpr, width, height = glassSpawnSchema.getFrom(iterator)
+        entity.initGlass(aiWorld.world, aiWorld.space, width, height)
         entity.setPosition(pos)
         entity.setRotation(Vec3(hpr.getX(), hpr.getY(), hpr.getZ()))
         return entity
@@ -648,8 +680,10 @@ class DropPodController(ObjectController):
             if droid is not None and (
                     droid.getPosition() -
                     self.entity.getPosition()).length() < self.captureDistance:
-                p.add(net.Boolean(True))
-                p.add(net.Uint8(droid.getTeam().getId()))
+                payout = net.Packet()
+                payout.add(net.Boolean(True))
+                payout.add(net.Uint8(droid.getTeam().getId()))
+                p.add(net2.EventUpdate(payout, omitted=net.Boolean(False)))
                 paid = True
                 self.money -= self.payoutAmount
                 self.lastPayout = engine.clock.time
@@ -706,11 +740,11 @@ class GrenadeController(ObjectController):
         ObjectController.__init__(self)
         self.bounceTime = -1
         self.bounceSound = audio.SoundPlayer("grenade-bounce")
-        self.lastPosition = None
         self.particleGroup = None
         self.light = engine.Light(color=Vec4(
             1.0, 0.7, 0.4, 1), attenuation=Vec3(0, 0, 0.01))
         self.light.add()
+        self.contactWorld = None  # The ai.World we get contact reports from
 
     def buildSpawnPacket(self):
         p = ObjectController.buildSpawnPacket(self)
@@ -735,6 +769,13 @@ class GrenadeController(ObjectController):
             self.bounceTime = engine.clock.time
             self.bounceSound.play(position=self.entity.getPosition())
 
+    def contactsReported(self, contacts):
+        "Bouncing off anything that moves starts the fuse too. The sweep only sees static geometry."
+        for entityA, entityB, position in contacts:
+            if entityA is self.entity:
+                self.trigger()
+                break
+
     def clientUpdate(self, aiWorld, entityGroup, data=None):
         ObjectController.clientUpdate(self, aiWorld, entityGroup, data)
         pos = self.entity.getPosition()
@@ -745,29 +786,12 @@ class GrenadeController(ObjectController):
         self.particleGroup.setPosition(pos)
 
     def serverUpdate(self, aiWorld, entityGroup, packetUpdate):
-        pos = self.entity.getPosition()
-        if self.lastPosition is None:
-            self.lastPosition = pos
-        else:
-            # Check to make sure the grenade didn't go through a wall
-            vector = self.entity.getPosition() - self.lastPosition
-            distance = vector.length()
-            if distance > 0:
-                vector.normalize()
-                queue = aiWorld.getCollisionQueue(
-                    self.lastPosition, vector, engine.renderEnvironment)
-                for i in range(queue.getNumEntries()):
-                    entry = queue.getEntry(i)
-                    collision = entry.getSurfacePoint(render)
-                    v = collision - self.lastPosition
-                    if v.length() < distance:
-                        self.entity.setPosition(
-                            collision - (vector * self.entity.radius))
-                        self.entity.commitChanges()
-                        self.trigger()
-                        break
-
-        self.lastPosition = self.entity.getPosition()
+        # The AI world's sweep keeps the grenade from going through walls.
+        aiWorld.sweeps.add(self.entity)
+        if self.contactWorld is None:
+            self.contactWorld = aiWorld
+            aiWorld.subscribeContacts(self.contactsReported, constants.CATEGORY_PROJECTILE,
+                                      constants.CATEGORY_PHYSICSENTITY | constants.CATEGORY_DROPPOD | constants.CATEGORY_ACTOR | constants.CATEGORY_GLASS)
 
         p = ObjectController.serverUpdate(
             self, aiWorld, entityGroup, packetUpdate)
@@ -778,10 +802,8 @@ class GrenadeController(ObjectController):
         ) - self.entity.getPosition()).length() < enemy.radius + self.entity.radius:
             self.entity.kill(aiWorld, entityGroup)
 
-        if self.bounceTime == -1:
-            if aiWorld.testCollisions(
-                    self.entity.collisionNodePath).getNumEntries() > 0:
-                self.trigger()
+        if self.bounceTime == -1 and aiWorld.sweeps.hasContact(self.entity):
+            self.trigger()
         if (self.bounceTime != -
             1 and engine.clock.time > self.bounceTime +
             0.6) or (engine.clock.time > self.entity.spawnTime +
@@ -791,6 +813,9 @@ class GrenadeController(ObjectController):
 
     def delete(self, killed=False):
         self.light.remove()
+        if self.contactWorld is not None:
+            self.contactWorld.unsubscribeContacts(self.contactsReported)
+            self.contactWorld = None
         ObjectController.delete(self, killed)
 
 
@@ -799,7 +824,6 @@ class MolotovController(ObjectController):
 
     def __init__(self):
         ObjectController.__init__(self)
-        self.lastPosition = None
         self.particleGroup = None
         self.light = engine.Light(color=Vec4(
             1.0, 0.6, 0.2, 1), attenuation=Vec3(0, 0, 0.005))
@@ -827,28 +851,8 @@ class MolotovController(ObjectController):
         ObjectController.setEntity(self, entity)
 
     def serverUpdate(self, aiWorld, entityGroup, packetUpdate):
-        pos = self.entity.getPosition()
-        if self.lastPosition is None:
-            self.lastPosition = pos
-        else:
-            # Check to make sure the grenade didn't go through a wall
-            vector = self.entity.getPosition() - self.lastPosition
-            distance = vector.length()
-            if distance > 0:
-                vector.normalize()
-                queue = aiWorld.getCollisionQueue(
-                    self.lastPosition, vector, engine.renderEnvironment)
-                for i in range(queue.getNumEntries()):
-                    entry = queue.getEntry(i)
-                    collision = entry.getSurfacePoint(render)
-                    v = collision - self.lastPosition
-                    if v.length() < distance:
-                        self.entity.setPosition(
-                            collision - (vector * self.entity.radius))
-                        self.entity.commitChanges()
-                        break
-
-        self.lastPosition = self.entity.getPosition()
+        # The AI world's sweep keeps the molotov from going through walls.
+        aiWorld.sweeps.add(self.entity)
 
         p = ObjectController.serverUpdate(
             self, aiWorld, entityGroup, packetUpdate)
@@ -867,11 +871,8 @@ class MolotovController(ObjectController):
             self.particleGroup.isIndependent = True
             particles.add(self.particleGroup)
         self.particleGroup.setPosition(pos)
-        for enemy in (
-            x for x in list(entityGroup.entities.values()) if isinstance(
-                x, entities.Actor) and not x.getTeam().isAlly(
-                self.entity.getTeam()) and (
-                x.getPosition() - self.entity.getPosition()).length() < 8.0):
+        for enemy, distance in entityGroup.getEntitiesInRadius(
+                pos, 8.0, entities.Actor, enemiesOf=self.entity.getTeam()):
             enemy.controller.setOnFire(self.entity.actor)
 
     def delete(self, killed=False):
@@ -919,10 +920,11 @@ class ActorController(ObjectController):
                 needUpdate = component.needsToSendUpdate()
                 self.newPositionData = self.newPositionData or needUpdate
                 if needUpdate:
+                    # Component updates are one-off events, like shots fired.
                     self.componentsNeedUpdate = True
-                    p.add(p2)
+                    self.criticalUpdate = True
+                    p.add(net2.EventUpdate(p2))
         p.add(net.Uint8(255))  # End of component packets
-        p.add(net.Boolean(self.onFire))
         if self.entity.health < self.entity.maxHealth and (
             engine.clock.time -
             self.lastDamage > 4.0 or (
@@ -933,7 +935,9 @@ class ActorController(ObjectController):
         self.entity.health += int(self.healthAddition)
         self.lastHealthAddition = self.healthAddition
         self.healthAddition = 0
-        p.add(net.Int16(self.entity.health))
+        status = net.Packet()
+        status.write(actorStatusSchema, self.onFire, self.entity.health)
+        p.add(net2.StateUpdate(status))
         if self.entity.health <= 0:
             self.entity.kill(aiWorld, entityGroup, True)
         return p
@@ -955,8 +959,8 @@ class ActorController(ObjectController):
                        if x not in updatedComponents):
                 self.entity.components[id].clientUpdate(aiWorld, entityGroup)
 
-            self.onFire = net.Boolean.getFrom(data)
-            self.entity.health = net.Int16.getFrom(data)
+            if net.Boolean.getFrom(data):  # Reliable copies leave the status out
+                self.onFire, self.entity.health = actorStatusSchema.getFrom(data)
         else:
             for component in self.entity.components:
                 component.clientUpdate(aiWorld, entityGroup)
@@ -979,13 +983,11 @@ class DroidController(ActorController):
         self.lastSentTargetPos = Vec3()
         self.targetedEnemy = None
         self.lastTargetedEnemy = None
-        self.lastPosition = None
         self.onFire = False
         self.fireTimer = -1
         self.lastFireDamage = -1
         self.fireEntity = None
         self.fireParticles = None
-        self.clipCheckCount = 0
 
     def buildSpawnPacket(self):
         p = ActorController.buildSpawnPacket(self)
@@ -1059,41 +1061,16 @@ class DroidController(ActorController):
                 self.entity.setPosition(self.entity.pinPosition)
                 self.entity.setRotation(self.entity.pinRotation)
                 self.entity.setLinearVelocity(Vec3(0, 0, 0))
+                # Don't sweep from where the physics put us to the pin.
+                aiWorld.sweeps.reset(self.entity)
 
         if self.entity.special is not None:
             specialPacket = self.entity.special.serverUpdate(
                 aiWorld, entityGroup, packetUpdate)
 
-        pos = self.entity.getPosition()
-        if self.lastPosition is None:
-            self.lastPosition = pos
-        else:
-            clipped = False
-            if self.clipCheckCount < 10:
-                # Check to make sure we didn't go through a wall
-                vector = self.entity.getPosition() - self.lastPosition
-                distance = vector.length()
-                if distance > self.entity.radius * 0.9:
-                    vector.normalize()
-                    queue = aiWorld.getCollisionQueue(
-                        self.lastPosition, vector, engine.renderEnvironment)
-                    for i in range(queue.getNumEntries()):
-                        entry = queue.getEntry(i)
-                        collision = entry.getSurfacePoint(render)
-                        v = collision - self.lastPosition
-                        if v.length() < distance:
-                            clipped = True
-                            self.entity.setPosition(
-                                collision - (vector * self.entity.radius))
-                            self.entity.commitChanges()
-                            break
-            if clipped:
-                self.clipCheckCount += 1
-            else:
-                # We didn't clip this time, so reset the count.
-                self.clipCheckCount = 0
-
-        self.lastPosition = self.entity.getPosition()
+        # The AI world's sweep keeps us from going through walls.
+        # After ten corrections in a row we must be stuck, so the sweep lets the physics have its way.
+        aiWorld.sweeps.add(self.entity, minDistance=self.entity.radius * 0.9, maxCorrections=10)
 
         if self.onFire:
             if engine.clock.time - self.fireTimer > 2.0:
@@ -1107,36 +1084,40 @@ class DroidController(ActorController):
         p = ActorController.serverUpdate(
             self, aiWorld, entityGroup, packetUpdate)
 
-        p.add(net.Boolean(self.onFire))
-
         if self.activeWeapon != self.lastActiveWeapon:
-            p.add(net.Boolean(True))
-            p.add(net.Uint8(self.activeWeapon))
+            weaponSwitch = net.Packet()
+            weaponSwitch.add(net.Boolean(True))
+            weaponSwitch.add(net.Uint8(self.activeWeapon))
+            p.add(net2.EventUpdate(weaponSwitch, omitted=net.Boolean(False)))
             self.addCriticalPacket(p, packetUpdate)
         else:
             p.add(net.Boolean(False))
-        p.add(net2.LowResVec3(self.targetPos))
+        status = net.Packet()
+        status.add(net.Boolean(self.onFire))
+        status.add(net2.LowResVec3(self.targetPos))
+        p.add(net2.StateUpdate(status))
         if self.entity.special is not None:
             p.add(specialPacket)
+            if self.entity.special.criticalUpdate:
+                self.criticalUpdate = True
         return p
 
     def actorDamaged(self, entity, damage, ranged):
         ActorController.actorDamaged(self, entity, damage, ranged)
         self.lastDamage = engine.clock.time
-        if self.entity.pinned:
-            self.lastPosition = self.entity.getPosition()
 
     def clientUpdate(self, aiWorld, entityGroup, iterator=None):
         ActorController.clientUpdate(self, aiWorld, entityGroup, iterator)
         if iterator is not None:
-            self.onFire = net.Boolean.getFrom(iterator)  # We're on fire
             if net.Boolean.getFrom(iterator):
                 if self.lastActiveWeapon != -1:
                     self.entity.components[self.lastActiveWeapon].hide()
                 self.activeWeapon = net.Uint8.getFrom(iterator)
                 self.entity.components[self.activeWeapon].show()
                 self.lastActiveWeapon = self.activeWeapon
-            self.targetPos = net2.LowResVec3.getFrom(iterator)
+            if net.Boolean.getFrom(iterator):  # Reliable copies leave the status out
+                self.onFire = net.Boolean.getFrom(iterator)  # We're on fire
+                self.targetPos = net2.LowResVec3.getFrom(iterator)
 
         if self.entity.health <= self.entity.maxHealth * 0.15:
             if not self.alarmSound.isPlaying():
@@ -1426,15 +1407,15 @@ class PlayerController(DroidController):
             maxSpeed *= 2
             torque *= 2
         if move:
-            self.entity.addTorque(Vec3(engine.impulseToForce(
+            self.entity.setStepTorque(Vec3(engine.impulseToForce(
                 torque * math.cos(angleX)), engine.impulseToForce(-torque * math.sin(angleX)), 0))
             if angularVel.length() > maxSpeed:
                 angularVel.normalize()
                 self.entity.setAngularVelocity(angularVel * maxSpeed)
         else:
-            self.entity.addTorque(Vec3(engine.impulseToForce(-angularVel.getX() * 20),
-                                       engine.impulseToForce(-angularVel.getY() * 20),
-                                       engine.impulseToForce(-angularVel.getZ() * 20)))
+            self.entity.setStepTorque(Vec3(engine.impulseToForce(-angularVel.getX() * 20),
+                                           engine.impulseToForce(-angularVel.getY() * 20),
+                                           engine.impulseToForce(-angularVel.getZ() * 20)))
 
         if self.isPlatformMode:
             self.pickRay.setOrigin(Point3(self.entity.getPosition()))
@@ -1506,16 +1487,18 @@ class PlayerController(DroidController):
         if not self.isPlatformMode:
             camera.setPos(self.entity.getPosition() + cameraPos)
 
-        p.add(net.Boolean(self.sprinting))
+        p.add(net2.StateUpdate(net.Boolean(self.sprinting)))
         cmds = len(self.commands)
-        p.add(net.Uint8(cmds))
+        commands = net.Packet()
+        commands.add(net.Uint8(cmds))
+        p.add(net2.EventUpdate(commands, omitted=net.Uint8(0)))
         if cmds > 0:
             self.addCriticalPacket(p, packetUpdate)
         for c in self.commands:
-            p.add(net.Uint8(c[0]))  # The ID of our actor
-            p.add(net.Boolean(c[1] == -1))  # True if this is a special attack
+            commands.add(net.Uint8(c[0]))  # The ID of our actor
+            commands.add(net.Boolean(c[1] == -1))  # True if this is a special attack
             if c[1] != -1:  # Setting the bot's target
-                p.add(net.Uint8(c[1]))  # The ID of the target entity
+                commands.add(net.Uint8(c[1]))  # The ID of the target entity
         del self.commands[:]
 
         return p
@@ -1524,7 +1507,8 @@ class PlayerController(DroidController):
         DroidController.clientUpdate(self, aiWorld, entityGroup, iterator)
 
         if iterator is not None:
-            self.sprinting = net.Boolean.getFrom(iterator)
+            if net.Boolean.getFrom(iterator):  # Reliable copies leave the state out
+                self.sprinting = net.Boolean.getFrom(iterator)
             cmds = net.Uint8.getFrom(iterator)
             for i in range(cmds):
                 id = net.Uint8.getFrom(iterator)
@@ -1700,7 +1684,7 @@ class AIController(DroidController):
         # PHYSICS/MOVEMENT UPDATE
         angularVel = self.entity.getAngularVelocity()
         if self.moving:
-            self.entity.addTorque(
+            self.entity.setStepTorque(
                 Vec3(
                     engine.impulseToForce(
                         -self.torque * self.direction.getY()),
@@ -1711,9 +1695,9 @@ class AIController(DroidController):
                 angularVel.normalize()
                 self.entity.setAngularVelocity(angularVel * self.maxSpeed)
         else:
-            self.entity.addTorque(Vec3(engine.impulseToForce(-angularVel.getX() * 6),
-                                       engine.impulseToForce(-angularVel.getY() * 6),
-                                       engine.impulseToForce(-angularVel.getZ() * 6)))
+            self.entity.setStepTorque(Vec3(engine.impulseToForce(-angularVel.getX() * 6),
+                                           engine.impulseToForce(-angularVel.getY() * 6),
+                                           engine.impulseToForce(-angularVel.getZ() * 6)))
 
         # WEAPON UPDATE
         weapon = self.entity.components[self.activeWeapon]
@@ -1778,6 +1762,7 @@ class Special(DirectObject):
         self.newEnabled = False
         self.enabledChanged = False
         self.criticalPackets = []
+        self.criticalUpdate = False
         # Passive specials (like shields) need to cancel out the order to set
         # the bot's target enemy.
         self.passive = True
@@ -1786,7 +1771,9 @@ class Special(DirectObject):
         # If we have a critical packet on an update frame, and we add it to the critical packet queue,
         # it will get sent again on the next update frame.
         # So, we don't want that to happen.
-        if not packetUpdate and p not in self.criticalPackets:
+        if packetUpdate:
+            self.criticalUpdate = True
+        elif p not in self.criticalPackets:
             self.criticalPackets.append(p)
 
     def enable(self):
@@ -1800,25 +1787,41 @@ class Special(DirectObject):
             self.newEnabled = False
         p = net.Packet()
         if packetUpdate:
-            p.add(net.Uint8(len(self.criticalPackets) + 1))
+            self.criticalUpdate = len(self.criticalPackets) > 0
+            events = net.Packet()
+            events.add(net.Uint8(len(self.criticalPackets)))
             for packet in self.criticalPackets:
-                p.add(packet)
+                events.add(packet)
+            p.add(net2.EventUpdate(events, omitted=net.Uint8(0)))
             del self.criticalPackets[:]
         else:
-            p.add(net.Uint8(1))
+            self.criticalUpdate = False
+            p.add(net.Uint8(0))
         self.enabled = self.newEnabled
-        p.add(net.Boolean(self.enabled))
-        p.add(net.Boolean(self.newEnabled != self.enabled))
+        state = net.Packet()
+        state.add(net.Boolean(self.enabled))
+        state.add(net.Boolean(False))
         if self.newEnabled != self.enabled:
-            p.add(net.HighResFloat(self.timer))
+            change = net.Packet()
+            change.add(net.Boolean(True))
+            change.add(net.Boolean(self.enabled))
+            change.add(net.Boolean(True))
+            change.add(net.HighResFloat(self.timer))
+            p.add(net2.EventUpdate(change, omitted=net2.StateUpdate(state)))
             self.addCriticalPacket(p, packetUpdate)
+        else:
+            p.add(net2.StateUpdate(state))
         return p
 
     def clientUpdateStart(self, aiWorld, entityGroup, iterator=None):
         if iterator is not None:
             criticalPackets = net.Uint8.getFrom(iterator)
             for _ in range(criticalPackets):
+                self.clientUpdateStart(aiWorld, entityGroup, iterator)
+            if net.Boolean.getFrom(iterator):  # Reliable copies leave the state out
                 self.clientUpdate(aiWorld, entityGroup, iterator)
+            else:
+                self.clientUpdate(aiWorld, entityGroup)
 
     def clientUpdate(self, aiWorld, entityGroup, iterator=None):
         if iterator is not None:
@@ -1858,7 +1861,7 @@ class KamikazeSpecial(Special):
                     distance = vector.length()
                     vector /= distance
                     vector *= (400.0 / max(6.0, distance))
-                    entity.addForce(engine.impulseToForce(
+                    entity.setStepForce(engine.impulseToForce(
                         vector.getX(), vector.getY(), vector.getZ()))
         elif self.triggered:
             entityGroup.shakeCamera()
@@ -50,6 +50,7 @@ class Backend(DirectObject):
         self.entityGroup = entities.EntityGroup(self.netManager)
         self.game = None
         self.lastGc = engine.clock.time
+        self.physicsTime = 0.0  # Clock time not yet simulated by a physics step
         self.scoreLimit = 3000
         self.username = username
         self.enableRespawn = True
@@ -70,13 +71,32 @@ class Backend(DirectObject):
                 gc.collect()
                 self.lastGc = engine.clock.time
             if not engine.paused:
-                self.aiWorld.update()
+                self.updatePhysics()
                 self.netManager.update(self)
             if self.entityGroup is not None:
                 self.entityGroup.update()
             if self.map is not None:
                 self.map.update()
 
+    def updatePhysics(self):
+        """Steps the physics at a fixed rate, so it behaves and costs the same at any frame rate.
+        Leftover time carries over to the next frame, and commitChanges interpolates between the last two steps.
+        Continuous controller forces from the last frame are applied on each step, then cleared."""
+        self.physicsTime += engine.clock.timeStep
+        steps = 0
+        while self.physicsTime >= engine.physicsTimeStep:
+            if steps == engine.maxPhysicsSteps:
+                self.physicsTime = 0.0
+                break
+            self.entityGroup.storeStepStates()
+            self.entityGroup.applyStepForces()
+            self.aiWorld.update(self.entityGroup)
+            self.physicsTime -= engine.physicsTimeStep
+            steps += 1
+        if steps > 0:
+            self.entityGroup.clearStepForces()
+        engine.physicsAlpha = self.physicsTime / engine.physicsTimeStep
+
     def loadMap(self, mapFile):
         self.reset()
         if self.game is not None:
@@ -226,7 +246,7 @@ class ServerBackend(Backend):
                 [x for x in self.entityGroup.teams if x.score > team.score])
             p.add(net.Uint8(team.getId()))
             p.add(net.Uint8(team.lastMatchPosition))
-        net.context.broadcast(p)
+        net.context.broadcast(p, reliable=True)
         for team in self.entityGroup.teams:
             # Just in case some packets came in late after the match ended.
             team.resetScore()
@@ -293,7 +313,7 @@ class ServerBackend(Backend):
         engine.log.info(
             "Constructing initialization packet for client " +
             net.addressToString(client))
-        net.context.send(self.makeSetupPacket(client), client)
+        net.context.send(self.makeSetupPacket(client), client, reliable=True)
 
     def makeSetupPacket(self, client):
         p = net.Packet()
@@ -309,20 +329,17 @@ class ServerBackend(Backend):
     def clientReadyCallback(self, client):
         engine.log.info("Client " + net.addressToString(client) +
                         " completed loading. Sending spawn packets...")
-        net.context.send(self.makeUberSpawnPacket(), client)
+        net.context.send(self.makeUberSpawnPacket(), client, reliable=True)
 
     def makeUberSpawnPacket(self):
         p = net.Packet()
         # Teams have to be spawned first, so other entities can link to them.
-        for entity in (
-            x for x in list(self.entityGroup.entities.values()) if isinstance(
-                x,
-                entities.TeamEntity)):
+        teams = self.entityGroup.getEntitiesOfType(entities.TeamEntity)
+        for entity in teams:
             p.add(entity.controller.buildSpawnPacket())
-        for entity in (
-            x for x in list(self.entityGroup.entities.values()) if not isinstance(
-                x,
-                entities.TeamEntity)):
+        teams = set(teams)
+        for entity in (x for x in list(self.entityGroup.entities.values())
+                       if x not in teams):
             p.add(entity.controller.buildSpawnPacket())
         return p
 
@@ -347,24 +364,20 @@ class PointControlBackend(ServerBackend):
         if engine.clock.time - self.lastPodSpawnCheck > 0.5:
             numPods = 1 if self.numClients <= 2 else 2
             self.lastPodSpawnCheck = engine.clock.time
-            if len([1 for x in list(self.entityGroup.entities.values()) if isinstance(x, entities.DropPod)]) < numPods and len(
+            if self.entityGroup.countEntitiesOfType(entities.DropPod) < numPods and len(
                     [1 for team in self.entityGroup.teams if team.getPlayer() is not None and team.getPlayer().active]) > 0:
                 self.spawnPod()
 
     def spawnPod(self):
         size = self.map.worldSize * 0.8
-        queue = None
-        while queue is None or queue.getNumEntries() == 0:
-            queue = self.aiWorld.getCollisionQueue(
+        pos = None
+        while pos is None:
+            hit = self.aiWorld.getStaticCollision(
                 Vec3(uniform(-size, size), uniform(-size, size), 100), Vec3(0, 0, -1))
-            pos = None
-            for i in range(queue.getNumEntries()):
-                entry = queue.getEntry(i)
-                if entry.getSurfaceNormal(render).getZ() >= 0:
-                    pos = entry.getSurfacePoint(render)
-                    break
-            if pos is None or self.aiWorld.navMesh.getNode(pos) is None:
-                queue = None
+            if hit is not None and hit[1].getZ() >= 0:
+                pos = hit[0]
+            if pos is not None and self.aiWorld.navMesh.getNode(pos) is None:
+                pos = None
         pod = entities.DropPod(self.aiWorld.world, self.aiWorld.space)
         pod.controller.setFinalPosition(pos)
         self.entityGroup.spawnEntity(pod)
@@ -456,7 +469,7 @@ class SurvivalBackend(ServerBackend):
             elif self.zombiesSpawned and engine.clock.time - self.zombieSpawnTime > self.zombieTeam.controller.spawnDelay + 1.0:
                 if deadPlayers == self.numClients:
                     self.endMatch(self.zombieTeam)
-                elif len([x for x in list(self.entityGroup.entities.values()) if isinstance(x, entities.Actor) and x.getTeam().isAlly(self.zombieTeam)]) == 0:
+                elif len(self.entityGroup.getActors(alliesOf=self.zombieTeam)) == 0:
                     highestScore = -1
                     winningTeam = None
                     for team in self.entityGroup.teams:
@@ -493,7 +506,7 @@ class ClientBackend(Backend):
         Backend.loadMap(self, mapFile)
         p = net.Packet()
         p.add(net.Uint8(constants.PACKET_CLIENTREADY))
-        net.context.broadcast(p)
+        net.context.broadcast(p, reliable=True)
 
     def endMatchCallback(self, iterator):
         self.entityGroup.resetMatch()
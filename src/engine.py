@@ -7,6 +7,7 @@ from random import uniform
 
 from . import ai
 from . import audio
+from . import collision
 from . import controllers
 from . import entities
 from . import net
@@ -54,6 +55,10 @@ physicsEntityFileCache = dict()
 paused = False
 enablePause = False
 modelFileSuffix = ""
+physicsRate = 60  # Physics steps per second
+physicsTimeStep = 1.0 / physicsRate
+maxPhysicsSteps = 5  # Most physics steps run in one frame. Any more time than that is dropped, so a slow frame can't snowball.
+physicsAlpha = 1.0  # How far the clock is between the last physics step and the next one, for interpolation
 
 map = None
 inputEnabled = True
@@ -500,6 +505,7 @@ class Map(DirectObject):
         self.ambientSound = None
         self.platforms = []
         self.name = ""
+        self.physicsSettings = []  # "physics" lines from the map file, to be saved back out
 
     def addSoundGroup(self, soundGroup):
         self.soundGroups[soundGroup.name] = soundGroup
@@ -552,6 +558,20 @@ class Map(DirectObject):
                 continue
             if tokens[0] == "world":
                 self.worldSize = float(tokens[1])
+            elif tokens[0] == "physics":
+                # physics space hash [min level] [max level], physics space quadtree [depth], physics space simple
+                # physics iterations [solver iterations per step]
+                self.physicsSettings.append(" ".join(tokens[1:]))
+                if tokens[1] == "space":
+                    if tokens[2] == "hash" and len(tokens) >= 5:
+                        aiWorld.setBroadphase("hash", levels=(int(tokens[3]), int(tokens[4])))
+                    elif tokens[2] == "quadtree":
+                        aiWorld.setBroadphase("quadtree", self.worldSize,
+                                              depth=int(tokens[3]) if len(tokens) >= 4 else None)
+                    else:
+                        aiWorld.setBroadphase(tokens[2])
+                elif tokens[1] == "iterations":
+                    aiWorld.setQuickStepIterations(int(tokens[2]))
             elif tokens[0] == "teams":
                 numTeams = sum([int(token) for token in tokens[1:]])
                 if net.netMode == constants.MODE_SERVER:
@@ -793,20 +813,6 @@ class Map(DirectObject):
                 pos = Vec3(float(tokens[2]), float(
                     tokens[3]), float(tokens[4]))
                 dock.setPosition(pos)
-                normal = Vec3(0, 0, 1)
-                queue = aiWorld.getCollisionQueue(
-                    Vec3(pos.getX(), pos.getY(), pos.getZ()), Vec3(0, 0, -1))
-                for i in range(queue.getNumEntries()):
-                    entry = queue.getEntry(i)
-                    if entityGroup.getEntityFromEntry(entry) is not None:
-                        continue
-                    normal = entry.getSurfaceNormal(render)
-                    break
-                dock.setRotation(Vec3(0,
-                                      math.degrees(-math.atan2(normal.getY(),
-                                                               normal.getZ())),
-                                      math.degrees(math.atan2(normal.getX(),
-                                                              normal.getZ()))))
                 aiWorld.docks.append(dock)
             elif tokens[0] == "physicsentity":
                 if net.netMode == constants.MODE_SERVER:
@@ -845,11 +851,29 @@ class Map(DirectObject):
                 scenery.reparentTo(renderLit)
                 self.sceneries[tokens[1]] = scenery
 
+        aiWorld.staticBVH = collision.loadStaticBVH(
+            [geom.collisionNodePath for geom in self.staticGeometries.values()], mapDirectory + "/" + self.name + ".bvh")
+        if aiWorld.staticBVH is not None:
+            log.info("Static BVH: %d triangles, %d nodes, built in %.3f seconds" % (
+                aiWorld.staticBVH.numTriangles, aiWorld.staticBVH.getNumNodes(), aiWorld.staticBVH.buildTime))
+
+        # Docks are listed before the geometry in map files, so they're aligned to the ground once it's all loaded.
+        for dock in aiWorld.docks:
+            normal = Vec3(0, 0, 1)
+            hit = aiWorld.getStaticCollision(dock.getPosition(), Vec3(0, 0, -1))
+            if hit is not None:
+                normal = hit[1]
+            dock.setRotation(Vec3(0,
+                                  math.degrees(-math.atan2(normal.getY(),
+                                                           normal.getZ())),
+                                  math.degrees(math.atan2(normal.getX(),
+                                                          normal.getZ()))))
+
         # Create winnar platforms
-        entry = aiWorld.getFirstCollision(Vec3(0, 0, 100), Vec3(0, 0, -1))
+        hit = aiWorld.getStaticCollision(Vec3(0, 0, 100), Vec3(0, 0, -1))
         height = 15
-        if entry is not None:
-            height = entry.getSurfacePoint(render).getZ() + 10.0
+        if hit is not None:
+            height = hit[0].getZ() + 10.0
         for i in range(numTeams):
             p = Platform(aiWorld.space)
             spacing = 7
@@ -865,6 +889,8 @@ class Map(DirectObject):
         "Saves a basic representation of the current game state (including environment resources) to a map file."
         mapFile = MapFile()
         mapFile.write("world " + str(self.worldSize) + "\n")
+        for setting in self.physicsSettings:
+            mapFile.write("physics " + setting + "\n")
         if aiWorld.navMesh is not None:
             mapFile.write("navmesh " + aiWorld.navMesh.filename + "\n")
         index = 0
@@ -1026,10 +1052,7 @@ class Map(DirectObject):
             pos = self.sceneries[sceneryFile].getPos(render)
             mapFile.write("scenery " + sceneryFile + " " + str(pos.getX()) +
                           " " + str(pos.getY()) + " " + str(pos.getZ()) + "\n")
-        for obj in (
-            entity for entity in list(entityGroup.entities.values()) if isinstance(
-                entity,
-                entities.PhysicsEntity)):
+        for obj in entityGroup.getEntitiesOfType(entities.PhysicsEntity):
             pos = obj.getPosition()
             hpr = obj.node.getHpr()
             mapFile.write("physicsentity " +
@@ -1047,10 +1070,7 @@ class Map(DirectObject):
                           " " +
                           str(hpr.getZ()) +
                           "\n")
-        for glass in (
-            entity for entity in list(entityGroup.entities.values()) if isinstance(
-                entity,
-                entities.Glass)):
+        for glass in entityGroup.getEntitiesOfType(entities.Glass):
             pos = glass.getPosition()
             hpr = glass.getRotation()
             mapFile.write("glass " +
@@ -1131,7 +1151,8 @@ class Map(DirectObject):
 
 
 class StaticGeometry(DirectObject):
-    "A StaticGeometry is a potentially invisible, immovable physics object, modeled as a trimesh."
+    """A StaticGeometry is a potentially invisible, immovable physics object, modeled as a trimesh.
+    If buildproxies.py has made a simplified collision proxy for the model, the trimesh and ray queries use that instead of the visible mesh."""
 
     def __init__(self, space, directory, filename=None):
         assert filename is not None
@@ -1139,11 +1160,20 @@ class StaticGeometry(DirectObject):
         self.node = loadModel(directory + "/" + self.filename)
         self.node.reparentTo(renderEnvironment)
         self.node.hide()
-        self.node.setCollideMask(BitMask32(1))
-        triMeshData = OdeTriMeshData(self.node, True)
+        proxyFilename = directory + "/" + collision.getProxyFilename(self.filename)
+        if os.path.exists(proxyFilename + ".egg") or os.path.exists(proxyFilename + ".bam"):
+            self.node.setCollideMask(BitMask32.allOff())
+            self.collisionNodePath = loadModel(proxyFilename)
+            self.collisionNodePath.reparentTo(self.node)
+            self.collisionNodePath.hide()
+        else:
+            self.collisionNodePath = self.node
+        self.collisionNodePath.setCollideMask(BitMask32(1))
+        triMeshData = OdeTriMeshData(self.collisionNodePath, True)
         self.geometry = OdeTriMeshGeom(space, triMeshData)
         self.geometry.setCollideBits(BitMask32(0x00000001))
-        self.geometry.setCategoryBits(BitMask32(0x00000001))
+        self.geometry.setCategoryBits(
+            BitMask32(constants.CATEGORY_ALL | constants.CATEGORY_STATIC))
         space.setSurfaceType(self.geometry, 0)
 
     def setPosition(self, pos):
@@ -1231,7 +1261,8 @@ class Platform(DirectObject):
         triMeshData = OdeTriMeshData(odeCollisionNode, True)
         self.geometry = OdeTriMeshGeom(space, triMeshData)
         self.geometry.setCollideBits(BitMask32(0x00000001))
-        self.geometry.setCategoryBits(BitMask32(0x00000001))
+        self.geometry.setCategoryBits(
+            BitMask32(constants.CATEGORY_ALL | constants.CATEGORY_STATIC))
         space.setSurfaceType(self.geometry, 0)
 
     def setPosition(self, pos):
@@ -1411,12 +1442,12 @@ class Light(object):
 
 
 def impulseToForce(fx, fy=None, fz=None):
-    "Converts an impulse to a force (either a vector or a scalar) by dividing by the timestep of the last ODE frame."
+    "Converts an impulse to a force (either a vector or a scalar) by dividing by the fixed physics timestep."
     if fy is not None and fz is not None:
         force = Vec3(fx, fy, fz)
-        return force / clock.timeStep
+        return force / physicsTimeStep
     else:
-        return fx / clock.timeStep
+        return fx / physicsTimeStep
 
 
 def frange(start, end=None, inc=None):
@@ -14,6 +14,123 @@ from panda3d.ode import *
 
 from direct.showbase.DirectObject import DirectObject
 
+entityCellSize = 16.0  # Width of a SpatialHash cell
+sleepLinearThreshold = 0.1  # Resting PhysicsEntities moving slower than this can go to sleep
+sleepAngularThreshold = 0.1  # Radians per second
+sleepTime = 1.0  # Seconds a PhysicsEntity must rest before ODE disables its body
+
+
+class SpatialHash:
+    """A uniform grid over the XY positions of ObjectEntities.
+    Positions are sampled when the hash is built, so it should be rebuilt every tick."""
+
+    def __init__(self, cellSize=entityCellSize):
+        self.cellSize = cellSize
+        self.cells = dict()  # (x, y) -> list of (entity, position)
+        self.minCell = (0, 0)
+        self.maxCell = (-1, -1)
+
+    def _getCell(self, pos):
+        return (int(math.floor(pos.getX() / self.cellSize)),
+                int(math.floor(pos.getY() / self.cellSize)))
+
+    def build(self, entities):
+        self.cells = dict()
+        cells = []
+        for entity in entities:
+            if isinstance(entity, ObjectEntity):
+                pos = entity.getPosition()
+                cell = self._getCell(pos)
+                self.cells.setdefault(cell, []).append((entity, pos))
+                cells.append(cell)
+        if len(cells) > 0:
+            self.minCell = (min(x[0] for x in cells), min(x[1] for x in cells))
+            self.maxCell = (max(x[0] for x in cells), max(x[1] for x in cells))
+        else:
+            self.minCell = (0, 0)
+            self.maxCell = (-1, -1)
+
+    def _matches(self, entity, entityType, enemiesOf, exclude):
+        if entityType is not None and not isinstance(entity, entityType):
+            return False
+        if entity is exclude:
+            return False
+        if enemiesOf is not None and enemiesOf.isAlly(entity.getTeam()):
+            return False
+        return True
+
+    def _getRing(self, center, ring):
+        "Yields the contents of the cells exactly ring cells away from center, on either axis."
+        cx, cy = center
+        for x in range(max(cx - ring, self.minCell[0]), min(cx + ring, self.maxCell[0]) + 1):
+            for y in range(max(cy - ring, self.minCell[1]), min(cy + ring, self.maxCell[1]) + 1):
+                if max(abs(x - cx), abs(y - cy)) == ring and (x, y) in self.cells:
+                    yield self.cells[(x, y)]
+
+    def getInRadius(
+            self,
+            pos,
+            radius,
+            entityType=None,
+            enemiesOf=None,
+            exclude=None):
+        """Returns a list of (entity, distance) for every entity within radius of pos.
+        Entities can be filtered by type, and to the enemies of a team."""
+        results = []
+        minX, minY = self._getCell(pos - Vec3(radius, radius, 0))
+        maxX, maxY = self._getCell(pos + Vec3(radius, radius, 0))
+        for x in range(max(minX, self.minCell[0]), min(maxX, self.maxCell[0]) + 1):
+            for y in range(max(minY, self.minCell[1]), min(maxY, self.maxCell[1]) + 1):
+                for entity, entityPos in self.cells.get((x, y), ()):
+                    distance = (entityPos - pos).length()
+                    if distance < radius and self._matches(
+                            entity, entityType, enemiesOf, exclude):
+                        results.append((entity, distance))
+        return results
+
+    def getKNearest(
+            self,
+            pos,
+            k,
+            entityType=None,
+            enemiesOf=None,
+            exclude=None,
+            filter=None):
+        """Returns a list of up to k (entity, distance) pairs, nearest first.
+        Searches outward one ring of cells at a time, and stops once no closer entity can remain.
+        filter is an optional function for any further tests."""
+        results = []
+        center = self._getCell(pos)
+        maxRing = max(abs(center[0] - self.minCell[0]), abs(center[0] - self.maxCell[0]),
+                      abs(center[1] - self.minCell[1]), abs(center[1] - self.maxCell[1]))
+        ring = 0
+        while ring <= maxRing:
+            for cell in self._getRing(center, ring):
+                for entity, entityPos in cell:
+                    if self._matches(entity, entityType, enemiesOf, exclude) and (
+                            filter is None or filter(entity)):
+                        results.append((entity, (entityPos - pos).length()))
+            results.sort(key=lambda x: x[1])
+            del results[k:]
+            # Anything in the next ring is at least this far away.
+            if len(results) == k and results[-1][1] <= ring * self.cellSize:
+                break
+            ring += 1
+        return results
+
+    def getNearest(
+            self,
+            pos,
+            entityType=None,
+            enemiesOf=None,
+            exclude=None,
+            filter=None):
+        results = self.getKNearest(
+            pos, 1, entityType, enemiesOf, exclude, filter)
+        if len(results) == 0:
+            return None
+        return results[0][0]
+
 
 class EntityGroup(DirectObject):
     """An entity group handles all the logistics of Entities and Impostors.
@@ -33,6 +150,12 @@ class EntityGroup(DirectObject):
         self.cameraShakeTime = 0.9
         self.manager = netManager
         self.teams = []
+        # Entities of the commonly searched types, keyed by entity. Values are unused.
+        # Each dict keeps the order entities were added in, like self.entities.
+        self.typedEntities = dict((x, dict()) for x in (
+            TeamEntity, ObjectEntity, Actor, BasicDroid, DropPod, PhysicsEntity, Fragment, Glass, Grenade, Molotov))
+        self.spatialHash = SpatialHash()
+        self.spatialHashTime = -1  # Clock time the spatial hash was built, or -1 if it's out of date
         EntityGroup.default = self
         TeamEntity.default = TeamEntity()
 
@@ -85,7 +208,64 @@ class EntityGroup(DirectObject):
         entity.active = True
         if isinstance(entity, ObjectEntity):
             entity.node.reparentTo(engine.renderObjects)
+            entity.body.setData(entity)  # Lets contact reports find the entity
+            self.spatialHashTime = -1
+        previous = self.entities.get(entity.getId())
+        if previous is not None and previous is not entity:
+            self._removeTypedEntity(previous)
         self.entities[entity.getId()] = entity
+        for entityType, typed in self.typedEntities.items():
+            if isinstance(entity, entityType):
+                typed[entity] = True
+
+    def _removeTypedEntity(self, entity):
+        for typed in self.typedEntities.values():
+            typed.pop(entity, None)
+
+    def getEntitiesOfType(self, entityType):
+        """Returns a list of the entities of the given type, in the order they were added.
+        The common types are indexed. Any other type falls back to a scan of every entity."""
+        if entityType in self.typedEntities:
+            return list(self.typedEntities[entityType])
+        return [x for x in list(self.entities.values())
+                if isinstance(x, entityType)]
+
+    def countEntitiesOfType(self, entityType):
+        if entityType in self.typedEntities:
+            return len(self.typedEntities[entityType])
+        return len(self.getEntitiesOfType(entityType))
+
+    def storeStepStates(self):
+        "Called before each physics step. Only the entities simulated here are interpolated. The rest follow network snapshots."
+        for entity in self.typedEntities[ObjectEntity]:
+            if entity.isLocal and not entity.isAsleep():
+                entity.storeStepState()
+
+    def applyStepForces(self):
+        "Called before each physics step, to apply the continuous forces controllers set this frame."
+        for entity in self.typedEntities[ObjectEntity]:
+            if entity.stepTorque is not None or entity.stepForce is not None:
+                entity.applyStepForces()
+
+    def clearStepForces(self):
+        "Called after the physics steps for a frame. Controllers set their forces again every frame."
+        for entity in self.typedEntities[ObjectEntity]:
+            entity.stepTorque = None
+            entity.stepForce = None
+
+    def getSleepCounts(self):
+        "Returns (awake, asleep): how many ObjectEntities are being simulated, and how many are at rest with their updates skipped."
+        objects = self.typedEntities[ObjectEntity]
+        asleep = sum(1 for entity in objects if entity.isAsleep())
+        return (len(objects) - asleep, asleep)
+
+    def getActors(self, alliesOf=None):
+        """Returns a list of Actors, optionally only those allied with the given team.
+        Actors find their team lazily, so teams are filtered here rather than indexed."""
+        if alliesOf is None:
+            return list(self.typedEntities[Actor])
+        return [x for x in self.typedEntities[Actor]
+                if x.getTeam().isAlly(alliesOf)]
 
     def removeEntity(self, entity):
         "Removes the ObjectEntity from the entity list. Also schedules the ObjectEntity's resources to be cleared, as soon as possible."
@@ -100,9 +280,12 @@ class EntityGroup(DirectObject):
         entity.setId(self.lastEntityId)
 
     def clearDeletedEntities(self):
+        if len(self.deletedEntities) > 0:
+            self.spatialHashTime = -1  # Don't hand out cleared entities from a hash built earlier this tick
         for entity in self.deletedEntities:
-            if entity.getId() in self.entities:
+            if self.entities.get(entity.getId()) is entity:
                 del self.entities[entity.getId()]
+                self._removeTypedEntity(entity)
             entity.clear(self)
         del self.deletedEntities[:]
 
@@ -115,24 +298,52 @@ class EntityGroup(DirectObject):
         if obj in self.graphicsObjects:
             self.graphicsObjects.remove(obj)
 
+    def getSpatialHash(self):
+        "Returns the SpatialHash of ObjectEntity positions, rebuilding it if it hasn't been built this tick."
+        if self.spatialHashTime != engine.clock.time:
+            self.spatialHash.build(self.getEntitiesOfType(ObjectEntity))
+            self.spatialHashTime = engine.clock.time
+        return self.spatialHash
+
+    def getEntitiesInRadius(
+            self,
+            pos,
+            radius,
+            entityType=None,
+            enemiesOf=None,
+            exclude=None):
+        "Returns a list of (entity, distance) for every ObjectEntity within radius of pos. See SpatialHash.getInRadius."
+        return self.getSpatialHash().getInRadius(
+            pos, radius, entityType, enemiesOf, exclude)
+
+    def getNearestEntities(
+            self,
+            pos,
+            k,
+            entityType=None,
+            enemiesOf=None,
+            exclude=None,
+            filter=None):
+        "Returns up to k (entity, distance) pairs, nearest first. See SpatialHash.getKNearest."
+        return self.getSpatialHash().getKNearest(
+            pos, k, entityType, enemiesOf, exclude, filter)
+
+    def getNearestEntity(
+            self,
+            pos,
+            entityType=None,
+            enemiesOf=None,
+            exclude=None,
+            filter=None):
+        return self.getSpatialHash().getNearest(
+            pos, entityType, enemiesOf, exclude, filter)
+
     def getNearestPhysicsEntity(self, pos):
-        closest = None
-        closestDist = 1000000
-        for entity in (x for x in list(self.entities.values())
-                       if isinstance(x, PhysicsEntity)):
-            dist = (entity.getPosition() - pos).length()
-            if dist < closestDist:
-                closest = entity
-                closestDist = dist
-        return closest
+        return self.getNearestEntity(pos, PhysicsEntity)
 
     def resetMatch(self):
-        for entity in (
-            x for x in list(self.entities.values()) if isinstance(
-                x,
-                Actor) or isinstance(
-                x,
-                Fragment)):
+        for entity in self.getEntitiesOfType(
+                Actor) + self.getEntitiesOfType(Fragment):
             entity.delete(self, killed=False, localDelete=False)
         self.clearDeletedEntities()
         for entity in list(self.entities.values()):
@@ -181,11 +392,9 @@ class EntityGroup(DirectObject):
                 size=6.0))
         particles.add(particles.ExplosionParticleGroup(position))
 
-        for entity in (entity for entity in list(self.entities.values(
-        )) if entity != sourceEntity and isinstance(entity, ObjectEntity)):
-            vector = entity.getPosition() - position
-            distance = vector.length()
-            if distance >= damageRadius or distance == 0:
+        for entity, distance in self.getEntitiesInRadius(
+                position, damageRadius, exclude=sourceEntity):
+            if distance == 0:
                 continue
             force2 = force * \
                 max(1 - (distance / damageRadius), 0) * entity.radius * 0.5
@@ -216,6 +425,7 @@ class EntityGroup(DirectObject):
 
     def delete(self):
         "Deletes all entities and particles in this group. IMPORTANT: you must delete the entity group BEFORE deleting the AI world."
+        engine.log.info("Entities: %d awake, %d asleep" % self.getSleepCounts())
         for obj in self.graphicsObjects:
             obj.delete(self)
         del self.graphicsObjects[:]
@@ -248,6 +458,10 @@ class Entity(DirectObject):
         "Useful for Entities that have health."
         pass
 
+    def isAsleep(self):
+        "Sleeping entities are at rest, and their controllers don't need updating."
+        return False
+
     def kill(self, aiWorld, entityGroup, localDelete=True):
         "Killing an ObjectEntity triggers a death animation. Deleting an entity just silently removes it."
         if self.active:
@@ -286,6 +500,10 @@ class ObjectEntity(Entity):
         self.node = None
         self.filename = ""
         self.radius = 0
+        self.stepPosition = None  # Body position before the last physics step
+        self.stepQuat = None
+        self.stepTorque = None  # Continuous torque from the controller, applied on every physics step
+        self.stepForce = None  # Continuous force, applied on every physics step
         if filename is not None:
             self.loadModel(filename)
 
@@ -304,6 +522,8 @@ class ObjectEntity(Entity):
         return self.body.getPosition()
 
     def setPosition(self, pos):
+        self.wake()
+        self.stepPosition = None  # Don't interpolate across a teleport
         self.node.setPos(pos)
         self.body.setPosition(pos)
 
@@ -314,7 +534,16 @@ class ObjectEntity(Entity):
     def getRotation(self):
         return self.node.getHpr()
 
+    def isAsleep(self):
+        return not self.body.isEnabled()
+
+    def wake(self):
+        "Re-enables a body that ODE has put to sleep. ODE wakes bodies on contact by itself, but not for forces or teleports."
+        if not self.body.isEnabled():
+            self.body.enable()
+
     def setLinearVelocity(self, vel):
+        self.wake()
         self.body.setLinearVel(vel)
 
     def getLinearVelocity(self):
@@ -334,23 +563,64 @@ class ObjectEntity(Entity):
         return self.body.getQuaternion()
 
     def addTorque(self, torque):
+        self.wake()
         self.body.addTorque(torque.getX(), torque.getY(), torque.getZ())
 
     def addForce(self, force):
+        self.wake()
         self.body.addForce(force)
 
+    def setStepTorque(self, torque):
+        """Sets a continuous torque, given as a force like addTorque takes. It's applied on every physics step until the next frame,
+        so it doesn't pile up or go missing when frames and physics steps don't line up. Use addTorque for one-off impulses."""
+        self.wake()
+        self.stepTorque = torque
+
+    def setStepForce(self, force):
+        """Sets a continuous force, applied on every physics step until the next frame, like setStepTorque.
+        Forces set on the same entity in the same frame add up, since more than one thing can be pulling on it. Use addForce for one-off impulses."""
+        self.wake()
+        if self.stepForce is None:
+            self.stepForce = Vec3(force)
+        else:
+            self.stepForce += force
+
+    def applyStepForces(self):
+        if self.stepTorque is not None:
+            self.body.addTorque(self.stepTorque.getX(), self.stepTorque.getY(), self.stepTorque.getZ())
+        if self.stepForce is not None:
+            self.body.addForce(self.stepForce.getX(), self.stepForce.getY(), self.stepForce.getZ())
+
     def addForceAtPosition(self, direction, position):
+        self.wake()
         self.body.addForceAtPos(direction.getX(), direction.getY(
         ), direction.getZ(), position.getX(), position.getY(), position.getZ())
 
+    def storeStepState(self):
+        "Remembers where the body is before a physics step, so commitChanges can interpolate between steps."
+        self.stepPosition = self.body.getPosition()
+        self.stepQuat = Quat(self.body.getQuaternion())
+
     def commitChanges(self):
-        "Updates the visual orientation and position of this ObjectEntity to reflect that of the ODE body."
-        self.node.setPosQuat(
-            engine.renderObjects, self.getPosition(), Quat(
-                self.body.getQuaternion()))
+        """Updates the visual orientation and position of this ObjectEntity to reflect that of the ODE body.
+        The physics runs at a fixed rate, so the node is placed between the last two physics steps, according to how far the clock is between them."""
+        pos = self.getPosition()
+        quat = Quat(self.body.getQuaternion())
+        alpha = engine.physicsAlpha
+        if self.stepPosition is not None and alpha < 1.0:
+            pos = self.stepPosition + (pos - self.stepPosition) * alpha
+            last = self.stepQuat
+            sign = -1.0 if last.dot(quat) < 0 else 1.0  # Take the short way around
+            quat = Quat(last[0] + (quat[0] * sign - last[0]) * alpha,
+                        last[1] + (quat[1] * sign - last[1]) * alpha,
+                        last[2] + (quat[2] * sign - last[2]) * alpha,
+                        last[3] + (quat[3] * sign - last[3]) * alpha)
+            quat.normalize()
+        self.node.setPosQuat(engine.renderObjects, pos, quat)
 
     def damage(self, entity, damage, ranged=True):
         "Useful for Entities that have health."
+        self.wake()
         Entity.damage(self, entity, damage, ranged)
 
     def kill(self, aiWorld, entityGroup, localDelete=True):
@@ -362,6 +632,7 @@ class ObjectEntity(Entity):
     def clear(self, entityGroup):
         """Clears all resources associated with this ObjectEntity."""
         Entity.clear(self, entityGroup)
+        self.body.setData(None)
         self.geometry.destroy()
         self.body.destroy()
         engine.deleteModel(self.node, self.filename)
@@ -387,7 +658,8 @@ class DropPod(ObjectEntity):
         self.collisionNode.addSolid(CollisionSphere(0, 0, 0, self.radius))
         self.geometry = OdeSphereGeom(space, self.radius)
         self.geometry.setCollideBits(BitMask32(0x00000001))
-        self.geometry.setCategoryBits(BitMask32(0x00000001))
+        self.geometry.setCategoryBits(
+            BitMask32(constants.CATEGORY_ALL | constants.CATEGORY_DROPPOD))
         self.body = OdeBody(world)
         mass = OdeMass()
         mass.setSphere(2, self.radius)
@@ -459,7 +731,8 @@ class Fragment(ObjectEntity):
         self.body.setMass(mass)
         self.geometry = OdeBoxGeom(space, size, size, 0.4)
         self.geometry.setCollideBits(BitMask32(0x00000001))
-        self.geometry.setCategoryBits(BitMask32(0x00000001))
+        self.geometry.setCategoryBits(
+            BitMask32(constants.CATEGORY_ALL | constants.CATEGORY_FRAGMENT))
         self.geometry.setBody(self.body)
         self.setPosition(pos)
         self.node.setHpr(uniform(0, 360), uniform(0, 360), uniform(0, 360))
@@ -485,7 +758,8 @@ class GlassFragment(Fragment):
         self.body.setMass(mass)
         self.geometry = OdeBoxGeom(space, size, size, 0.05)
         self.geometry.setCollideBits(BitMask32(0x00000001))
-        self.geometry.setCategoryBits(BitMask32(0x00000001))
+        self.geometry.setCategoryBits(
+            BitMask32(constants.CATEGORY_ALL | constants.CATEGORY_FRAGMENT))
         self.geometry.setBody(self.body)
         self.setPosition(pos)
         self.setRotation(
@@ -528,7 +802,8 @@ class Glass(ObjectEntity):
         self.collisionNodePath = self.node.attachNewNode(self.collisionNode)
         self.geometry = OdeBoxGeom(space, width, 0.5, height)
         self.geometry.setCollideBits(BitMask32(0x00000001))
-        self.geometry.setCategoryBits(BitMask32(0x00000001))
+        self.geometry.setCategoryBits(
+            BitMask32(constants.CATEGORY_ALL | constants.CATEGORY_GLASS))
         space.setSurfaceType(self.geometry, 1)
         self.shattered = False
         self.glassWidth = width
@@ -589,6 +864,12 @@ class PhysicsEntity(ObjectEntity):
         lines = data.split("\n")
         i = 0
         self.body = OdeBody(world)
+        # Blocks and balls spend most of a match at rest, so ODE can disable them until something touches them.
+        self.body.setAutoDisableFlag(True)
+        self.body.setAutoDisableLinearThreshold(sleepLinearThreshold)
+        self.body.setAutoDisableAngularThreshold(sleepAngularThreshold)
+        self.body.setAutoDisableTime(sleepTime)
+        self.body.setAutoDisableSteps(0)
         while i < len(lines):
             tokens = lines[i].split()
             if tokens[0] == "model" and self.node is None:
@@ -654,7 +935,8 @@ class PhysicsEntity(ObjectEntity):
                     self.collisionNode.addSolid(CollisionBox(point1, point2))
                     geom = OdeCylinderGeom(space, radius, length)
                 geom.setCollideBits(BitMask32(0x00000001))
-                geom.setCategoryBits(BitMask32(0x00000001))
+                geom.setCategoryBits(
+                    BitMask32(constants.CATEGORY_ALL | constants.CATEGORY_PHYSICSENTITY))
                 geom.setBody(self.body)
                 geom.setOffsetPosition(offsetx, offsety, offsetz)
                 space.setSurfaceType(geom, 1)
@@ -963,7 +1245,8 @@ class BasicDroid(Actor):
         self.body.setMass(mass)
         self.geometry = OdeSphereGeom(space, self.radius)
         self.geometry.setCollideBits(BitMask32(0x00000001))
-        self.geometry.setCategoryBits(BitMask32(0x00000001))
+        self.geometry.setCategoryBits(
+            BitMask32(constants.CATEGORY_ALL | constants.CATEGORY_ACTOR))
         self.geometry.setBody(self.body)
         space.setSurfaceType(self.geometry, 2)
         self.cloaked = False
@@ -1082,7 +1365,8 @@ class Grenade(ObjectEntity):
         self.body.setMass(mass)
         self.geometry = OdeSphereGeom(space, 0.2)
         self.geometry.setCollideBits(BitMask32(0x00000001))
-        self.geometry.setCategoryBits(BitMask32(0x00000001))
+        self.geometry.setCategoryBits(
+            BitMask32(constants.CATEGORY_ALL | constants.CATEGORY_PROJECTILE))
         self.geometry.setBody(self.body)
         space.setSurfaceType(self.geometry, 2)
         self.commitChanges()
@@ -1149,7 +1433,8 @@ class Molotov(ObjectEntity):
         self.body.setMass(mass)
         self.geometry = OdeSphereGeom(space, 0.2)
         self.geometry.setCollideBits(BitMask32(0x00000001))
-        self.geometry.setCategoryBits(BitMask32(0x00000001))
+        self.geometry.setCategoryBits(
+            BitMask32(constants.CATEGORY_ALL | constants.CATEGORY_PROJECTILE))
         self.geometry.setBody(self.body)
         space.setSurfaceType(self.geometry, 2)
         self.commitChanges()
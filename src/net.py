@@ -1,4 +1,8 @@
+import collections
+import random
 import socket
+import struct
+import threading
 import time
 import zlib
 import ipgetter
@@ -6,6 +10,7 @@ import ipgetter
 from . import constants
 
 from direct.distributed.PyDatagram import PyDatagram
+from direct.distributed.PyDatagramIterator import PyDatagramIterator
 
 netMode = 0
 
@@ -46,13 +51,162 @@ class NetworkContext:
         pass  # Clean up.
 
 
+reliableResendTime = 0.1  # Seconds before an unacknowledged reliable message is sent again
+maxReliableBytes = 600  # Reliable message data per datagram, after the first message
+maxDatagramSize = 1200  # Bytes per UDP datagram, under the 1280 byte minimum IPv6 MTU. Bigger datagrams are fragmented
+fragmentTimeout = 2.0  # Seconds to wait for the rest of a fragmented datagram
+threadedIO = True  # Send, receive, compress and decompress datagrams on background threads
+receiveQueueSize = 1024  # Most received datagrams waiting for readTick. The oldest are dropped after that
+sendQueueSize = 1024  # Most datagrams waiting for the write thread. The oldest are dropped after that
+
+
+class ReliableMessage:
+    __slots__ = ("id", "data", "lastSendTime")
+
+    def __init__(self, id, data):
+        self.id = id
+        self.data = data
+        self.lastSendTime = None
+
+
+class FragmentBuffer:
+    __slots__ = ("count", "time", "chunks")
+
+    def __init__(self, count, time):
+        self.count = count
+        self.time = time
+        self.chunks = dict()  # Fragment index -> data
+
+
 class Connection:
+    """Every datagram sent over a connection starts with a PACKET_SEQUENCED header. The header carries the sender's session ID, the datagram's sequence number,
+    the newest sequence received from the other end with a bit field for the 32 before it, and any reliable messages that are due.
+    Reliable messages are resent until a datagram carrying them is acknowledged, and are delivered in order.
+    The rest of the datagram is unreliable.
+    A new session ID from the same address means the other end reconnected and started counting again, so the sequence state is reset."""
 
     def __init__(self):
         self.address = ("", 0)
         self.lastPacketTime = time.time()
         self.lastSentPacketTime = 0
         self.ready = False
+        self.session = random.getrandbits(32)  # Identifies this end of the connection
+        self.remoteSession = None
+        self.previousSession = None  # Late datagrams from before a reconnect are dropped
+        self.resets = 0  # Times the other end reconnected without this connection timing out
+        self.resetSequences()
+
+    def resetSequences(self):
+        self.sequence = 0  # Sequence number of the last datagram sent
+        self.remoteSequence = None  # Newest datagram sequence received
+        self.remoteBits = 0  # Which of the 32 sequences before remoteSequence were received
+        self.sentDatagrams = dict()  # Sequence -> IDs of the reliable messages in the datagram
+        self.reliableQueue = []  # Unacknowledged outgoing ReliableMessages
+        self.nextReliableId = 0
+        self.nextReceiveId = 0
+        self.receiveBuffer = dict()  # Message ID -> data, for messages that arrived ahead of order
+        self.ackPending = False
+
+    def queueReliable(self, data):
+        self.reliableQueue.append(ReliableMessage(self.nextReliableId, data))
+        self.nextReliableId = (self.nextReliableId + 1) & 0xFFFF
+
+    def hasDueMessages(self, now):
+        return any(x.lastSendTime is None or now - x.lastSendTime >= reliableResendTime
+                   for x in self.reliableQueue)
+
+    def frame(self, payload, now):
+        """Returns a datagram with the connection header, the reliable messages that are due and the unreliable payload.
+        Also returns the number of reliable messages that were resent."""
+        self.sequence = (self.sequence + 1) & 0xFFFF
+        for sequence in [x for x in self.sentDatagrams.keys() if (
+                self.sequence - x) & 0xFFFF > 32]:
+            del self.sentDatagrams[sequence]
+        messages = []
+        size = 0
+        for message in self.reliableQueue:
+            if message.lastSendTime is not None and now - message.lastSendTime < reliableResendTime:
+                continue
+            if len(messages) > 0 and (size + len(message.data) > maxReliableBytes or len(messages) == 255):
+                break
+            messages.append(message)
+            size += len(message.data)
+        resent = len([x for x in messages if x.lastSendTime is not None])
+        data = PyDatagram()
+        data.addUint8(constants.PACKET_SEQUENCED)
+        data.addUint32(self.session)
+        data.addUint16(self.sequence)
+        data.addUint16(self.remoteSequence if self.remoteSequence is not None else 0)
+        data.addUint32(self.remoteBits)
+        data.addUint8(len(messages))
+        for message in messages:
+            data.addUint16(message.id)
+            data.addBlob(message.data)
+            message.lastSendTime = now
+        if len(messages) > 0:
+            self.sentDatagrams[self.sequence] = [x.id for x in messages]
+        data.appendData(payload)
+        self.ackPending = False
+        return data, resent
+
+    def unframe(self, iterator):
+        """Reads a PACKET_SEQUENCED datagram, after the packet code. Returns a list of (data, reliable) for the messages that can be delivered,
+        or None if the datagram is a duplicate."""
+        session = iterator.getUint32()
+        if session == self.previousSession:
+            return None
+        if session != self.remoteSession:
+            if self.remoteSession is not None:
+                # The other end reconnected. Its sequences and reliable message IDs start again,
+                # and the reliable messages queued for the old session are for a peer that's gone.
+                self.resetSequences()
+                self.resets += 1
+                self.previousSession = self.remoteSession
+            self.remoteSession = session
+        sequence = iterator.getUint16()
+        ack = iterator.getUint16()
+        ackBits = iterator.getUint32()
+        if self.remoteSequence is None:
+            self.remoteSequence = sequence
+        else:
+            age = (sequence - self.remoteSequence) & 0xFFFF
+            if age == 0:
+                return None
+            elif age < 0x8000:
+                self.remoteBits = ((self.remoteBits << age) | (
+                    1 << (age - 1))) & 0xFFFFFFFF
+                self.remoteSequence = sequence
+            else:
+                age = ((self.remoteSequence - sequence) & 0xFFFF) - 1
+                if age >= 32 or self.remoteBits & (1 << age):
+                    return None
+                self.remoteBits |= 1 << age
+
+        acked = set()
+        for i in range(33):
+            if i == 0 or ackBits & (1 << (i - 1)):
+                ids = self.sentDatagrams.pop((ack - i) & 0xFFFF, None)
+                if ids is not None:
+                    acked.update(ids)
+        if len(acked) > 0:
+            self.reliableQueue = [
+                x for x in self.reliableQueue if x.id not in acked]
+
+        messages = []
+        numMessages = iterator.getUint8()
+        if numMessages > 0:
+            self.ackPending = True
+        for _ in range(numMessages):
+            id = iterator.getUint16()
+            data = iterator.getBlob()
+            if (id - self.nextReceiveId) & 0xFFFF < 0x8000:
+                self.receiveBuffer[id] = data
+        while self.nextReceiveId in self.receiveBuffer:
+            messages.append((self.receiveBuffer.pop(self.nextReceiveId), True))
+            self.nextReceiveId = (self.nextReceiveId + 1) & 0xFFFF
+        if iterator.getRemainingSize() > 0:
+            messages.append((iterator.getRemainingBytes(), False))
+        return messages
 
 
 class PythonNetContext(NetworkContext):
@@ -68,7 +222,10 @@ class PythonNetContext(NetworkContext):
         self.publicAddress = ipgetter.myip()
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
-        self.socket.setblocking(False)
+        if threadedIO:
+            self.socket.settimeout(0.1)  # Lets the read thread notice when it's time to stop
+        else:
+            self.socket.setblocking(False)
         self.bindSocket(localPort)
         self.clientConnected = False
         self.activeConnections = dict()  # Server only - connected clients
@@ -80,11 +237,34 @@ class PythonNetContext(NetworkContext):
         self.clientUsername = "Unnamed"
         self.lastConnectionAttempt = 0
         self.connectionAttempts = 0
+        self.reliableMessages = 0
+        self.resentMessages = 0
+        self.duplicateDatagrams = 0
+        self.fragmentGroup = 0
+        self.fragmentBuffers = dict()  # (address, fragment group) -> FragmentBuffer
+        self.fragmentsSent = 0
+        self.fragmentsReceived = 0
+        self.fragmentsExpired = 0
+        # The read thread fills receiveQueue and readTick empties it. writeTick fills sendQueue and the write thread empties it.
+        # Appending to and popping from opposite ends of a deque is thread safe, so neither side has to wait for a lock.
+        self.receiveQueue = collections.deque(maxlen=receiveQueueSize)  # (message, address)
+        self.sendQueue = collections.deque(maxlen=sendQueueSize)  # (data, address)
+        self.sendEvent = threading.Event()
+        self.droppedDatagrams = 0
+        self.running = True
+        self.threads = []
+        if threadedIO:
+            for name, worker in (("net-read", self.readWorker), ("net-write", self.writeWorker)):
+                thread = threading.Thread(target=worker, name=name)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
 
     def connectToServer(self, arg, username):
         global netMode
         netMode = MODE_CLIENT
         self.mode = MODE_CLIENT
+        self.hostConnection = Connection()
         args = arg.split(":")
         ip = args[0]
         port = 1337
@@ -160,43 +340,170 @@ class PythonNetContext(NetworkContext):
         for connection in list(self.activeConnections.values()):
             connection.ready = False
 
+    def getConnection(self, address):
+        "Returns the Connection for the given address, or None if datagrams to it aren't sequenced (the lobby server, or clients that haven't connected)."
+        if address in self.activeConnections:
+            return self.activeConnections[address]
+        if self.mode == constants.MODE_CLIENT and address is not None and compareAddresses(
+                address, self.hostConnection.address):
+            return self.hostConnection
+        return None
+
+    def writeTo(self, address, data, reliable, now):
+        connection = self.getConnection(address)
+        if connection is None:
+            if data is not None:
+                self.queueSend(data, address)
+            return
+        if reliable:
+            connection.queueReliable(data)
+            self.reliableMessages += 1
+            data = b""
+        framed, resent = connection.frame(data if data is not None else b"", now)
+        self.resentMessages += resent
+        connection.lastSentPacketTime = now
+        self.queueSend(bytes(framed), address)
+
+    def queueSend(self, data, address):
+        if not threadedIO:
+            self.sendTo(data, address)
+            return
+        if len(self.sendQueue) == self.sendQueue.maxlen:
+            self.droppedDatagrams += 1
+        self.sendQueue.append((data, address))
+
+    def sendTo(self, data, address):
+        "Compresses and sends the data, in fragments if it doesn't fit in one datagram."
+        data = zlib.compress(data)
+        if len(data) <= maxDatagramSize:
+            self.sendRaw(data, address)
+            return
+        chunkSize = maxDatagramSize - 5  # Fragment header size
+        count = (len(data) + chunkSize - 1) // chunkSize
+        if count > 255:
+            return
+        self.fragmentGroup = (self.fragmentGroup + 1) & 0xFFFF
+        for i in range(count):
+            fragment = PyDatagram()
+            fragment.addUint8(constants.PACKET_FRAGMENT)
+            fragment.addUint16(self.fragmentGroup)
+            fragment.addUint8(i)
+            fragment.addUint8(count)
+            fragment.appendData(data[i * chunkSize:(i + 1) * chunkSize])
+            self.sendRaw(bytes(fragment), address)
+        self.fragmentsSent += count
+
+    def sendRaw(self, data, address):
+        try:
+            self.socket.sendto(data, address)
+        except socket.error:
+            pass
+
+    def addFragment(self, message, address, now):
+        "Buffers a fragment. Returns the compressed datagram once all its fragments are in, otherwise None."
+        iterator = PyDatagramIterator(PyDatagram(message))
+        try:
+            iterator.getUint8()
+            group = iterator.getUint16()
+            index = iterator.getUint8()
+            count = iterator.getUint8()
+        except AssertionError:
+            return None
+        if index >= count:
+            return None
+        self.fragmentsReceived += 1
+        key = (address, group)
+        buffer = self.fragmentBuffers.get(key)
+        if buffer is None or buffer.count != count:
+            buffer = FragmentBuffer(count, now)
+            self.fragmentBuffers[key] = buffer
+        buffer.chunks[index] = iterator.getRemainingBytes()
+        if len(buffer.chunks) < count:
+            return None
+        del self.fragmentBuffers[key]
+        return b"".join(buffer.chunks[i] for i in range(count))
+
+    def expireFragments(self, now):
+        for key, buffer in list(self.fragmentBuffers.items()):
+            if now - buffer.time > fragmentTimeout:
+                self.fragmentsExpired += len(buffer.chunks)
+                del self.fragmentBuffers[key]
+
+    def readWorker(self):
+        "Runs in a daemon thread. Receives datagrams, puts fragments back together and decompresses them for readTick."
+        lastExpiry = time.time()
+        while self.running:
+            try:
+                self.receive()
+            except socket.error:
+                pass  # Timed out, or the socket was closed
+            now = time.time()
+            if now - lastExpiry > 0.5:
+                self.expireFragments(now)
+                lastExpiry = now
+
+    def writeWorker(self):
+        "Runs in a daemon thread. Compresses and sends the datagrams queued by writeTick. Sends everything left in the queue before stopping."
+        while self.running or len(self.sendQueue) > 0:
+            self.sendEvent.wait(0.1)
+            self.sendEvent.clear()
+            self.flushSendQueue()
+
+    def flushSendQueue(self):
+        while True:
+            try:
+                data, address = self.sendQueue.popleft()
+            except IndexError:
+                return
+            self.sendTo(data, address)
+
+    def receive(self):
+        "Receives a datagram and queues it, decompressed, for readTick. Raises socket.error if there's nothing to receive."
+        message, address = self.socket.recvfrom(maxDatagramSize)
+        if not message:
+            return
+        if message[:1] == bytes([constants.PACKET_FRAGMENT]):
+            message = self.addFragment(message, address, time.time())
+            if message is None:
+                return
+        try:
+            message = zlib.decompress(message)
+        except zlib.error:
+            return
+        if len(self.receiveQueue) == self.receiveQueue.maxlen:
+            self.droppedDatagrams += 1
+        self.receiveQueue.append((message, address))
+
     def writeTick(self):
+        now = time.time()
         for data in self.writeQueue:
             # data[0] = action code. 0 for broadcast or broadcastExcept. 1 for send.
             # for broadcasting, the given connection is excluded, if one is given.
             # for sending, the given connection is the only one we send the
             # data to.
-            compressedData = zlib.compress(bytes(data[1]))
+            # data[3] is True for reliable data.
             if data[0] == 0:  # Broadcast
-                for c in (
-                        x for x in list(self.activeConnections.values()) if x.ready):
-                    c.lastSentPacketTime = time.time()
-                    try:
-                        self.socket.sendto(compressedData, c.address)
-                    except socket.error:
-                        pass
+                addresses = [x.address for x in list(
+                    self.activeConnections.values()) if x.ready]
             elif data[0] == 1:  # Send to specific machine
-                try:
-                    self.socket.sendto(compressedData, data[2])
-                except socket.error:
-                    pass
-                if data[2] in self.activeConnections:
-                    self.activeConnections[data[2]
-                                           ].lastSentPacketTime = time.time()
-                elif compareAddresses(data[2], self.hostConnection.address):
-                    self.hostConnection.lastSentPacketTime = time.time()
+                addresses = [data[2]]
             elif data[0] == 2:  # Broadcast, excluding one machine
-                for c in (
-                    x for x in list(self.activeConnections.values()) if x.ready and not compareAddresses(
-                        x.address,
-                        data[2])):
-                    try:
-                        self.socket.sendto(compressedData, c.address)
-                    except socket.error:
-                        pass
-                    c.lastSentPacketTime = time.time()
+                addresses = [x.address for x in list(self.activeConnections.values(
+                )) if x.ready and not compareAddresses(x.address, data[2])]
+            for address in addresses:
+                self.writeTo(address, bytes(data[1]), data[3], now)
         del self.writeQueue[:]
 
+        # Acknowledge reliable messages, and resend lost ones, even if there's nothing else to send.
+        connections = list(self.activeConnections.values())
+        if self.mode == constants.MODE_CLIENT:
+            connections.append(self.hostConnection)
+        for connection in connections:
+            if connection.ackPending or connection.hasDueMessages(now):
+                self.writeTo(connection.address, None, False, now)
+        if threadedIO:
+            self.sendEvent.set()
+
     def readTick(self):
         if self.mode == constants.MODE_SERVER:
             loadingTimeout = self.connectionTimeout * 2
@@ -222,94 +529,127 @@ class PythonNetContext(NetworkContext):
                     self.connectionAttempts = 0
                     self.disconnectCallback(self.hostConnection.address)
 
+        if not threadedIO:
+            while True:
+                try:
+                    self.receive()
+                except socket.error:
+                    break
+            self.expireFragments(time.time())
+
         readQueue = []
         while True:
             try:
-                message, address = self.socket.recvfrom(1024)
-            except socket.error:
+                message, address = self.receiveQueue.popleft()
+            except IndexError:
                 return readQueue
-            
-            if not message:
-                continue
-            
+
+            if message[:1] == bytes([constants.PACKET_SEQUENCED]):
+                connection = self.getConnection(address)
+                iterator = PyDatagramIterator(PyDatagram(message))
+                iterator.getUint8()
+                try:
+                    if connection is None:
+                        # Reliable messages are resent once there is a connection to keep them in order.
+                        messages = [x for x in Connection().unframe(
+                            iterator) if not x[1]]
+                    else:
+                        messages = connection.unframe(iterator)
+                except AssertionError:
+                    continue
+                if messages is None:
+                    self.duplicateDatagrams += 1
+                    continue
+            else:
+                messages = [(message, False)]
+
+            # Only accepted datagrams keep a connection alive.
             if address in self.activeConnections:
                 self.activeConnections[address].lastPacketTime = time.time()
-            
-            try:
-                message = zlib.decompress(message)
-            except zlib.error:
-                continue
-            
-            iterator = PyDatagram(message)
-            if not iterator.getRemainingSize():
-                continue
-            
-            code = Uint8.getFrom(iterator)
-            if code == constants.PACKET_HOSTLIST:
-                numHosts = Uint16.getFrom(iterator)
-                hosts = []
-                for _ in range(numHosts):
-                    ip = String.getFrom(iterator)
-                    port = Uint16.getFrom(iterator)
-                    user = String.getFrom(iterator)
-                    map = String.getFrom(iterator)
-                    activePlayers = Uint8.getFrom(iterator)
-                    playerSlots = Uint8.getFrom(iterator)
-                    hosts.append((user, map, ip + ":" + str(port),
-                                  activePlayers, playerSlots))
-                #engine.log.debug("Received " + str(numHosts) + " hosts from lobby server.")
-                if self.hostListCallback is not None:
-                    self.hostListCallback(hosts)
-            if self.mode == constants.MODE_SERVER:
-                if code == constants.PACKET_NEWCLIENTNOTIFICATION:
-                    ip = String.getFrom(iterator)
-                    port = Uint16.getFrom(iterator)
-                    clientAddress = (ip, port)
-                    self.connectionAttempts = 0
-                    #engine.log.info("Received notification from lobby server of new client " + ip + ":" + str(port))
-                    self.serverConnect(clientAddress)
-                elif code == constants.PACKET_DISCONNECT:
-                    if address in self.activeConnections:
-                        del self.activeConnections[address]
-                elif code == constants.PACKET_CLIENTREADY:
-                    if address in self.activeConnections:
-                        self.activeConnections[address].ready = True
-            elif self.mode == MODE_CLIENT and address == self.hostConnection.address:
-                self.hostConnection.lastPacketTime = time.time()
-            readQueue.append((message, address))
-        return readQueue
-
-    def broadcastDatagram(self, datagram):
+
+            for message, reliable in messages:
+                self.readMessage(message, address, reliable, readQueue)
+
+    def readMessage(self, message, address, reliable, readQueue):
+        "Handles the connection level packet codes in a message, then adds it to the read queue."
+        iterator = PyDatagram(message)
+        if not iterator.getRemainingSize():
+            return
+        
+        code = Uint8.getFrom(iterator)
+        if code == constants.PACKET_HOSTLIST:
+            numHosts = Uint16.getFrom(iterator)
+            hosts = []
+            for _ in range(numHosts):
+                ip = String.getFrom(iterator)
+                port = Uint16.getFrom(iterator)
+                user = String.getFrom(iterator)
+                map = String.getFrom(iterator)
+                activePlayers = Uint8.getFrom(iterator)
+                playerSlots = Uint8.getFrom(iterator)
+                hosts.append((user, map, ip + ":" + str(port),
+                              activePlayers, playerSlots))
+            #engine.log.debug("Received " + str(numHosts) + " hosts from lobby server.")
+            if self.hostListCallback is not None:
+                self.hostListCallback(hosts)
+        if self.mode == constants.MODE_SERVER:
+            if code == constants.PACKET_NEWCLIENTNOTIFICATION:
+                ip = String.getFrom(iterator)
+                port = Uint16.getFrom(iterator)
+                clientAddress = (ip, port)
+                self.connectionAttempts = 0
+                #engine.log.info("Received notification from lobby server of new client " + ip + ":" + str(port))
+                self.serverConnect(clientAddress)
+            elif code == constants.PACKET_DISCONNECT:
+                if address in self.activeConnections:
+                    del self.activeConnections[address]
+            elif code == constants.PACKET_CLIENTREADY:
+                if address in self.activeConnections:
+                    self.activeConnections[address].ready = True
+        elif self.mode == MODE_CLIENT and address == self.hostConnection.address:
+            self.hostConnection.lastPacketTime = time.time()
+        readQueue.append((message, address, reliable))
+
+    def broadcastDatagram(self, datagram, reliable=False):
         """For the server, broadcasts the given data packet to all connected clients.
-        For clients, sends the datagram to the server."""
+        For clients, sends the datagram to the server.
+        Reliable data is resent until it's acknowledged, and arrives in order with the other reliable data."""
         if netMode == constants.MODE_SERVER:
-            self.writeQueue.append((0, datagram, None))  # Send to all clients
+            self.writeQueue.append((0, datagram, None, reliable))  # Send to all clients
         else:
             self.writeQueue.append(
-                (1, datagram, self.hostConnection.address))  # Send to host
+                (1, datagram, self.hostConnection.address, reliable))  # Send to host
 
-    def broadcastDatagramExcept(self, datagram, client):
+    def broadcastDatagramExcept(self, datagram, client, reliable=False):
         """For the server, broadcasts the given data packet to all connected clients.
         For clients, sends the datagram to the server."""
-        self.writeQueue.append((2, datagram, client))
+        self.writeQueue.append((2, datagram, client, reliable))
 
-    def sendDatagram(self, datagram, client=None):
-        self.writeQueue.append((1, datagram, client))
+    def sendDatagram(self, datagram, client=None, reliable=False):
+        self.writeQueue.append((1, datagram, client, reliable))
 
-    def broadcast(self, packet):
+    def broadcast(self, packet, reliable=False):
         d = PyDatagram()
         packet.addTo(d)
-        self.broadcastDatagram(d)
+        self.broadcastDatagram(d, reliable)
 
-    def broadcastExcept(self, packet, client):
+    def broadcastExcept(self, packet, client, reliable=False):
         d = PyDatagram()
         packet.addTo(d)
-        self.broadcastDatagramExcept(d, client)
+        self.broadcastDatagramExcept(d, client, reliable)
 
-    def send(self, packet, client=None):
+    def send(self, packet, client=None, reliable=False):
         d = PyDatagram()
         packet.addTo(d)
-        self.sendDatagram(d, client)
+        self.sendDatagram(d, client, reliable)
+
+    def getStats(self):
+        connections = list(self.activeConnections.values()) + [self.hostConnection]
+        waiting = sum(len(x.reliableQueue) for x in connections)
+        resets = sum(x.resets for x in connections)
+        return "%d reliable messages sent, %d resent, %d waiting for acknowledgement. %d duplicate datagrams dropped. %d connections reset by a reconnect. %d fragments sent, %d received, %d expired. %d datagrams dropped from full queues" % (
+            self.reliableMessages, self.resentMessages, waiting, self.duplicateDatagrams, resets,
+            self.fragmentsSent, self.fragmentsReceived, self.fragmentsExpired, self.droppedDatagrams)
 
     def delete(self):
         p = Packet()
@@ -319,6 +659,10 @@ class PythonNetContext(NetworkContext):
         self.broadcastDatagram(data)
         self.writeTick()
         time.sleep(0.25)
+        self.running = False
+        self.sendEvent.set()
+        for thread in self.threads:
+            thread.join(1.0)
         self.socket.close()
 
 
@@ -370,7 +714,7 @@ def isValidIp(addressString):
 class Packet:
 
     def __init__(self):
-        self.dataObjects = []
+        self.dataObjects = []  # NetObjects, Packets, and bytearrays of fields written with Schemas
 
     def getSize(self):
         return len(self.dataObjects)
@@ -380,9 +724,19 @@ class Packet:
         if dataObject is not None:
             self.dataObjects.append(dataObject)
 
+    def write(self, schema, *values):
+        "Packs the values straight into the packet with a Schema, without allocating a NetObject for each field."
+        if len(self.dataObjects) == 0 or not isinstance(
+                self.dataObjects[-1], bytearray):
+            self.dataObjects.append(bytearray())
+        schema.write(self.dataObjects[-1], *values)
+
     def addTo(self, datagram):
         for dataObject in self.dataObjects:
-            dataObject.addTo(datagram)
+            if isinstance(dataObject, bytearray):
+                datagram.appendData(bytes(dataObject))
+            else:
+                dataObject.addTo(datagram)
 
 
 def clamp(a, min, max):
@@ -397,6 +751,10 @@ def clamp(a, min, max):
 
 class NetObject:
     data = None
+    format = None  # struct format character, for fixed size objects that can go in a Schema
+    encoding = "{0}"  # Expression turning a value into what gets packed
+    decoding = "{0}"  # Expression turning what gets unpacked back into a value
+    components = None  # Fixed size objects made of several fields, like vectors, list the field types here
 
     def __init__(self, data):
         self.data = data
@@ -410,6 +768,8 @@ class NetObject:
 
 
 class HighResFloat(NetObject):
+    format = "f"
+    encoding = "float({0})"
 
     def addTo(self, datagram):
         datagram.addFloat32(float(self.data))
@@ -420,6 +780,9 @@ class HighResFloat(NetObject):
 
 
 class StandardFloat(NetObject):
+    format = "h"
+    encoding = "clamp(int({0} * 110.0), -32768, 32767)"
+    decoding = "float({0}) / 110.0"
 
     def addTo(self, datagram):
         datagram.addInt16(clamp(int(self.data * 110.0), -32768, 32767))
@@ -430,6 +793,9 @@ class StandardFloat(NetObject):
 
 
 class LowResFloat(NetObject):
+    format = "h"
+    encoding = "clamp(int({0} * 50.0), -32768, 32767)"
+    decoding = "float({0}) / 50.0"
 
     def addTo(self, datagram):
         datagram.addInt16(clamp(int(self.data * 50.0), -32768, 32767))
@@ -440,6 +806,9 @@ class LowResFloat(NetObject):
 
 
 class SmallFloat(NetObject):
+    format = "b"
+    encoding = "clamp(int({0} * (127.0 / 35.0)), -128, 127)"
+    decoding = "float({0}) * (35.0 / 127.0)"
 
     def addTo(self, datagram):
         datagram.addInt8(clamp(int(self.data * (127.0 / 35.0)), -128, 127))
@@ -450,6 +819,8 @@ class SmallFloat(NetObject):
 
 
 class Uint8(NetObject):
+    format = "B"
+    encoding = "int({0})"
 
     def addTo(self, datagram):
         datagram.addUint8(int(self.data))
@@ -460,6 +831,8 @@ class Uint8(NetObject):
 
 
 class Uint16(NetObject):
+    format = "H"
+    encoding = "int({0})"
 
     def addTo(self, datagram):
         datagram.addUint16(int(self.data))
@@ -470,6 +843,8 @@ class Uint16(NetObject):
 
 
 class Uint32(NetObject):
+    format = "I"
+    encoding = "int({0})"
 
     def addTo(self, datagram):
         datagram.addUint32(int(self.data))
@@ -479,7 +854,21 @@ class Uint32(NetObject):
         return iterator.getUint32()
 
 
+class Int8(NetObject):
+    format = "b"
+    encoding = "int({0})"
+
+    def addTo(self, datagram):
+        datagram.addInt8(int(self.data))
+
+    @staticmethod
+    def getFrom(iterator):
+        return iterator.getInt8()
+
+
 class Int16(NetObject):
+    format = "h"
+    encoding = "int({0})"
 
     def addTo(self, datagram):
         datagram.addInt16(int(self.data))
@@ -500,6 +889,8 @@ class String(NetObject):
 
 
 class Boolean(NetObject):
+    format = "?"
+    encoding = "bool({0})"
 
     def addTo(self, datagram):
         datagram.addBool(bool(self.data))
@@ -507,3 +898,87 @@ class Boolean(NetObject):
     @staticmethod
     def getFrom(iterator):
         return iterator.getBool()
+
+
+class Composite(NetObject):
+    """A fixed group of fields, like a vector. Subclasses list the field types in components,
+    the methods that read each field from a value in accessors, and the type that builds a value from the fields in make."""
+    components = ()
+    accessors = ()
+    make = None
+
+    def addTo(self, datagram):
+        type(self).getSchema().addTo(datagram, self.data)
+
+    @classmethod
+    def getFrom(cls, iterator):
+        return cls.getSchema().getFrom(iterator)[0]
+
+    @classmethod
+    def getSchema(cls):
+        if "schema" not in cls.__dict__:
+            cls.schema = Schema(cls)
+        return cls.schema
+
+
+class Schema:
+    """A message layout, compiled to a single struct.Struct. Fields are any NetObject types with a format, including Composites.
+    Writing a message packs every field in one call, instead of allocating and walking a NetObject for each one.
+    The bytes are the same as the NetObjects would write, so either side of a connection can use either."""
+
+    def __init__(self, *types):
+        self.types = types
+        formats = []
+        arguments = []
+        encodings = []
+        decodings = []
+        namespace = dict(clamp=clamp)
+        field = 0
+        for i in range(len(types)):
+            type = types[i]
+            argument = "a%d" % i
+            arguments.append(argument)
+            if type.components is None:
+                assert type.format is not None, "%s isn't a fixed size field" % type.__name__
+                formats.append(type.format)
+                encodings.append(type.encoding.format(argument))
+                decodings.append(type.decoding.format("r[%d]" % field))
+                field += 1
+            else:
+                parts = []
+                for component, accessor in zip(type.components, type.accessors):
+                    formats.append(component.format)
+                    encodings.append(component.encoding.format(
+                        "%s.%s()" % (argument, accessor)))
+                    parts.append(component.decoding.format("r[%d]" % field))
+                    field += 1
+                namespace["make%d" % i] = type.make
+                decodings.append("make%d(%s)" % (i, ", ".join(parts)))
+        self.struct = struct.Struct("<" + "".join(formats))
+        self.size = self.struct.size
+        namespace["structPack"] = self.struct.pack
+        namespace["structPackInto"] = self.struct.pack_into
+        namespace["structUnpack"] = self.struct.unpack
+        namespace["blank"] = bytes(self.size)
+        arguments = ", ".join(arguments)
+        encodings = ", ".join(encodings)
+        source = ("def pack(%s):\n"
+                  "    return structPack(%s)\n"
+                  "def write(buffer, %s):\n"
+                  "    offset = len(buffer)\n"
+                  "    buffer.extend(blank)\n"
+                  "    structPackInto(buffer, offset, %s)\n"
+                  "def read(data):\n"
+                  "    r = structUnpack(data)\n"
+                  "    return (%s,)\n") % (arguments, encodings, arguments, encodings, ", ".join(decodings))
+        exec(compile(source, "<schema %s>" % ", ".join(x.__name__ for x in types), "exec"), namespace)
+        self.pack = namespace["pack"]  # pack(*values) - returns the message as bytes
+        self.write = namespace["write"]  # write(buffer, *values) - appends the message to a bytearray
+        self.read = namespace["read"]  # read(data) - returns a tuple of values from bytes
+
+    def addTo(self, datagram, *values):
+        datagram.appendData(self.pack(*values))
+
+    def getFrom(self, iterator):
+        "Returns a tuple of the values in the next message."
+        return self.read(iterator.extractBytes(self.size))
@@ -10,117 +10,47 @@ from direct.distributed.PyDatagramIterator import PyDatagramIterator
 from direct.showbase.DirectObject import DirectObject
 
 
-class HighResVec3(net.NetObject):
+class HighResVec3(net.Composite):
+    components = (net.HighResFloat, net.HighResFloat, net.HighResFloat)
+    accessors = ("getX", "getY", "getZ")
+    make = Vec3
 
-    def addTo(self, datagram):
-        x = net.HighResFloat(self.data.getX())
-        y = net.HighResFloat(self.data.getY())
-        z = net.HighResFloat(self.data.getZ())
-        x.addTo(datagram)
-        y.addTo(datagram)
-        z.addTo(datagram)
 
-    @staticmethod
-    def getFrom(iterator):
-        return Vec3(
-            net.HighResFloat.getFrom(iterator),
-            net.HighResFloat.getFrom(iterator),
-            net.HighResFloat.getFrom(iterator))
+class StandardVec3(net.Composite):
+    components = (net.StandardFloat, net.StandardFloat, net.StandardFloat)
+    accessors = ("getX", "getY", "getZ")
+    make = Vec3
 
 
-class StandardVec3(net.NetObject):
+class StandardQuat(net.Composite):
+    components = (net.StandardFloat, net.StandardFloat,
+                  net.StandardFloat, net.StandardFloat)
+    accessors = ("getX", "getY", "getZ", "getW")
+    make = Quat
 
-    def addTo(self, datagram):
-        x = net.StandardFloat(self.data.getX())
-        y = net.StandardFloat(self.data.getY())
-        z = net.StandardFloat(self.data.getZ())
-        x.addTo(datagram)
-        y.addTo(datagram)
-        z.addTo(datagram)
 
-    @staticmethod
-    def getFrom(iterator):
-        return Vec3(
-            net.StandardFloat.getFrom(iterator),
-            net.StandardFloat.getFrom(iterator),
-            net.StandardFloat.getFrom(iterator))
+class HighResVec4(net.Composite):
+    components = (net.HighResFloat, net.HighResFloat,
+                  net.HighResFloat, net.HighResFloat)
+    accessors = ("getX", "getY", "getZ", "getW")
+    make = Vec4
 
 
-class StandardQuat(net.NetObject):
+class LowResVec3(net.Composite):
+    components = (net.LowResFloat, net.LowResFloat, net.LowResFloat)
+    accessors = ("getX", "getY", "getZ")
+    make = Vec3
 
-    def addTo(self, datagram):
-        x = net.StandardFloat(self.data.getX())
-        y = net.StandardFloat(self.data.getY())
-        z = net.StandardFloat(self.data.getZ())
-        w = net.StandardFloat(self.data.getW())
-        x.addTo(datagram)
-        y.addTo(datagram)
-        z.addTo(datagram)
-        w.addTo(datagram)
 
-    @staticmethod
-    def getFrom(iterator):
-        return Quat(
-            net.StandardFloat.getFrom(iterator),
-            net.StandardFloat.getFrom(iterator),
-            net.StandardFloat.getFrom(iterator),
-            net.StandardFloat.getFrom(iterator))
+class SmallVec3(net.Composite):
+    components = (net.SmallFloat, net.SmallFloat, net.SmallFloat)
+    accessors = ("getX", "getY", "getZ")
+    make = Vec3
 
 
-class HighResVec4(net.NetObject):
-    def addTo(self, datagram):
-        x = net.HighResFloat(self.data.getX())
-        y = net.HighResFloat(self.data.getY())
-        z = net.HighResFloat(self.data.getZ())
-        w = net.HighResFloat(self.data.getW())
-        x.addTo(datagram)
-        y.addTo(datagram)
-        z.addTo(datagram)
-        w.addTo(datagram)
-
-    @staticmethod
-    def getFrom(iterator):
-        return Vec4(
-            net.HighResFloat.getFrom(iterator),
-            net.HighResFloat.getFrom(iterator),
-            net.HighResFloat.getFrom(iterator),
-            net.HighResFloat.getFrom(iterator))
-
-
-class LowResVec3(net.NetObject):
-
-    def addTo(self, datagram):
-        x = net.LowResFloat(self.data.getX())
-        y = net.LowResFloat(self.data.getY())
-        z = net.LowResFloat(self.data.getZ())
-        x.addTo(datagram)
-        y.addTo(datagram)
-        z.addTo(datagram)
-
-    @staticmethod
-    def getFrom(iterator):
-        return Vec3(
-            net.LowResFloat.getFrom(iterator),
-            net.LowResFloat.getFrom(iterator),
-            net.LowResFloat.getFrom(iterator))
-
-
-class SmallVec3(net.NetObject):
-
-    def addTo(self, datagram):
-        x = net.SmallFloat(self.data.getX())
-        y = net.SmallFloat(self.data.getY())
-        z = net.SmallFloat(self.data.getZ())
-        x.addTo(datagram)
-        y.addTo(datagram)
-        z.addTo(datagram)
-
-    @staticmethod
-    def getFrom(iterator):
-        return Vec3(
-            net.SmallFloat.getFrom(iterator),
-            net.SmallFloat.getFrom(iterator),
-            net.SmallFloat.getFrom(iterator))
+snapshotSchema = net.Schema(HighResVec3, StandardQuat)
+deltaHeaderSchema = net.Schema(net.Uint8, net.Uint8, net.Uint8)  # Encoding, baseline age, changed fields
+snapshotAckSchema = net.Schema(net.Uint8, net.Uint16, net.Uint32)
 
 
 class EntitySnapshot(net.NetObject):
@@ -138,16 +68,12 @@ class EntitySnapshot(net.NetObject):
         self.empty = False
 
     def addTo(self, datagram):
-        pos = HighResVec3(self.pos)
-        quat = StandardQuat(self.quat)
-        pos.addTo(datagram)
-        quat.addTo(datagram)
+        snapshotSchema.addTo(datagram, self.pos, self.quat)
 
     @staticmethod
     def getFrom(iterator):
         es = EntitySnapshot()
-        es.pos = HighResVec3.getFrom(iterator)
-        es.quat = StandardQuat.getFrom(iterator)
+        es.pos, es.quat = snapshotSchema.getFrom(iterator)
         es.time = engine.clock.time
         es.empty = False
         return es
@@ -175,21 +101,307 @@ class EntitySnapshot(net.NetObject):
             snapshot.pos, 0.2)
 
 
+snapshotPositionScale = 512.0  # Delta encoded positions are sent in steps of 1/512 units
+snapshotQuatScale = 110.0  # Same steps as net.StandardFloat
+snapshotWindow = 32  # Server sequences a baseline stays usable for
+# Snapshot encodings. The first two match the Boolean that used to come before a snapshot,
+# so full snapshots written by clients read the same way.
+SNAPSHOT_NONE = 0
+SNAPSHOT_FULL = 1
+SNAPSHOT_DELTA = 2
+SNAPSHOT_FULL_SIZE = snapshotSchema.size  # Bytes in a full snapshot (HighResVec3 + StandardQuat)
+
+
+def getSnapshotState(snapshot, received=False):
+    """Returns the integer state both ends keep as a baseline. Quaternions are truncated the same way net.StandardFloat does it.
+    Received quaternions have already been truncated, so they are rounded back to the step they were sent as."""
+    quantize = round if received else int
+    return (int(round(snapshot.pos.getX() * snapshotPositionScale)),
+            int(round(snapshot.pos.getY() * snapshotPositionScale)),
+            int(round(snapshot.pos.getZ() * snapshotPositionScale)),
+            net.clamp(int(quantize(snapshot.quat.getX() * snapshotQuatScale)), -32768, 32767),
+            net.clamp(int(quantize(snapshot.quat.getY() * snapshotQuatScale)), -32768, 32767),
+            net.clamp(int(quantize(snapshot.quat.getZ() * snapshotQuatScale)), -32768, 32767),
+            net.clamp(int(quantize(snapshot.quat.getW() * snapshotQuatScale)), -32768, 32767))
+
+
+def getSequenceAge(sequence, older):
+    return (sequence - older) & 0xFFFF
+
+
+class ClientBaselines:
+    "Server side record of the entity states sent to one client, and the newest state the client has acknowledged for each entity."
+
+    def __init__(self):
+        self.sequence = 0
+        self.sent = dict()  # Sequence -> {entity ID: state}
+        self.acked = dict()  # Entity ID -> (sequence, state)
+
+    def nextSequence(self):
+        self.sequence = (self.sequence + 1) & 0xFFFF
+        for sequence in [x for x in self.sent.keys() if getSequenceAge(
+                self.sequence, x) > snapshotWindow]:
+            del self.sent[sequence]
+        # Old baselines have to go too. Once the sequence wraps, their age would land back inside the window.
+        for id in [x for x, baseline in self.acked.items() if getSequenceAge(
+                self.sequence, baseline[0]) > snapshotWindow]:
+            del self.acked[id]
+        return self.sequence
+
+    def getBaseline(self, id):
+        baseline = self.acked.get(id)
+        if baseline is not None and 0 < getSequenceAge(
+                self.sequence, baseline[0]) <= snapshotWindow:
+            return baseline
+        return None
+
+    def record(self, id, state):
+        self.sent.setdefault(self.sequence, dict())[id] = state
+
+    def acknowledge(self, sequence):
+        states = self.sent.pop(sequence, None)
+        if states is None:
+            return
+        age = getSequenceAge(self.sequence, sequence)
+        for id, state in states.items():
+            baseline = self.acked.get(id)
+            if baseline is None or getSequenceAge(
+                    self.sequence, baseline[0]) > age:
+                self.acked[id] = (sequence, state)
+
+
+class SnapshotBaselines:
+    """Delta encodes entity snapshots against the newest state each client has acknowledged.
+    The server numbers the packets it sends each client, and clients acknowledge the numbers they decoded in full.
+    Entities without a usable baseline, because the client is new or has been dropping packets, get a full snapshot."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.clients = dict()  # Server only - client address -> ClientBaselines
+        self.recipient = None  # Server only - the ClientBaselines a packet is being written for
+        self.decoded = dict()  # Client only - sequence -> {entity ID: state}
+        self.latestSequence = None
+        self.readSequence = None  # Client only - sequence of the packet being read
+        self.readStates = dict()
+        self.readFailed = False
+        self.ackPending = False
+        self.fullSnapshots = 0
+        self.deltaSnapshots = 0
+        self.snapshotBytes = 0
+        self.writingReliable = False  # Reliable copies leave snapshots and other state out, since a resent one would arrive stale
+        self.writingEvents = True  # Unreliable copies of critical updates leave events out, since the reliable copy carries them
+
+    def removeClient(self, address):
+        if address in self.clients:
+            del self.clients[address]
+
+    def beginSnapshot(self, address):
+        "Starts writing a packet for the given client. Returns the packet's sequence number."
+        if address not in self.clients:
+            self.clients[address] = ClientBaselines()
+        self.recipient = self.clients[address]
+        return self.recipient.nextSequence()
+
+    def endSnapshot(self):
+        self.recipient = None
+
+    def writeSnapshot(self, datagram, id, snapshot):
+        state = getSnapshotState(snapshot)
+        if self.recipient is None:
+            datagram.addUint8(SNAPSHOT_FULL)
+            snapshot.addTo(datagram)
+            return
+        baseline = self.recipient.getBaseline(id)
+        if baseline is not None:
+            deltas = [state[i] - baseline[1][i] for i in range(7)]
+            if all(-32768 <= x <= 32767 for x in deltas[:3]) and all(
+                    -128 <= x <= 127 for x in deltas[3:]):
+                mask = 0
+                for i in range(7):
+                    if deltas[i] != 0:
+                        mask |= 1 << i
+                deltaHeaderSchema.addTo(datagram, SNAPSHOT_DELTA, getSequenceAge(
+                    self.recipient.sequence, baseline[0]), mask)
+                size = 3
+                for i in range(7):
+                    if mask & (1 << i):
+                        if i < 3:
+                            datagram.addInt16(deltas[i])
+                            size += 2
+                        else:
+                            datagram.addInt8(deltas[i])
+                            size += 1
+                self.recipient.record(id, state)
+                self.deltaSnapshots += 1
+                self.snapshotBytes += size
+                return
+        datagram.addUint8(SNAPSHOT_FULL)
+        snapshot.addTo(datagram)
+        self.recipient.record(id, state)
+        self.fullSnapshots += 1
+        self.snapshotBytes += SNAPSHOT_FULL_SIZE + 1
+
+    def isAcknowledged(self, id, snapshot):
+        """Returns True once every ready client has acknowledged the snapshot's state for the entity.
+        Always True on clients, since the server doesn't acknowledge what they send."""
+        if net.netMode != constants.MODE_SERVER:
+            return True
+        state = getSnapshotState(snapshot)
+        for connection in list(net.context.activeConnections.values()):
+            if not connection.ready:
+                continue
+            client = self.clients.get(connection.address)
+            baseline = client.acked.get(id) if client is not None else None
+            if baseline is None or baseline[1] != state:
+                return False
+        return True
+
+    def acknowledge(self, address, latest, bits):
+        "Marks the latest sequence, and the 32 before it that are set in bits, as decoded by the client."
+        client = self.clients.get(address)
+        if client is None:
+            return
+        client.acknowledge(latest)
+        for i in range(32):
+            if bits & (1 << i):
+                client.acknowledge((latest - 1 - i) & 0xFFFF)
+
+    def beginRead(self, sequence=None):
+        "Starts reading a packet. Only packets from the server carry a sequence number."
+        self.readSequence = sequence
+        self.readStates = dict()
+        self.readFailed = False
+
+    def endRead(self):
+        "Keeps the states from a fully decoded packet as baselines, and queues an acknowledgement for it."
+        if self.readSequence is None or self.readFailed:
+            self.readSequence = None
+            return
+        sequence = self.readSequence
+        self.readSequence = None
+        self.decoded[sequence] = self.readStates
+        if self.latestSequence is None or getSequenceAge(
+                sequence, self.latestSequence) < 0x8000:
+            self.latestSequence = sequence
+        for old in [x for x in self.decoded.keys() if getSequenceAge(
+                self.latestSequence, x) > snapshotWindow * 2]:
+            del self.decoded[old]
+        self.ackPending = True
+
+    def readSnapshot(self, iterator, id):
+        "Returns the EntitySnapshot in a controller update, or None if there isn't one, or its baseline is missing."
+        encoding = net.Uint8.getFrom(iterator)
+        if encoding == SNAPSHOT_NONE:
+            return None
+        if encoding == SNAPSHOT_FULL:
+            snapshot = EntitySnapshot.getFrom(iterator)
+            self.readStates[id] = getSnapshotState(snapshot, True)
+            return snapshot
+        age = net.Uint8.getFrom(iterator)
+        mask = net.Uint8.getFrom(iterator)
+        deltas = [0] * 7
+        for i in range(7):
+            if mask & (1 << i):
+                deltas[i] = net.Int16.getFrom(
+                    iterator) if i < 3 else net.Int8.getFrom(iterator)
+        baseline = None
+        if self.readSequence is not None:
+            baseline = self.decoded.get(
+                (self.readSequence - age) & 0xFFFF, dict()).get(id)
+        if baseline is None:
+            self.readFailed = True
+            return None
+        state = tuple(baseline[i] + deltas[i] for i in range(7))
+        self.readStates[id] = state
+        snapshot = EntitySnapshot()
+        snapshot.pos = Vec3(state[0] / snapshotPositionScale, state[1] /
+                            snapshotPositionScale, state[2] / snapshotPositionScale)
+        snapshot.quat = Quat(state[3] / snapshotQuatScale, state[4] / snapshotQuatScale,
+                             state[5] / snapshotQuatScale, state[6] / snapshotQuatScale)
+        snapshot.time = engine.clock.time
+        snapshot.empty = False
+        return snapshot
+
+    def buildAckPacket(self):
+        bits = 0
+        for i in range(32):
+            if ((self.latestSequence - 1 - i) & 0xFFFF) in self.decoded:
+                bits |= 1 << i
+        p = net.Packet()
+        p.write(snapshotAckSchema, constants.PACKET_SNAPSHOTACK,
+                self.latestSequence, bits)
+        self.ackPending = False
+        return p
+
+    def getStats(self):
+        total = self.fullSnapshots + self.deltaSnapshots
+        return "%d sent, %d full, %d delta. %.1f bytes per snapshot, %.1f without deltas" % (
+            total, self.fullSnapshots, self.deltaSnapshots,
+            float(self.snapshotBytes) / max(total, 1), SNAPSHOT_FULL_SIZE + 1.0)
+
+
+baselines = SnapshotBaselines()
+
+
+class SnapshotUpdate(net.NetObject):
+    "An EntitySnapshot in a controller update. Written as a delta when the packet's recipient has a baseline for the entity."
+
+    def __init__(self, id, snapshot):
+        self.id = id
+        self.data = snapshot
+
+    def addTo(self, datagram):
+        if baselines.writingReliable:
+            datagram.addUint8(SNAPSHOT_NONE)
+        else:
+            baselines.writeSnapshot(datagram, self.id, self.data)
+
+
+class StateUpdate(net.NetObject):
+    """Fields in a controller update that the next update supersedes, like health. Reliable copies leave them out, so a resend can't overwrite newer state.
+    Written as a Boolean saying whether the fields follow."""
+
+    def __init__(self, data):
+        self.data = data  # A Packet or NetObject
+
+    def addTo(self, datagram):
+        if baselines.writingReliable:
+            net.Boolean(False).addTo(datagram)
+        else:
+            net.Boolean(True).addTo(datagram)
+            self.data.addTo(datagram)
+
+
+class EventUpdate(net.NetObject):
+    """Fields in a controller update that happen once, like a shot fired. A critical update goes out reliably and unreliably.
+    The reliable copy carries the events, and the unreliable copy writes the omitted object (if any) in their place, so they only happen once."""
+
+    def __init__(self, data, omitted=None):
+        self.data = data  # A Packet or NetObject
+        self.omitted = omitted
+
+    def addTo(self, datagram):
+        if baselines.writingEvents:
+            self.data.addTo(datagram)
+        elif self.omitted is not None:
+            self.omitted.addTo(datagram)
+
+
 class NetManager(DirectObject):
 
     def __init__(self):
         self.lastPacketUpdate = 0
         self.spawnPackets = []
         self.deletePackets = []
-        self.clientSpawnPacketRequests = []
         self.chatPackets = []
         self.lastStatsLog = engine.clock.time
         self.incomingPackets = 0
         self.totalIncomingPacketSize = 0
         self.outgoingPackets = 0
         self.totalOutgoingPacketSize = 0
-        self.requestedEntitySpawns = dict()
-        self.lastCheckSumSent = 0
+        baselines.reset()
         self.accept("chat-outgoing", self.chatHandler)
 
     def spawnEntity(self, entity):
@@ -211,6 +423,7 @@ class NetManager(DirectObject):
         iterator = PyDatagramIterator(packet)
         lastId = "None"
         lastController = "None"
+        baselines.beginRead()
         try:
             rebroadcast = True
             while iterator.getRemainingSize() > 0:
@@ -225,31 +438,20 @@ class NetManager(DirectObject):
                         entity.controller.clientUpdate(
                             backend.aiWorld, backend.entityGroup, iterator)
                     else:
-                        engine.log.warning(
+                        # Spawns are reliable, so the spawn packet is on its way.
+                        # Controller updates are unreliable, and can get here first.
+                        engine.log.debug(
                             "Received controller packet with no matching entity. ID: " +
                             str(id) +
                             " Last entity updated: " +
                             lastId +
                             " - controller: " +
                             str(lastController))
-                        # Only send a request once every two seconds
-                        if sender is not None and (
-                            (id not in list(self.requestedEntitySpawns.keys())) or (
-                                engine.clock.time - self.requestedEntitySpawns[id] > 2.0)):
-                            p = net.Packet()
-                            p.add(net.Uint8(constants.PACKET_REQUESTSPAWNPACKET))
-                            p.add(net.Uint8(id))
-                            net.context.send(p, sender)
-                            self.requestedEntitySpawns[id] = engine.clock.time
-                            engine.log.info(
-                                "Sending request for missing entity spawn packet. Entity ID: " + str(id))
                         return rebroadcast
                 elif type == constants.PACKET_SPAWN:
                     controllerType = net.Uint8.getFrom(iterator)
                     entity = controllers.types[controllerType].readSpawnPacket(
                         backend.aiWorld, backend.entityGroup, iterator)
-                    if entity.getId() in list(self.requestedEntitySpawns.keys()):
-                        del self.requestedEntitySpawns[entity.getId()]
                     if entity is not None and backend.entityGroup.getEntity(
                             entity.getId()) is None:
                         backend.entityGroup.addEntity(entity)
@@ -270,10 +472,6 @@ class NetManager(DirectObject):
                         else:
                             entity.delete(backend.entityGroup, False, False)
                     rebroadcast = True
-                elif type == constants.PACKET_REQUESTSPAWNPACKET:
-                    self.clientSpawnPacketRequests.append(
-                        (net.Uint8.getFrom(iterator), sender))
-                    rebroadcast = False
                 elif type == constants.PACKET_SETUP:
                     if net.netMode == net.MODE_CLIENT:
                         messenger.send("client-setup", [iterator])
@@ -291,6 +489,7 @@ class NetManager(DirectObject):
                     messenger.send("end-match", [iterator])
                     rebroadcast = True
                 elif type == constants.PACKET_NEWCLIENT:
+                    baselines.removeClient(sender)
                     # Sender address and username
                     messenger.send("server-new-connection",
                                    [sender, net.String.getFrom(iterator)])
@@ -298,6 +497,7 @@ class NetManager(DirectObject):
                 elif type == constants.PACKET_DISCONNECT:
                     engine.log.info(net.addressToString(
                         sender) + " disconnected.")
+                    baselines.removeClient(sender)
                     messenger.send("disconnect", [sender])
                     rebroadcast = False
                 elif type == constants.PACKET_SERVERFULL:
@@ -316,63 +516,34 @@ class NetManager(DirectObject):
                     # Make sure we get all the data out of the packet to ensure proper processing.
                     # This packet has already been handled by the NetContext.
                     rebroadcast = False
-                elif type == constants.PACKET_ENTITYCHECKSUM:
-                    # Number of active entities we're supposed to have
-                    checksum = net.Uint8.getFrom(iterator)
-                    if net.netMode == net.MODE_CLIENT and checksum != len(
-                            [x for x in list(backend.entityGroup.entities.values()) if x.active and x.getId() < 256]):
-                        # We don't have the right number of entities
-                        p = net.Packet()
-                        p.add(net.Uint8(constants.PACKET_REQUESTENTITYLIST))
-                        net.context.send(p, sender)
-                        engine.log.info(
-                            "Entity checksum failed. Requesting full entity list.")
+                elif type == constants.PACKET_SNAPSHOT:
+                    baselines.beginRead(net.Uint16.getFrom(iterator))
                     rebroadcast = False
-                elif type == constants.PACKET_REQUESTENTITYLIST:
-                    p = net.Packet()
-                    p.add(net.Uint8(constants.PACKET_ENTITYLIST))
-                    entityList = [x for x in list(backend.entityGroup.entities.values(
-                    )) if x.active and x.getId() < 256]
-                    p.add(net.Uint8(len(entityList)))
-                    for entity in entityList:
-                        p.add(net.Uint8(entity.getId()))
-                    net.context.send(p, sender)
-                    engine.log.info("Sending entity list to " +
-                                    net.addressToString(sender))
-                    rebroadcast = False
-                elif type == constants.PACKET_ENTITYLIST:
-                    total = net.Uint8.getFrom(iterator)
-                    entities = []
-                    missingEntities = []
-                    for _ in range(total):
-                        id = net.Uint8.getFrom(iterator)
-                        if id not in list(backend.entityGroup.entities.keys()):
-                            missingEntities.append(id)
-                        entities.append(id)
-                    # Delete any extra entities, assuming they aren't ones that
-                    # we just spawned on our end.
-                    for entity in (
-                            x for x in list(backend.entityGroup.entities.values()) if x.active and x.getId() < 256):
-                        if entity.getId() not in entities and engine.clock.time - entity.spawnTime > 5.0:
-                            entity.delete(backend.entityGroup, False, False)
-                    if len(missingEntities) > 0:
-                        # Request spawn packets for any missing entities
-                        p = net.Packet()
-                        for id in missingEntities:
-                            p.add(net.Uint8(constants.PACKET_REQUESTSPAWNPACKET))
-                            p.add(net.Uint8(id))
-                            self.requestedEntitySpawns[id] = engine.clock.time
-                            engine.log.info(
-                                "Sending request for missing entity spawn packet. Entity ID: " + str(id))
-                        net.context.send(p, sender)
+                elif type == constants.PACKET_SNAPSHOTACK:
+                    latest = net.Uint16.getFrom(iterator)
+                    bits = net.Uint32.getFrom(iterator)
+                    if net.netMode == constants.MODE_SERVER and sender is not None:
+                        baselines.acknowledge(sender, latest, bits)
                     rebroadcast = False
                 else:
                     rebroadcast = False
+            baselines.endRead()
         except AssertionError:
             engine.log.warning("Packet iteration failed. Discarding packet.")
             rebroadcast = False
         return rebroadcast
 
+    def broadcastSnapshots(self, packet):
+        "Writes the packet separately for each ready client, so entity snapshots are delta encoded against what that client has."
+        for client in (
+                x for x in list(net.context.activeConnections.values()) if x.ready):
+            data = PyDatagram()
+            net.Uint8(constants.PACKET_SNAPSHOT).addTo(data)
+            net.Uint16(baselines.beginSnapshot(client.address)).addTo(data)
+            packet.addTo(data)
+            net.context.sendDatagram(data, client.address)
+        baselines.endSnapshot()
+
     def update(self, backend):
         # Only send out an update packet if we need to
         packetUpdate = False
@@ -391,20 +562,25 @@ class NetManager(DirectObject):
         entityList = list(backend.entityGroup.entities.values())
         updatedEntities = []
         controllerPacket = net.Packet()
-        for entity in (x for x in entityList if x.active and x.isLocal):
+        criticalPacket = net.Packet()  # Controller updates with one-off events, which go on the reliable channel
+        for entity in (x for x in entityList if x.active and x.isLocal and not x.controller.isDormant()):
             # Do a server update for local entities.
             # The controller packet is only sent if we've exceeded the regular
             # packet update interval.
+            # Dormant entities are at rest, and have nothing to send.
             p = entity.controller.serverUpdate(
                 backend.aiWorld, backend.entityGroup, packetUpdate)
             if p is not None and entity.controller.needsToSendUpdate():
+                if entity.controller.criticalUpdate:
+                    # The events go in the reliable copy. The snapshot and other state go in the regular one.
+                    criticalPacket.add(p)
                 controllerPacket.add(p)
                 updatedEntities.append(entity)
 
         # Make sure we update our own copy of the entities.
-        sendController = False
-        if len(controllerPacket.dataObjects) > 0:
-            sendController = True
+        sendController = len(controllerPacket.dataObjects) > 0
+        sendCritical = len(criticalPacket.dataObjects) > 0
+        if sendController:
             data = PyDatagram()
             controllerPacket.addTo(data)
             self.processPacket(data, backend)
@@ -418,43 +594,33 @@ class NetManager(DirectObject):
             del self.deletePackets[:]
 
         if packetUpdate:
-            outboundPacket = net.Packet()
-            outboundPacket.add(spawnPacket)
-            outboundPacket.add(controllerPacket)
-            outboundPacket.add(deletePacket)
+            # Spawns, one-off events, deletes and chat are reliable, and arrive in order.
+            reliablePacket = net.Packet()
+            reliablePacket.add(spawnPacket)
+            reliablePacket.add(criticalPacket)
+            reliablePacket.add(deletePacket)
             for chat in self.chatPackets:
-                outboundPacket.add(chat)
+                reliablePacket.add(chat)
             sendChat = len(self.chatPackets) > 0
             del self.chatPackets[:]
-            for request in self.clientSpawnPacketRequests:
-                entity = backend.entityGroup.getEntity(request[0])
-                if entity is not None:
-                    if net.netMode == net.MODE_CLIENT:
-                        outboundPacket.add(
-                            entity.controller.buildSpawnPacket())
-                    else:
-                        temp = net.Packet()
-                        temp.add(entity.controller.buildSpawnPacket())
-                        net.context.send(temp, request[1])
-                    engine.log.info("Sending missed spawn packet (ID " +
-                                    str(request[0]) +
-                                    ") to client " +
-                                    net.addressToString(request[1]))
-                else:
-                    engine.log.warning(
-                        "Client requested spawn packet for non-existent entity.")
-            del self.clientSpawnPacketRequests[:]
-            sendCheckSum = False
-            if net.netMode == constants.MODE_SERVER and engine.clock.time - self.lastCheckSumSent > 5.0:
-                self.lastCheckSumSent = engine.clock.time
-                checkSumPacket = net.Packet()
-                checkSumPacket.add(net.Uint8(constants.PACKET_ENTITYCHECKSUM))
-                checkSumPacket.add(net.Uint8(
-                    len([x for x in entityList if x.active and x.getId() < 256])))
-                outboundPacket.add(checkSumPacket)
-                sendCheckSum = True
-            if sendSpawn or sendController or sendDelete or sendCheckSum or sendChat:
+            if sendSpawn or sendCritical or sendDelete or sendChat:
+                baselines.writingReliable = True
+                net.context.broadcast(reliablePacket, reliable=True)
+                baselines.writingReliable = False
+
+            # Regular controller updates are superseded by the next one, so they aren't worth resending.
+            outboundPacket = net.Packet()
+            # Acknowledgements go first. The server only rebroadcasts a client's packet if the last item in it should be rebroadcast.
+            sendAck = net.netMode == constants.MODE_CLIENT and baselines.ackPending
+            if sendAck:
+                outboundPacket.add(baselines.buildAckPacket())
+            outboundPacket.add(controllerPacket)
+            baselines.writingEvents = False
+            if net.netMode == constants.MODE_SERVER and sendController:
+                self.broadcastSnapshots(outboundPacket)
+            elif sendController or sendAck:
                 net.context.broadcast(outboundPacket)
+            baselines.writingEvents = True
 
         packets = net.context.readTick()
         for packet in packets:
@@ -463,12 +629,12 @@ class NetManager(DirectObject):
             self.incomingPackets += 1
             self.totalIncomingPacketSize += len(packet[0])
             if net.netMode == constants.MODE_SERVER and rebroadcast:
-                net.context.broadcastDatagramExcept(data, packet[1])
+                net.context.broadcastDatagramExcept(data, packet[1], packet[2])
         del packets
 
         if len(entityList) > len(updatedEntities):
             for entity in (
-                    x for x in entityList if x.active and x not in updatedEntities):
+                    x for x in entityList if x.active and x not in updatedEntities and not x.controller.isDormant()):
                 entity.controller.clientUpdate(
                     backend.aiWorld, backend.entityGroup)
 
@@ -484,4 +650,7 @@ class NetManager(DirectObject):
         net.context.writeTick()
 
     def delete(self):
+        engine.log.info("Snapshots: " + baselines.getStats())
+        engine.log.info("Connections: " + net.context.getStats())
+        baselines.reset()
         self.ignoreAll()